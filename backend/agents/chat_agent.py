@@ -1,12 +1,15 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel
 from typing import Dict, List, Any, Optional, AsyncGenerator
 import json
 import re
 import os
+import time
 import asyncio
+import threading
+from collections import OrderedDict, deque
 from enum import Enum
 from agents.profile_extraction_agent import profile_extraction_agent
+from agents.prompt_budget import prompt_budget, estimate_tokens, REQUIRED, HIGH, LOW
+from agents.providers import providers
 
 # 環境変数から設定を取得（全て必須）
 PROJECT_ID = os.getenv("PROJECT_ID")
@@ -21,7 +24,12 @@ if not LOCATION:
 if not TEXT_MODEL_NAME:
     raise ValueError("TEXT_MODEL_NAME environment variable is required")
 
-vertexai.init(project=PROJECT_ID, location=LOCATION)
+# 会話コンテキストの設定
+CONTEXT_MAX_TURNS = int(os.getenv("CHAT_CONTEXT_MAX_TURNS", "10"))           # ユーザーごとに保持する往復数
+CONTEXT_MAX_USERS = int(os.getenv("CHAT_CONTEXT_MAX_USERS", "1000"))         # 全体で保持するユーザー数の上限
+CONTEXT_IDLE_SECONDS = int(os.getenv("CHAT_CONTEXT_IDLE_SECONDS", "1800"))   # この時間操作がなければ破棄
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "300"))    # プロンプトに含める会話の目安トークン数
+CONTEXT_MAX_CHARS = int(os.getenv("CHAT_CONTEXT_MAX_CHARS", "300"))          # 1発言あたり保持する最大文字数
 
 class IntentType(Enum):
     IMAGE_REQUEST = "image_request"       # 冷蔵庫の写真を撮ってもらいたい
@@ -32,13 +40,78 @@ class IntentType(Enum):
     CASUAL_CHAT = "casual_chat"          # 雑談
     CLARIFICATION = "clarification"       # 詳細確認が必要
 
+class ConversationContextStore:
+    """ユーザーごとの直近の会話を保持する（往復数・ユーザー数・アイドル時間で上限を設ける）
+    
+    意図分析はスレッドプールで実行されるため、イベントループ側の追加・削除とはロックで排他する。
+    """
+    
+    def __init__(self):
+        self.users: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # 参照順（末尾が最新）
+        self._lock = threading.Lock()
+    
+    def _evict(self):
+        # ロックを取得した状態で呼び出す
+        now = time.monotonic()
+        while self.users:
+            user_id, entry = next(iter(self.users.items()))
+            if len(self.users) <= CONTEXT_MAX_USERS and now - entry["last_access"] < CONTEXT_IDLE_SECONDS:
+                break
+            del self.users[user_id]
+    
+    def add(self, user_id: str, user_message: str, bot_response: str):
+        with self._lock:
+            entry = self.users.get(user_id)
+            if entry is None:
+                entry = {"turns": deque(maxlen=CONTEXT_MAX_TURNS), "last_access": 0.0}
+                self.users[user_id] = entry
+            entry["turns"].append((user_message[:CONTEXT_MAX_CHARS], bot_response[:CONTEXT_MAX_CHARS]))
+            entry["last_access"] = time.monotonic()
+            self.users.move_to_end(user_id)
+            self._evict()
+    
+    def clear(self, user_id: str):
+        with self._lock:
+            self.users.pop(user_id, None)
+    
+    def build_prompt_context(self, user_id: Optional[str], token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+        """新しい発言から遡り、予算内に収まる分だけ会話履歴をプロンプト用の文字列にする"""
+        if not user_id or token_budget <= 0:
+            return ""
+        with self._lock:
+            self._evict()
+            entry = self.users.get(user_id)
+            # 整形はロックの外で行うため、往復のコピーを取る
+            turns = list(entry["turns"]) if entry else []
+        if not turns:
+            return ""
+        
+        lines: List[str] = []
+        used = 0
+        for user_message, bot_response in reversed(turns):
+            turn = f"ユーザー: {user_message}\nアシスタント: {bot_response}"
+            cost = estimate_tokens(turn)
+            if used + cost > token_budget:
+                break
+            lines.append(turn)
+            used += cost
+        
+        if not lines:
+            return ""
+        lines.reverse()
+        return "\n【これまでの会話（古い順）】\n" + "\n".join(lines) + "\n"
+
 class ChatAgent:
     def __init__(self):
-        self.model = GenerativeModel(TEXT_MODEL_NAME)
-        self.conversation_context = []
+        self.context_store = ConversationContextStore()
+    
+    @property
+    def model(self):
+        # モデルは初回利用時に作成（起動時間を短縮）
+        return providers.get_model(TEXT_MODEL_NAME)
     
-    def analyze_user_intent(self, message: str, has_image: bool = False) -> Dict[str, Any]:
-        """ユーザーの意図を分析する"""
+    def analyze_user_intent(self, message: str, has_image: bool = False, user_id: str = None) -> Dict[str, Any]:
+        """ユーザーの意図を分析する（user_id指定時は直近の会話も考慮）"""
         
         # 画像が添付されている場合
         if has_image:
@@ -51,12 +124,15 @@ class ChatAgent:
             }
         
         # テキストベースの意図分析
-        prompt = f"""
+        context = self.context_store.build_prompt_context(user_id)
+        header = """
 あなたは料理アシスタントの意図理解エキスパートです。
 ユーザーのメッセージを慎重に分析して、以下のカテゴリのどれに該当するか判定してください。
-
+"""
+        user_section = f"""
 ユーザーメッセージ: "{message}"
-
+"""
+        instructions = f"""
 意図カテゴリ:
 1. image_request: 冷蔵庫の写真を撮る/送ることに関する言及
 2. text_ingredients: 具体的な食材名を複数含んでいて、かつレシピ生成を明確に求めている
@@ -103,6 +179,13 @@ class ChatAgent:
     "reasoning": "判定理由の簡潔な説明"
 }}
 """
+        # 予算を超える場合は会話履歴から切り詰める
+        prompt = prompt_budget.build("intent", [
+            (REQUIRED, header),
+            (LOW, context),
+            (HIGH, user_section),
+            (REQUIRED, instructions)
+        ], model=self.model)
         
         try:
             response = self.model.generate_content(prompt)
@@ -355,24 +438,21 @@ class ChatAgent:
         """詳細確認のレスポンス"""
         return "申し訳ございませんが、もう少し詳しく教えていただけますか？🤔\n\n例えば：\n• 冷蔵庫の写真を送る\n• 手持ちの食材を教える\n• 作りたい料理の種類を伝える\n\nなどしていただけると、より良い提案ができます！"
     
-    def add_to_context(self, user_message: str, bot_response: str):
-        """会話履歴をコンテキストに追加"""
-        self.conversation_context.append({
-            "user": user_message,
-            "bot": bot_response,
-            "timestamp": "now"  # 実際の実装では適切なタイムスタンプを
-        })
-        
-        # 履歴が長くなりすぎたら古いものを削除
-        if len(self.conversation_context) > 10:
-            self.conversation_context = self.conversation_context[-10:]
+    def add_to_context(self, user_message: str, bot_response: str, user_id: str = None):
+        """会話履歴をユーザーごとのコンテキストに追加（匿名の会話は保持しない）"""
+        if user_id:
+            self.context_store.add(user_id, user_message, bot_response)
+    
+    def clear_context(self, user_id: str):
+        """ユーザーの会話コンテキストを破棄（新規会話開始時）"""
+        self.context_store.clear(user_id)
     
     # ===== 非同期メソッド（新機能） =====
     
-    async def analyze_user_intent_async(self, message: str, has_image: bool = False) -> Dict[str, Any]:
+    async def analyze_user_intent_async(self, message: str, has_image: bool = False, user_id: str = None) -> Dict[str, Any]:
         """非同期版意図分析（後方互換性のため、同期版を流用）"""
         return await asyncio.get_event_loop().run_in_executor(
-            None, self.analyze_user_intent, message, has_image
+            None, self.analyze_user_intent, message, has_image, user_id
         )
     
     async def generate_response_async(self, intent_result: Dict[str, Any]) -> str:
@@ -393,7 +473,7 @@ class ChatAgent:
         try:
             # Step 1: 意図理解
             yield self._create_sse_data("status", "analyzing_intent")
-            intent_result = await self.analyze_user_intent_async(message, has_image)
+            intent_result = await self.analyze_user_intent_async(message, has_image, user_id)
             yield self._create_sse_data("intent", {
                 "intent": intent_result["intent"].value,
                 "confidence": intent_result["confidence"],
@@ -405,7 +485,11 @@ class ChatAgent:
                 profile_info = intent_result.get("profile_info", {})
                 if profile_info and profile_info.get("confidence", 0) > 0.3:
                     # バックグラウンドで実行（レスポンスをブロックしない）
-                    asyncio.create_task(self._update_profile_from_conversation(user_id, profile_info))
+                    from services.background_tasks import background_tasks
+                    background_tasks.submit(
+                        "profile_update",
+                        lambda: self._update_profile_from_conversation(user_id, profile_info)
+                    )
             
             # Step 3: 応答生成
             response = await self.generate_response_async(intent_result)
@@ -420,7 +504,7 @@ class ChatAgent:
                     yield recipe_data
             
             # 会話コンテキストに追加
-            self.add_to_context(message, response)
+            self.add_to_context(message, response, user_id)
             
             yield self._create_sse_data("complete", {"status": "success"})
             
@@ -448,7 +532,7 @@ class ChatAgent:
             
             # Step 1: 意図理解とプロファイル抽出
             yield self._create_sse_data("status", "analyzing_intent")
-            intent_result = await self.analyze_user_intent_async(message, has_image)
+            intent_result = await self.analyze_user_intent_async(message, has_image, user_id)
             yield self._create_sse_data("intent", {
                 "intent": intent_result["intent"].value,
                 "confidence": intent_result["confidence"],
@@ -481,15 +565,16 @@ class ChatAgent:
             # Step 4: レシピ生成
             yield self._create_sse_data("status", "generating_recipe")
             
+            conversation_context = self.context_store.build_prompt_context(user_id)
             if dish_name:
                 recipe = await asyncio.get_event_loop().run_in_executor(
                     None, recipe_agent.generate_recipe_from_dish_name,
-                    dish_name, {}, user_preferences
+                    dish_name, {}, user_preferences, conversation_context
                 )
             else:
                 recipe = await asyncio.get_event_loop().run_in_executor(
                     None, recipe_agent.generate_recipe_from_ingredients,
-                    ingredients, user_preferences
+                    ingredients, user_preferences, conversation_context
                 )
             
             yield self._create_sse_data("recipe", recipe)
@@ -542,7 +627,7 @@ class ChatAgent:
             
             # Step 8: 会話履歴に追加
             response = self.generate_response(intent_result)
-            self.add_to_context(message, response)
+            self.add_to_context(message, response, user_id)
             
             yield self._create_sse_data("complete", {"status": "success"})
             
@@ -575,15 +660,16 @@ class ChatAgent:
             # Step 1: レシピ生成
             yield self._create_sse_data("status", "generating_recipe")
             
+            conversation_context = self.context_store.build_prompt_context(user_id)
             if dish_name:
                 recipe = await asyncio.get_event_loop().run_in_executor(
                     None, recipe_agent.generate_recipe_from_dish_name,
-                    dish_name, {}, user_preferences
+                    dish_name, {}, user_preferences, conversation_context
                 )
             else:
                 recipe = await asyncio.get_event_loop().run_in_executor(
                     None, recipe_agent.generate_recipe_from_ingredients,
-                    ingredients, user_preferences
+                    ingredients, user_preferences, conversation_context
                 )
             
             yield self._create_sse_data("recipe", recipe)
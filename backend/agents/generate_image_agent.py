@@ -1,11 +1,8 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel
 import base64
-from google import genai
-from google.genai import types
 import asyncio
 import os
 from typing import Optional
+from agents.providers import providers
 
 # 環境変数から設定を取得（全て必須）
 PROJECT_ID = os.getenv("PROJECT_ID")
@@ -20,15 +17,19 @@ if not LOCATION:
 if not IMAGE_MODEL_NAME:
     raise ValueError("IMAGE_MODEL_NAME environment variable is required")
 
-vertexai.init(project=PROJECT_ID, location=LOCATION)
-
 class GenerateImageAgent:
     def __init__(self):
         self.model_name = IMAGE_MODEL_NAME
-        self.client = genai.Client()
+    
+    @property
+    def client(self):
+        # GenAIクライアントは初回利用時に作成（起動時間を短縮）
+        return providers.get_genai_client()
     
     def generate_single_image(self, step_description: str) -> str:
         """単一の調理手順画像を生成する"""
+        # GenAI SDKは起動時に読み込まない
+        from google.genai import types
         contents = [
             types.Content(
                 role="user",
@@ -1,9 +1,9 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel
 from typing import Dict, List, Any
 import json
 import re
 import os
+from agents.prompt_budget import prompt_budget, join_limited, REQUIRED, HIGH, MEDIUM
+from agents.providers import providers
 
 # 環境変数から設定を取得（全て必須）
 PROJECT_ID = os.getenv("PROJECT_ID")
@@ -18,22 +18,25 @@ if not LOCATION:
 if not TEXT_MODEL_NAME:
     raise ValueError("TEXT_MODEL_NAME environment variable is required")
 
-vertexai.init(project=PROJECT_ID, location=LOCATION)
-
 class NutritionAgent:
-    def __init__(self):
-        self.model = GenerativeModel(TEXT_MODEL_NAME)
+    @property
+    def model(self):
+        # モデルは初回利用時に作成（起動時間を短縮）
+        return providers.get_model(TEXT_MODEL_NAME)
     
     def analyze_recipe_nutrition(self, recipe_text: str, ingredients: List[str]) -> Dict[str, Any]:
         """レシピの栄養価を分析する"""
-        prompt = f"""
+        header = """
 あなたは栄養学の専門家です。以下のレシピの栄養価を分析してください。
-
-使用食材: {', '.join(ingredients)}
-
+"""
+        ingredient_section = f"""
+使用食材: {join_limited(ingredients, 30)}
+"""
+        recipe_section = f"""
 レシピ:
 {recipe_text}
-
+"""
+        instructions = f"""
 以下のJSON形式で回答してください：
 {{
     "calories_per_serving": 推定カロリー数（数値のみ）,
@@ -70,6 +73,12 @@ class NutritionAgent:
 
 数値は整数で、文字列は日本語で記述してください。JSONの形式を厳密に守ってください。
 """
+        prompt = prompt_budget.build("nutrition", [
+            (REQUIRED, header),
+            (MEDIUM, ingredient_section),
+            (HIGH, recipe_section),
+            (REQUIRED, instructions)
+        ], model=self.model)
         
         try:
             response = self.model.generate_content(prompt)
@@ -1,27 +1,24 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel
 import json
 import re
 import os
 from typing import Dict, List, Any, Optional
+from agents.prompt_budget import prompt_budget, REQUIRED, HIGH
+from agents.providers import providers
 
 # 環境変数から設定を取得
 PROJECT_ID = os.getenv("PROJECT_ID")
 LOCATION = os.getenv("LOCATION") 
 TEXT_MODEL_NAME = os.getenv("TEXT_MODEL_NAME")
 
-# 必須環境変数のチェック
-if PROJECT_ID and LOCATION and TEXT_MODEL_NAME:
-    vertexai.init(project=PROJECT_ID, location=LOCATION)
-
 class ProfileExtractionAgent:
     """会話からユーザープロファイル情報を抽出するエージェント"""
     
-    def __init__(self):
+    @property
+    def model(self):
+        # 環境変数が揃っている場合のみ、初回利用時にモデルを作成
         if PROJECT_ID and LOCATION and TEXT_MODEL_NAME:
-            self.model = GenerativeModel(TEXT_MODEL_NAME)
-        else:
-            self.model = None
+            return providers.get_model(TEXT_MODEL_NAME)
+        return None
     
     def extract_profile_info(self, message: str) -> Dict[str, Any]:
         """会話からユーザープロファイル情報を抽出する（全メッセージ対象）"""
@@ -41,12 +38,14 @@ class ProfileExtractionAgent:
         if message.strip().lower() in skip_patterns:
             return {}
             
-        prompt = f"""
+        header = """
 あなたは料理アシスタントの高度なプロファイル分析エキスパートです。
 ユーザーのメッセージから料理・食事に関する個人情報を可能な限り抽出してください。
-
+"""
+        user_section = f"""
 ユーザーメッセージ: "{message}"
-
+"""
+        instructions = f"""
 以下の項目を詳細に分析し、関連する情報があれば全て抽出してください：
 
 ## 必須項目
@@ -131,6 +130,11 @@ class ProfileExtractionAgent:
     "reasoning": "抽出理由の詳細説明"
 }}
 """
+        prompt = prompt_budget.build("profile_extraction", [
+            (REQUIRED, header),
+            (HIGH, user_section),
+            (REQUIRED, instructions)
+        ], model=self.model)
         
         try:
             response = self.model.generate_content(prompt)
@@ -0,0 +1,131 @@
+import os
+import threading
+from typing import Dict, List, Any, Iterable, Optional, Tuple
+
+# プロンプトの目安トークン数（エージェントごとに PROMPT_TOKEN_BUDGET_<AGENT> で上書き可能）
+DEFAULT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+# 有効にするとモデルのcount_tokensで実際のトークン数も計測する（API呼び出しが増える）
+COUNT_TOKENS_ENABLED = os.getenv("PROMPT_COUNT_TOKENS", "false").lower() == "true"
+# プロファイル由来のリストをプロンプトに含める最大件数
+MAX_LIST_ITEMS = int(os.getenv("PROMPT_MAX_LIST_ITEMS", "10"))
+
+# セクションの優先度（小さいほど重要。REQUIREDは切り詰めない）
+REQUIRED = 0
+HIGH = 1
+MEDIUM = 2
+LOW = 3
+
+TRUNCATION_MARK = "…"
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（日本語は1文字≒1トークン、ASCIIは4文字≒1トークン）"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def join_limited(items: Iterable[Any], max_items: int = MAX_LIST_ITEMS, separator: str = ", ") -> str:
+    """重複を除いて先頭からmax_items件までを連結する（超過分は件数のみ記載）"""
+    unique = list(dict.fromkeys(str(item) for item in items if item))
+    text = separator.join(unique[:max_items])
+    if len(unique) > max_items:
+        text += f" ほか{len(unique) - max_items}件"
+    return text
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """後ろの行から削り、それでも収まらなければ文字単位で切り詰める"""
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    lines = text.split("\n")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > max_tokens:
+        lines.pop()
+    text = "\n".join(lines)
+
+    while text and estimate_tokens(text + TRUNCATION_MARK) > max_tokens:
+        text = text[:-max(1, len(text) // 10)]
+    return text + TRUNCATION_MARK if text else ""
+
+class PromptBudget:
+    """優先度付きセクションから予算内のプロンプトを組み立て、エージェントごとのサイズを記録する"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get_budget(self, agent: str) -> int:
+        return int(os.getenv(f"PROMPT_TOKEN_BUDGET_{agent.upper()}", str(DEFAULT_TOKEN_BUDGET)))
+
+    def build(self, agent: str, sections: List[Tuple[int, str]], budget: Optional[int] = None, model: Any = None) -> str:
+        """sections: プロンプト順の (優先度, テキスト)。予算超過時は優先度の低いセクションから切り詰める"""
+        budget = self.get_budget(agent) if budget is None else budget
+        texts = [text or "" for _, text in sections]
+        costs = [estimate_tokens(text) for text in texts]
+        total = sum(costs)
+        truncated = 0
+        dropped = 0
+
+        if total > budget:
+            # 優先度が低い順、同じ優先度なら後ろのセクションから削る（結果は常に同じ）
+            order = sorted(range(len(sections)), key=lambda i: (-sections[i][0], -i))
+            for i in order:
+                if total <= budget or sections[i][0] == REQUIRED:
+                    break
+                if not texts[i]:
+                    continue
+                texts[i] = truncate_to_tokens(texts[i], costs[i] - (total - budget))
+                if texts[i]:
+                    truncated += 1
+                else:
+                    dropped += 1
+                total -= costs[i] - estimate_tokens(texts[i])
+                costs[i] = estimate_tokens(texts[i])
+
+        prompt = "".join(texts)
+        counted = None
+        if COUNT_TOKENS_ENABLED and model is not None:
+            try:
+                counted = model.count_tokens(prompt).total_tokens
+            except Exception as e:
+                print(f"[WARN] count_tokensに失敗しました: {e}")
+
+        self._record(agent, total, budget, truncated, dropped, counted)
+        return prompt
+
+    def _record(self, agent: str, tokens: int, budget: int, truncated: int, dropped: int, counted: Optional[int]):
+        with self._lock:
+            metrics = self.metrics.setdefault(agent, {
+                'calls': 0,
+                'estimated_tokens_total': 0,
+                'estimated_tokens_max': 0,
+                'truncated_calls': 0,
+                'dropped_sections': 0,
+                'over_budget_calls': 0,
+                'last_counted_tokens': None
+            })
+            metrics['calls'] += 1
+            metrics['estimated_tokens_total'] += tokens
+            metrics['estimated_tokens_max'] = max(metrics['estimated_tokens_max'], tokens)
+            metrics['budget'] = budget
+            if truncated or dropped:
+                metrics['truncated_calls'] += 1
+            metrics['dropped_sections'] += dropped
+            if tokens > budget:
+                # 必須セクションだけで予算を超えている
+                metrics['over_budget_calls'] += 1
+            if counted is not None:
+                metrics['last_counted_tokens'] = counted
+
+    def get_metrics(self) -> Dict[str, Dict[str, Any]]:
+        """エージェントごとのプロンプトサイズ統計"""
+        with self._lock:
+            return {
+                agent: {
+                    **metrics,
+                    'estimated_tokens_avg': metrics['estimated_tokens_total'] // metrics['calls'] if metrics['calls'] else 0
+                }
+                for agent, metrics in self.metrics.items()
+            }
+
+# シングルトンインスタンス
+prompt_budget = PromptBudget()
@@ -0,0 +1,96 @@
+import os
+import time
+import threading
+import importlib
+import importlib.util
+from typing import Any, Callable, Dict
+
+# 環境変数から設定を取得
+PROJECT_ID = os.getenv("PROJECT_ID")
+LOCATION = os.getenv("LOCATION")
+
+class ProviderRegistry:
+    """Vertex AIのモデル・GenAIクライアント・Firestoreクライアントなどを初回利用時に作成して共有する
+    
+    起動時にはSDKの読み込みもクライアントの作成も行わない（Cloud Runのコールドスタート短縮）。
+    vertexai.init はプロセス内で1回だけ呼ぶ。
+    """
+    
+    def __init__(self):
+        self._instances: Dict[str, Any] = {}
+        # 初期化中に別のプロバイダを取得する（モデル作成前のvertexai.initなど）ため再入可能なロックを使う
+        self._lock = threading.RLock()
+        self.init_seconds: Dict[str, float] = {}
+    
+    def get(self, key: str, factory: Callable[[], Any]) -> Any:
+        """keyのインスタンスを返す（未作成ならfactoryで作成）"""
+        instance = self._instances.get(key)
+        if instance is not None:
+            return instance
+        with self._lock:
+            instance = self._instances.get(key)
+            if instance is None:
+                started_at = time.perf_counter()
+                instance = factory()
+                self.init_seconds[key] = round(time.perf_counter() - started_at, 4)
+                self._instances[key] = instance
+                print(f"[INFO] プロバイダを初期化しました: {key} ({self.init_seconds[key]}秒)")
+            return instance
+    
+    def _init_vertexai(self) -> bool:
+        import vertexai
+        vertexai.init(project=PROJECT_ID, location=LOCATION)
+        return True
+    
+    def get_model(self, model_name: str, preview: bool = False) -> Any:
+        """Vertex AIのGenerativeModel（preview=Trueでpreview版のクラスを使う）"""
+        def create():
+            self.get("vertexai", self._init_vertexai)
+            if preview:
+                from vertexai.preview.generative_models import GenerativeModel
+            else:
+                from vertexai.generative_models import GenerativeModel
+            return GenerativeModel(model_name)
+        return self.get(f"model:{'preview:' if preview else ''}{model_name}", create)
+    
+    def get_genai_client(self) -> Any:
+        """Google GenAI SDKのクライアント（画像生成用）"""
+        def create():
+            from google import genai
+            return genai.Client()
+        return self.get("genai", create)
+    
+    def get_firestore_client(self) -> Any:
+        """プロファイル保存用の非同期Firestoreクライアント"""
+        def create():
+            from google.cloud import firestore
+            return firestore.AsyncClient()
+        return self.get("firestore", create)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """初期化済みのプロバイダと初期化にかかった秒数"""
+        return {'initialized': sorted(self._instances.keys()), 'init_seconds': dict(self.init_seconds)}
+
+# シングルトンインスタンス
+providers = ProviderRegistry()
+
+class LazyModule:
+    """属性に初めてアクセスした時点でモジュールを読み込む
+    
+    Firestoreなどのモジュールレベルのimportを置き換え、起動時にSDKを読み込まないようにする。
+    読み込みにかかった時間はプロバイダと同様に get_metrics に記録する。
+    """
+    
+    def __init__(self, name: str):
+        self._name = name
+    
+    def __getattr__(self, attr: str) -> Any:
+        module = providers.get(f"module:{self._name}", lambda: importlib.import_module(self._name))
+        return getattr(module, attr)
+
+def module_available(name: str) -> bool:
+    """モジュールを読み込まずにインストールされているかを確認"""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ImportError:
+        return False
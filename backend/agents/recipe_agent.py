@@ -1,8 +1,9 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel
 import re
 import os
-from typing import List, Dict, Optional, Any
+from collections import OrderedDict
+from typing import List, Dict, Optional, Any, Tuple
+from agents.prompt_budget import prompt_budget, join_limited, REQUIRED, HIGH, MEDIUM, LOW
+from agents.providers import providers
 
 # 環境変数から設定を取得（全て必須）
 PROJECT_ID = os.getenv("PROJECT_ID")
@@ -17,62 +18,72 @@ if not LOCATION:
 if not TEXT_MODEL_NAME:
     raise ValueError("TEXT_MODEL_NAME environment variable is required")
 
-vertexai.init(project=PROJECT_ID, location=LOCATION)
+# プロファイル制約文のキャッシュ件数（(user_id, profile_version) ごとに1件）
+CONSTRAINTS_CACHE_MAX_ENTRIES = int(os.getenv("RECIPE_CONSTRAINTS_CACHE_MAX_ENTRIES", "1000"))
 
 class RecipeAgent:
     def __init__(self):
-        self.model = GenerativeModel(TEXT_MODEL_NAME)
+        self._constraints_cache: "OrderedDict[Tuple[str, int], List[Tuple[int, str]]]" = OrderedDict()
+        self.constraints_cache_stats = {'hits': 0, 'misses': 0}
     
-    def generate_recipe_from_ingredients(self, ingredients: List[str], user_preferences: Optional[Dict[str, Any]] = None) -> str:
-        """食材リストからレシピを生成する（プロファイル対応）"""
+    @property
+    def model(self):
+        # モデルは初回利用時に作成（起動時間を短縮）
+        return providers.get_model(TEXT_MODEL_NAME)
+    
+    def generate_recipe_from_ingredients(self, ingredients: List[str], user_preferences: Optional[Dict[str, Any]] = None, conversation_context: str = "") -> str:
+        """食材リストからレシピを生成する（プロファイル・直近の会話対応）"""
         
         # 基本プロンプト
-        prompt = f"""
+        sections = [(REQUIRED, """
 あなたは料理の専門家です。次の食材を使って夜ご飯を1品提案してください。
-食材: {', '.join(ingredients)}
-"""
+"""), (HIGH, f"""食材: {join_limited(ingredients, 30)}
+""")]
         
         # ユーザープロファイルに基づく制約を追加
         if user_preferences:
-            prompt += self._build_preferences_constraints(user_preferences)
+            sections += self._get_preferences_sections(user_preferences)
         
-        prompt += """
+        # 直近の会話（人数や気分などの文脈）を参考情報として追加
+        sections.append((LOW, conversation_context))
+        
+        sections.append((REQUIRED, """
 以下の形式で回答してください：
 - 日本語で簡潔にレシピ名・材料・手順を提示してください。
 - Markdown形式で出力してください。
 - 手順は番号付きリスト（1. 2. 3. ...）で明確に記載してください。
-"""
+"""))
         
+        # 予算を超える場合は会話履歴・好みの順に切り詰める
+        prompt = prompt_budget.build("recipe", sections, model=self.model)
         response = self.model.generate_content(prompt)
         return response.text
     
-    def generate_recipe_from_dish_name(self, dish_name: str, preferences: Dict = None, user_preferences: Optional[Dict[str, Any]] = None) -> str:
-        """料理名からレシピを生成する（プロファイル対応）"""
-        base_prompt = f"""
+    def generate_recipe_from_dish_name(self, dish_name: str, preferences: Dict = None, user_preferences: Optional[Dict[str, Any]] = None, conversation_context: str = "") -> str:
+        """料理名からレシピを生成する（プロファイル・直近の会話対応）"""
+        sections = [(REQUIRED, f"""
 あなたは料理の専門家です。「{dish_name}」のレシピを提案してください。
-"""
+""")]
         
         # ユーザープロファイルに基づく制約を追加
         if user_preferences:
-            base_prompt += self._build_preferences_constraints(user_preferences)
+            sections += self._get_preferences_sections(user_preferences)
+        
+        # 直近の会話（人数や気分などの文脈）を参考情報として追加
+        sections.append((LOW, conversation_context))
         
-        base_prompt += """
+        sections.append((REQUIRED, """
 以下の形式で回答してください：
 - 日本語で簡潔にレシピ名・材料・手順を提示してください。
 - Markdown形式で出力してください。
 - 手順は番号付きリスト（1. 2. 3. ...）で明確に記載してください。
 - 一般的で作りやすいレシピにしてください。
-"""
+"""))
         
         # 追加の要求があれば追加
-        if preferences:
-            if preferences.get("time_constraint"):
-                base_prompt += f"\n- 調理時間: {preferences['time_constraint']}"
-            if preferences.get("difficulty_level"):
-                base_prompt += f"\n- 難易度: {preferences['difficulty_level']}"
-            if preferences.get("cooking_method"):
-                base_prompt += f"\n- 調理法: {preferences['cooking_method']}"
+        sections.append((MEDIUM, self._build_request_options(preferences)))
         
+        base_prompt = prompt_budget.build("recipe", sections, model=self.model)
         response = self.model.generate_content(base_prompt)
         return response.text
     
@@ -93,11 +104,12 @@ class RecipeAgent:
     
     def generate_recipe_with_both(self, dish_name: str, ingredients: List[str], preferences: Dict = None) -> str:
         """食材と料理名両方を使ったレシピ生成"""
+        ingredient_list = join_limited(ingredients, 30)
         base_prompt = f"""
-あなたは料理の専門家です。「{dish_name}」を「{', '.join(ingredients)}」を使って作るレシピを提案してください。
+あなたは料理の専門家です。「{dish_name}」を「{ingredient_list}」を使って作るレシピを提案してください。
 以下の条件を守ってください：
 - 料理名: {dish_name}
-- 主要食材: {', '.join(ingredients)}
+- 主要食材: {ingredient_list}
 - 日本語で簡潔にレシピ名・材料・手順を提示してください。
 - Markdown形式で出力してください。
 - 手順は番号付きリスト（1. 2. 3. ...）で明確に記載してください。
@@ -105,14 +117,10 @@ class RecipeAgent:
 """
         
         # 追加の要求があれば追加
-        if preferences:
-            if preferences.get("time_constraint"):
-                base_prompt += f"\n- 調理時間: {preferences['time_constraint']}"
-            if preferences.get("difficulty_level"):
-                base_prompt += f"\n- 難易度: {preferences['difficulty_level']}"
-            if preferences.get("cooking_method"):
-                base_prompt += f"\n- 調理法: {preferences['cooking_method']}"
-        
+        base_prompt = prompt_budget.build("recipe", [
+            (REQUIRED, base_prompt),
+            (MEDIUM, self._build_request_options(preferences))
+        ], model=self.model)
         response = self.model.generate_content(base_prompt)
         return response.text
     
@@ -152,21 +160,67 @@ class RecipeAgent:
             'difficulty': 'easy' if len(steps) <= 3 else 'medium' if len(steps) <= 6 else 'hard'
         }
     
+    def _build_request_options(self, preferences: Optional[Dict]) -> str:
+        """リクエストごとの追加要求（調理時間・難易度・調理法）"""
+        options = ""
+        if preferences:
+            if preferences.get("time_constraint"):
+                options += f"\n- 調理時間: {preferences['time_constraint']}"
+            if preferences.get("difficulty_level"):
+                options += f"\n- 難易度: {preferences['difficulty_level']}"
+            if preferences.get("cooking_method"):
+                options += f"\n- 調理法: {preferences['cooking_method']}"
+        return options
+    
     def _build_preferences_constraints(self, preferences: Dict[str, Any]) -> str:
         """ユーザープロファイルから制約文を構築"""
+        return "".join(text for _, text in self._get_preferences_sections(preferences))
+    
+    def preferences_cache_key(self, preferences: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+        """嗜好サマリーの (user_id, profile_version)。プロファイルが同じ間は変わらないため応答キャッシュのキーにも使える"""
+        if preferences.get('user_id') and preferences.get('profile_version') is not None:
+            return (preferences['user_id'], preferences['profile_version'])
+        return None
+    
+    def _get_preferences_sections(self, preferences: Dict[str, Any]) -> List[Tuple[int, str]]:
+        """制約文をプロファイルのバージョン単位でキャッシュして返す"""
+        key = self.preferences_cache_key(preferences)
+        if key is None:
+            return self._build_preferences_sections(preferences)
+        
+        sections = self._constraints_cache.get(key)
+        if sections is not None:
+            self._constraints_cache.move_to_end(key)
+            self.constraints_cache_stats['hits'] += 1
+            return sections
+        
+        self.constraints_cache_stats['misses'] += 1
+        sections = self._build_preferences_sections(preferences)
+        self._constraints_cache[key] = sections
+        while len(self._constraints_cache) > CONSTRAINTS_CACHE_MAX_ENTRIES:
+            self._constraints_cache.popitem(last=False)
+        return sections
+    
+    def get_constraints_cache_stats(self) -> Dict[str, Any]:
+        """制約文キャッシュの統計"""
+        return {**self.constraints_cache_stats, 'entries': len(self._constraints_cache)}
+    
+    def _build_preferences_sections(self, preferences: Dict[str, Any]) -> List[Tuple[int, str]]:
+        """ユーザープロファイルから制約文を構築（安全に関わる制約は必須、それ以外は予算に応じて切り詰め可能）"""
+        required = []
         constraints = []
         
-        # 食事制限・アレルギー
+        # 食事制限・アレルギー（切り詰めない）
         if preferences.get('dietary_restrictions'):
-            restrictions = ', '.join(preferences['dietary_restrictions'])
-            constraints.append(f"食事制限: {restrictions}に対応してください")
+            restrictions = join_limited(preferences['dietary_restrictions'], len(preferences['dietary_restrictions']))
+            required.append(f"食事制限: {restrictions}に対応してください")
         
         if preferences.get('allergies'):
-            allergies = ', '.join(preferences['allergies'])
-            constraints.append(f"アレルギー食材は絶対に使用しないでください: {allergies}")
+            allergies = join_limited(preferences['allergies'], len(preferences['allergies']))
+            required.append(f"アレルギー食材は絶対に使用しないでください: {allergies}")
         
         if preferences.get('disliked_ingredients'):
-            dislikes = ', '.join(preferences['disliked_ingredients'])
+            dislikes = join_limited(preferences['disliked_ingredients'])
             constraints.append(f"苦手な食材は避けてください: {dislikes}")
         
         # 好みの食材・料理ジャンル
@@ -221,9 +275,13 @@ class RecipeAgent:
             if '電子レンジ' in equipment and len(equipment) <= 3:
                 constraints.append("簡単な調理器具のみを使用してください")
         
-        if constraints:
-            return "\n\n【制約条件】\n- " + "\n- ".join(constraints) + "\n"
-        return ""
+        if not required and not constraints:
+            return []
+        # 優先度の高い制約ほど前に並んでいるため、切り詰めは末尾の行から行われる
+        return [
+            (REQUIRED, "\n\n【制約条件】" + "".join(f"\n- {c}" for c in required)),
+            (HIGH, "".join(f"\n- {c}" for c in constraints) + "\n")
+        ]
 
 # シングルトンインスタンス
 recipe_agent = RecipeAgent()
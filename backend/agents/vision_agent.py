@@ -1,6 +1,5 @@
-from vertexai.preview.generative_models import GenerativeModel, Part
-import vertexai
 import os
+from agents.providers import providers
 
 # 環境変数から設定を取得（全て必須）
 PROJECT_ID = os.getenv("PROJECT_ID")
@@ -15,8 +14,6 @@ if not LOCATION:
 if not MODEL_NAME:
     raise ValueError("TEXT_MODEL_NAME environment variable is required")
 
-vertexai.init(project=PROJECT_ID, location=LOCATION)
-model = GenerativeModel(MODEL_NAME)
 
 def extract_ingredients_from_image(image_path: str) -> list[str]:
     with open(image_path, "rb") as f:
@@ -29,6 +26,8 @@ def extract_ingredients_from_image(image_path: str) -> list[str]:
         "また、はい、いいえ等の返答も絶対に含めないでください。"
     )
 
+    from vertexai.preview.generative_models import Part
+    model = providers.get_model(MODEL_NAME, preview=True)
     response = model.generate_content([
         prompt,
         Part.from_data(data=image_data, mime_type="image/jpeg")
@@ -1,6 +1,6 @@
 from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, status, Request as HTTPRequest
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response
 from pydantic import BaseModel
 import os
 import sys
@@ -8,6 +8,8 @@ import shutil
 import json
 import asyncio
 import re
+import time
+from urllib.parse import urlencode
 from typing import AsyncGenerator, Dict, Any, Optional
 from functools import wraps
 
@@ -20,18 +22,22 @@ from agents.recipe_agent import recipe_agent
 from agents.generate_image_agent import image_agent
 from agents.nutrition_agent import nutrition_agent
 from agents.chat_agent import chat_agent
+from agents.prompt_budget import prompt_budget
+from agents.providers import providers
 
 # 認証関連
-from auth import google_auth, GoogleLoginRequest, get_current_user
+from auth import google_auth, GoogleLoginRequest, get_current_user, google_cert_cache, sign_attachment, verify_attachment_signature, attachment_signing_window
 
 # レート制限
 from rate_limiter import rate_limiter
 
 # LINEスタイル会話永続化
-from conversation_storage import line_conversation_storage
+from conversation_storage import line_conversation_storage, ATTACHMENT_PREFIX
 
 # プロファイル管理
 from services.profile_storage import profile_storage
+from services.profile_learning import profile_learning_queue
+from services.background_tasks import background_tasks
 from models.user_profile import UserProfileUpdate, RecipeFeedback, CookingSession
 
 
@@ -41,6 +47,13 @@ from models.user_profile import UserProfileUpdate, RecipeFeedback, CookingSessio
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# 会話履歴の1ページあたりの件数（初回表示は最新のこの件数のみ）
+CONVERSATION_PAGE_SIZE = int(os.getenv("CONVERSATION_PAGE_SIZE", "50"))
+CONVERSATION_MAX_PAGE_SIZE = 200
+
+# 添付画像URLの前に付ける公開URL（未設定時は相対パスを返し、フロントエンドがAPIのURLを付ける）
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+
 class ChatMessage(BaseModel):
     message: str
     has_image: bool = False
@@ -169,7 +182,8 @@ def require_rate_limit(check_image_generation: bool = False):
                 if payload:
                     with_images = getattr(payload, 'with_images', False)
             
-            can_proceed, remaining = await rate_limiter.check_limits(user_id, with_images)
+            # チェックと加算を1回でアトミックに行う（同時リクエストのすり抜け防止）
+            can_proceed, remaining = await rate_limiter.reserve(user_id, with_images)
             
             if not can_proceed:
                 if remaining['total_remaining'] <= 0:
@@ -188,12 +202,34 @@ def require_rate_limit(check_image_generation: bool = False):
                     }
                 )
             
-            result = await func(*args, **kwargs)
-            await rate_limiter.increment_count(user_id, with_images)
+            try:
+                result = await func(*args, **kwargs)
+            except BaseException:
+                await rate_limiter.refund(user_id, with_images)
+                raise
+            
+            # ストリーミングの場合は失敗・中断時に利用枠を返却する
+            if isinstance(result, StreamingResponse):
+                result.body_iterator = refund_on_stream_failure(result.body_iterator, user_id, with_images)
             return result
         return wrapper
     return decorator
 
+async def refund_on_stream_failure(body_iterator, user_id: str, with_images: bool):
+    """ストリームがエラー終了・クライアント切断した場合に利用枠を返却"""
+    completed = False
+    failed = False
+    try:
+        async for chunk in body_iterator:
+            text = chunk.decode('utf-8', errors='ignore') if isinstance(chunk, bytes) else chunk
+            if text.startswith('data: {"type":"error"'):
+                failed = True
+            yield chunk
+        completed = True
+    finally:
+        if failed or not completed:
+            await rate_limiter.refund(user_id, with_images)
+
 # 管理者権限デコレーター
 def require_admin():
     def decorator(func):
@@ -231,26 +267,110 @@ async def authenticate_google(request: GoogleLoginRequest):
 
 # === LINEスタイル会話永続化エンドポイント ===
 
+def resolve_attachment_urls(messages: list, user_id: str) -> list:
+    """添付参照（attachment://<id>）をユーザー用の署名付き・期限付きの取得URLに置き換える"""
+    def to_url(value):
+        if isinstance(value, str) and value.startswith(ATTACHMENT_PREFIX):
+            attachment_id = value[len(ATTACHMENT_PREFIX):]
+            return f"{PUBLIC_BASE_URL}/conversations/attachments/{attachment_id}?{urlencode(sign_attachment(user_id, attachment_id))}"
+        return value
+    
+    resolved = []
+    for message in messages:
+        message = dict(message)
+        message['image'] = to_url(message.get('image'))
+        if isinstance(message.get('stepImage'), dict):
+            message['stepImage'] = {**message['stepImage'], 'image_url': to_url(message['stepImage'].get('image_url'))}
+        resolved.append(message)
+    return resolved
+
 @app.get("/conversations/messages")
-async def get_user_messages(current_user: dict = Depends(get_current_user)):
-    """ユーザーの全メッセージを取得（LINEスタイル）"""
+async def get_user_messages(
+    http_request: HTTPRequest,
+    response: Response,
+    limit: int = CONVERSATION_PAGE_SIZE,
+    before: Optional[str] = None,
+    since: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """ユーザーのメッセージを新しい順にページ単位で取得（LINEスタイル）
+    
+    さらに古い履歴は next_cursor を before に指定して取得する。
+    since（メッセージIDまたはタイムスタンプ）を指定すると、それより新しいメッセージのみを古い順に返す。
+    会話に変更がなければ If-None-Match に対して 304 を返す。
+    """
     try:
         user_id = current_user['id']
-        messages = await line_conversation_storage.get_user_messages(user_id)
+        limit = max(1, min(limit, CONVERSATION_MAX_PAGE_SIZE))
+        
+        version = await line_conversation_storage.get_conversation_version(user_id)
+        # 本文の添付URLは署名期間ごとに変わるため、期間もETagに含める（304で期限切れのURLを使わせない）
+        etag = f'"{version}.{attachment_signing_window()}"'
+        if http_request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
+        
+        if since:
+            # 1件多く取得して続きがあるか判定（続きは最後のメッセージIDを since に指定）
+            messages = await line_conversation_storage.get_messages_since(user_id, since, limit=limit + 1)
+            has_more = len(messages) > limit
+            messages = resolve_attachment_urls(messages[:limit], user_id)
+            return {
+                "messages": messages,
+                "message_count": len(messages),
+                "has_more": has_more,
+                "next_since": messages[-1].get('id') if has_more and messages else None,
+                "version": version,
+                "backend": line_conversation_storage.backend
+            }
+        
+        # 1件多く取得して続きがあるか判定
+        messages = await line_conversation_storage.get_user_messages(user_id, limit=limit + 1, before=before)
+        has_more = len(messages) > limit
+        if has_more:
+            messages = messages[1:]
+        messages = resolve_attachment_urls(messages, user_id)
         
         return {
             "messages": messages,
             "message_count": len(messages),
+            "has_more": has_more,
+            "next_cursor": messages[0].get('id') if has_more and messages else None,
+            "version": version,
             "backend": line_conversation_storage.backend
         }
     except Exception as e:
         return {
             "messages": [],
             "message_count": 0,
+            "has_more": False,
+            "next_cursor": None,
             "backend": line_conversation_storage.backend,
             "error": str(e)
         }
 
+@app.get("/conversations/attachments/{attachment_id}")
+async def get_conversation_attachment(attachment_id: str, uid: str = "", exp: int = 0, sig: str = ""):
+    """メッセージ添付画像を取得（会話履歴の取得時に発行した署名付き・期限付きURLのみ有効）"""
+    if not re.fullmatch(r"[0-9a-f]{64}", attachment_id):
+        raise HTTPException(status_code=404, detail="添付が見つかりません")
+    if not verify_attachment_signature(uid, attachment_id, exp, sig):
+        raise HTTPException(status_code=403, detail="添付URLの有効期限が切れているか、署名が正しくありません")
+    
+    attachment = await line_conversation_storage.get_attachment(uid, attachment_id)
+    if attachment is None:
+        if line_conversation_storage.is_attachment_evicted(uid, attachment_id):
+            raise HTTPException(status_code=410, detail="メモリ上限を超えたため添付は破棄されました")
+        raise HTTPException(status_code=404, detail="添付が見つかりません")
+    
+    mime_type, data = attachment
+    return Response(
+        content=data,
+        media_type=mime_type,
+        headers={"Cache-Control": f"private, max-age={max(0, exp - int(time.time()))}"}
+    )
+
 @app.post("/conversations/messages")
 async def save_user_message(
     request: SaveMessageRequest, 
@@ -298,6 +418,7 @@ async def clear_user_messages(current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user['id']
         success = await line_conversation_storage.clear_user_messages(user_id)
+        chat_agent.clear_context(user_id)
         
         if success:
             return {
@@ -337,99 +458,9 @@ async def get_user_conversation_stats(current_user: dict = Depends(get_current_u
 
 # プロファイル自動更新用のヘルパー関数
 async def update_profile_from_conversation(user_id: str, profile_info: Dict[str, Any]):
-    """会話から抽出したプロファイル情報でユーザープロファイルを更新"""
+    """会話から抽出したプロファイル情報を学習キューに登録（ユーザーごとにまとめて反映）"""
     try:
-        # 現在のプロファイルを取得
-        current_profile = await profile_storage.get_user_profile(user_id)
-        if not current_profile:
-            print(f"[WARN] ユーザー {user_id} のプロファイルが見つかりません")
-            return
-        
-        # 更新データを構築
-        update_data = {}
-        
-        # 既存の値と比較して新しい情報のみ追加
-        if profile_info.get("dietary_restrictions"):
-            existing = set(current_profile.dietary_restrictions or [])
-            new_restrictions = set(profile_info["dietary_restrictions"])
-            if not new_restrictions.issubset(existing):
-                update_data["dietary_restrictions"] = list(existing | new_restrictions)
-        
-        if profile_info.get("allergies"):
-            existing = set(current_profile.allergies or [])
-            new_allergies = set(profile_info["allergies"])
-            if not new_allergies.issubset(existing):
-                update_data["allergies"] = list(existing | new_allergies)
-        
-        if profile_info.get("cooking_skill_level") and profile_info["cooking_skill_level"] != current_profile.cooking_skill_level:
-            update_data["cooking_skill_level"] = profile_info["cooking_skill_level"]
-        
-        if profile_info.get("available_cooking_time") and profile_info["available_cooking_time"] != current_profile.available_cooking_time:
-            update_data["available_cooking_time"] = profile_info["available_cooking_time"]
-        
-        if profile_info.get("preferred_cuisines"):
-            existing = set(current_profile.preferred_cuisines or [])
-            new_cuisines = set(profile_info["preferred_cuisines"])
-            if not new_cuisines.issubset(existing):
-                update_data["preferred_cuisines"] = list(existing | new_cuisines)
-        
-        if profile_info.get("family_size") and profile_info["family_size"] != current_profile.family_size:
-            update_data["family_size"] = profile_info["family_size"]
-        
-        if profile_info.get("health_goals"):
-            existing = set(current_profile.health_goals or [])
-            new_goals = set(profile_info["health_goals"])
-            if not new_goals.issubset(existing):
-                update_data["health_goals"] = list(existing | new_goals)
-        
-        if profile_info.get("disliked_ingredients"):
-            existing = set(current_profile.disliked_ingredients or [])
-            new_dislikes = set(profile_info["disliked_ingredients"])
-            if not new_dislikes.issubset(existing):
-                update_data["disliked_ingredients"] = list(existing | new_dislikes)
-        
-        # === 新しい拡張項目の更新 ===
-        
-        if profile_info.get("favorite_ingredients"):
-            existing = set(current_profile.favorite_ingredients or [])
-            new_favorites = set(profile_info["favorite_ingredients"])
-            if not new_favorites.issubset(existing):
-                update_data["favorite_ingredients"] = list(existing | new_favorites)
-        
-        if profile_info.get("preferred_cooking_methods"):
-            existing = set(current_profile.preferred_cooking_methods or [])
-            new_methods = set(profile_info["preferred_cooking_methods"])
-            if not new_methods.issubset(existing):
-                update_data["preferred_cooking_methods"] = list(existing | new_methods)
-        
-        if profile_info.get("taste_preferences"):
-            existing = set(current_profile.taste_preferences or [])
-            new_tastes = set(profile_info["taste_preferences"])
-            if not new_tastes.issubset(existing):
-                update_data["taste_preferences"] = list(existing | new_tastes)
-        
-        if profile_info.get("food_interests"):
-            existing = set(current_profile.food_interests or [])
-            new_interests = set(profile_info["food_interests"])
-            if not new_interests.issubset(existing):
-                update_data["food_interests"] = list(existing | new_interests)
-        
-        if profile_info.get("special_situations"):
-            existing = set(current_profile.special_situations or [])
-            new_situations = set(profile_info["special_situations"])
-            if not new_situations.issubset(existing):
-                update_data["special_situations"] = list(existing | new_situations)
-        
-        if profile_info.get("meal_timing") and profile_info["meal_timing"] != current_profile.meal_timing_context:
-            update_data["meal_timing_context"] = profile_info["meal_timing"]
-        
-        # 更新がある場合のみプロファイルを更新
-        if update_data:
-            from models.user_profile import UserProfileUpdate
-            profile_update = UserProfileUpdate(**update_data)
-            await profile_storage.update_user_profile(user_id, profile_update)
-            print(f"[INFO] ユーザー {user_id} のプロファイルを自動更新: {list(update_data.keys())}")
-        
+        profile_learning_queue.submit(user_id, profile_info)
     except Exception as e:
         print(f"[ERROR] プロファイル自動更新エラー: {e}")
 
@@ -439,16 +470,18 @@ async def update_profile_from_conversation(user_id: str, profile_info: Dict[str,
 async def chat_endpoint(payload: ChatMessage, current_user: dict = Depends(get_current_user)):
     try:
         user_id = current_user['id']
-        intent_result = chat_agent.analyze_user_intent(payload.message, payload.has_image)
+        intent_result = chat_agent.analyze_user_intent(payload.message, payload.has_image, user_id)
         response = chat_agent.generate_response(intent_result)
-        chat_agent.add_to_context(payload.message, response)
+        chat_agent.add_to_context(payload.message, response, user_id)
         
         # プロファイル情報を自動更新（非同期処理）
         profile_info = intent_result.get("profile_info", {})
         if profile_info and profile_info.get("confidence", 0) > 0.3:  # しきい値を下げて学習を強化
             # バックグラウンドで実行（レスポンスをブロックしない）
-            import asyncio
-            asyncio.create_task(update_profile_from_conversation(user_id, profile_info))
+            background_tasks.submit(
+                "profile_update",
+                lambda: update_profile_from_conversation(user_id, profile_info)
+            )
         
         return {
             "response": response,
@@ -623,6 +656,17 @@ async def get_admin_stats(current_user: dict = Depends(get_current_user)):
         'reset_info': reset_info
     }
 
+@app.get("/admin/stats/users")
+@require_admin()
+async def get_admin_user_stats(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """当日のユーザー別利用状況をページ単位で取得（cursorは前ページのnext_cursor）"""
+    limit = max(1, min(limit, 200))
+    return await rate_limiter.get_user_stats_page(limit, cursor)
+
 @app.post("/admin/reset-user/{user_id}")
 @require_admin()
 async def reset_user_limits(
@@ -878,6 +922,16 @@ async def chat_recipe_v2_endpoint(
 
 # レガシーエンドポイントは削除済み - ChatAgent v2に統合
 
+# シャットダウン時に未反映のデータを書き込む
+@app.on_event("shutdown")
+async def flush_pending_writes():
+    # キューに残ったバックグラウンド処理を先に完了させてから、各バッファを書き出す
+    await background_tasks.drain()
+    await rate_limiter.flush_local_counts()
+    await line_conversation_storage.flush_all()
+    await profile_learning_queue.flush_all()
+    await google_cert_cache.close()
+
 # ヘルスチェック
 @app.get("/health")
 async def health_check():
@@ -887,7 +941,15 @@ async def health_check():
         "version": "1.0.0",
         "timestamp": rate_limiter._get_jst_now().isoformat(),
         "rate_limiter_backend": rate_limiter.backend,
-        "conversation_storage_backend": line_conversation_storage.backend
+        "conversation_storage_backend": line_conversation_storage.backend,
+        "conversation_memory": line_conversation_storage.get_memory_usage(),
+        "prompt_budget": prompt_budget.get_metrics(),
+        "profile_cache": profile_storage.get_cache_stats(),
+        "recipe_constraints_cache": recipe_agent.get_constraints_cache_stats(),
+        "profile_learning": profile_learning_queue.get_metrics(),
+        "background_tasks": background_tasks.get_metrics(),
+        "google_certs": google_cert_cache.get_metrics(),
+        "providers": providers.get_metrics()
     }
 
 @app.get("/cors/debug")
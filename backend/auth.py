@@ -1,12 +1,17 @@
 import os
+import re
+import time
+import asyncio
+import hmac
+import hashlib
 import jwt
 import httpx
 from datetime import datetime, timedelta
+from typing import Dict, Optional
 from fastapi import HTTPException, Depends, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from google.auth import jwt as google_jwt
 import json
 
 # 環境変数
@@ -15,9 +20,105 @@ JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-here")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24 * 7  # 7日間
 
+# 会話の添付画像URLの署名（<img>からはAuthorizationヘッダーを送れないため、署名付き・期限付きのURLで配信する）
+ATTACHMENT_URL_SECRET = os.getenv("ATTACHMENT_URL_SECRET", JWT_SECRET_KEY)
+ATTACHMENT_URL_TTL_SECONDS = int(os.getenv("ATTACHMENT_URL_TTL_SECONDS", "3600"))
+
+# Googleの公開証明書（IDトークンの署名検証用）
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+
 # セキュリティスキーム
 security = HTTPBearer()
 
+class GoogleCertCache:
+    """Googleの公開証明書をCache-Controlのmax-age に従って保持する
+    
+    - 接続を使い回すため httpx.AsyncClient を1つだけ作る
+    - 期限が近づいたらバックグラウンドで更新し、ログイン処理は待たせない
+    - 未知のkidのトークン（鍵のローテーション直後）は1回だけ即時更新する
+    """
+    
+    def __init__(self):
+        self.DEFAULT_MAX_AGE_SECONDS = float(os.getenv('GOOGLE_CERTS_DEFAULT_MAX_AGE_SECONDS', '3600'))
+        self.REFRESH_MARGIN_SECONDS = float(os.getenv('GOOGLE_CERTS_REFRESH_MARGIN_SECONDS', '300'))
+        # 未知のkidによる即時更新の最短間隔（不正なトークンで取得を繰り返させない）
+        self.MIN_FORCED_REFRESH_SECONDS = float(os.getenv('GOOGLE_CERTS_MIN_FORCED_REFRESH_SECONDS', '60'))
+        self.certs: Dict[str, str] = {}
+        self.expires_at = 0.0
+        self.fetched_at = 0.0
+        self.client: Optional[httpx.AsyncClient] = None
+        self.refresh_task: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.metrics = {'hits': 0, 'fetches': 0, 'background_refreshes': 0, 'fetch_errors': 0}
+    
+    def _max_age(self, cache_control: str) -> float:
+        match = re.search(r'max-age=(\d+)', cache_control or '')
+        return float(match.group(1)) if match else self.DEFAULT_MAX_AGE_SECONDS
+    
+    async def refresh(self) -> Dict[str, str]:
+        """証明書を取得し直す（同時に呼ばれても取得は1回）"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        requested_at = time.monotonic()
+        async with self._lock:
+            if self.certs and self.fetched_at >= requested_at:
+                # 待っている間に他の呼び出しが更新済み
+                return self.certs
+            if self.client is None:
+                self.client = httpx.AsyncClient(timeout=10.0)
+            try:
+                response = await self.client.get(GOOGLE_CERTS_URL)
+                response.raise_for_status()
+                self.certs = response.json()
+                self.fetched_at = time.monotonic()
+                self.expires_at = self.fetched_at + self._max_age(response.headers.get('cache-control'))
+                self.metrics['fetches'] += 1
+            except Exception as e:
+                self.metrics['fetch_errors'] += 1
+                print(f"[WARN] Google証明書の取得に失敗しました: {e}")
+                if not self.certs:
+                    raise ValueError('Failed to fetch Google certificates')
+            return self.certs
+    
+    async def _background_refresh(self):
+        try:
+            self.metrics['background_refreshes'] += 1
+            await self.refresh()
+        except Exception:
+            pass
+        finally:
+            self.refresh_task = None
+    
+    async def get_certs(self, kid: Optional[str] = None) -> Dict[str, str]:
+        now = time.monotonic()
+        remaining = self.expires_at - now
+        if not self.certs or remaining <= 0:
+            return await self.refresh()
+        if kid and kid not in self.certs and now - self.fetched_at >= self.MIN_FORCED_REFRESH_SECONDS:
+            return await self.refresh()
+        if remaining < self.REFRESH_MARGIN_SECONDS and self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._background_refresh())
+        self.metrics['hits'] += 1
+        return self.certs
+    
+    async def close(self):
+        """HTTP接続を閉じる（シャットダウン時に呼び出す）"""
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    def get_metrics(self) -> Dict:
+        return {
+            **self.metrics,
+            'keys': len(self.certs),
+            'expires_in_seconds': max(0, int(self.expires_at - time.monotonic()))
+        }
+
+google_cert_cache = GoogleCertCache()
+
 class GoogleLoginRequest(BaseModel):
     credential: str
 
@@ -35,15 +136,21 @@ class AuthResponse(BaseModel):
 async def verify_google_token(credential: str) -> dict:
     """Googleトークンを検証してユーザー情報を取得"""
     try:
-        # Google IDトークンを検証
-        idinfo = id_token.verify_oauth2_token(
-            credential, 
-            requests.Request(), 
-            GOOGLE_CLIENT_ID
+        # 署名検証用の証明書はキャッシュから取得（未知のkidなら取得し直す）
+        try:
+            kid = jwt.get_unverified_header(credential).get('kid')
+        except jwt.PyJWTError:
+            raise ValueError('Malformed token.')
+        certs = await google_cert_cache.get_certs(kid)
+
+        # 署名・有効期限・audienceの検証はCPU処理のためスレッドプールで実行
+        idinfo = await asyncio.get_running_loop().run_in_executor(
+            None,
+            lambda: google_jwt.decode(credential, certs=certs, audience=GOOGLE_CLIENT_ID)
         )
 
         # 発行者の確認
-        if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
+        if idinfo['iss'] not in GOOGLE_ISSUERS:
             raise ValueError('Wrong issuer.')
 
         # ユーザー情報を抽出
@@ -92,6 +199,29 @@ def verify_jwt_token(token: str) -> dict:
             detail="Invalid token"
         )
 
+def _attachment_signature(user_id: str, attachment_id: str, expires: int) -> str:
+    message = f"{user_id}\n{attachment_id}\n{expires}".encode('utf-8')
+    return hmac.new(ATTACHMENT_URL_SECRET.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+def attachment_signing_window() -> int:
+    """添付URLの署名期間の番号（同じ期間内は同じURLになり、期限は期間の終わりから1TTL以上残る）"""
+    return int(time.time()) // ATTACHMENT_URL_TTL_SECONDS
+
+def sign_attachment(user_id: str, attachment_id: str) -> Dict[str, str]:
+    """添付取得URLのクエリ（uid・exp・sig）を作成
+    
+    有効期限はTTL単位で切り上げ、同じ期間内は同じURLになるようにする（ブラウザのキャッシュを効かせる）。
+    URLを含むレスポンスのETagには attachment_signing_window() を含め、期限切れのURLを304で再利用させない。
+    """
+    expires = (attachment_signing_window() + 2) * ATTACHMENT_URL_TTL_SECONDS
+    return {'uid': user_id, 'exp': str(expires), 'sig': _attachment_signature(user_id, attachment_id, expires)}
+
+def verify_attachment_signature(user_id: str, attachment_id: str, expires: int, signature: str) -> bool:
+    """添付取得URLの署名と有効期限を検証"""
+    if not user_id or expires < time.time():
+        return False
+    return hmac.compare_digest(_attachment_signature(user_id, attachment_id, expires), signature)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
     """認証が必要なエンドポイントで現在のユーザーを取得"""
     if not credentials:
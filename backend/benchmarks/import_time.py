@@ -0,0 +1,100 @@
+"""起動時（app.mainのimport）の時間・RSSと、SDKが読み込まれていないことを確認する
+
+別プロセスでimportするため、このプロセスや他の計測の影響を受けない。
+uvicornと同様にイベントループ上でimportする（conversation_storageが初期化タスクを作成するため）。
+
+    cd backend && python benchmarks/import_time.py --max-seconds 2.0 --max-rss-mb 150
+
+予算を超えた場合、またはSDKのモジュールが読み込まれていた場合は終了コード1で終了する。
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 初回利用時まで読み込まないはずのSDK（プロバイダレジストリ・LazyModule経由で読み込む）
+LAZY_SDK_MODULES = [
+    "vertexai",
+    "google.genai",
+    "google.cloud.aiplatform",
+    "google.cloud.firestore",
+    "firebase_admin",
+    "langchain",
+    "langchain_google_vertexai",
+]
+
+# 子プロセスで実行するコード（結果はRESULT_PREFIXに続けてJSONで出力）
+RESULT_PREFIX = "IMPORT_TIME_RESULT "
+CHILD_CODE = """
+import asyncio, importlib, json, resource, sys, time
+
+async def main():
+    started_at = time.perf_counter()
+    importlib.import_module(sys.argv[1])
+    seconds = time.perf_counter() - started_at
+    print(sys.argv[2] + json.dumps({
+        'seconds': seconds,
+        # Linuxではキロバイト単位
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'modules': sorted(sys.modules)
+    }))
+
+asyncio.run(main())
+"""
+
+def measure(module: str) -> dict:
+    env = dict(os.environ)
+    # 必須の環境変数はダミー値で補う（importだけなので実際には接続しない）
+    for key, value in {
+        'PROJECT_ID': 'import-time-check',
+        'LOCATION': 'asia-northeast1',
+        'TEXT_MODEL_NAME': 'gemini-2.0-flash',
+        'IMAGE_MODEL_NAME': 'gemini-2.0-flash-preview-image-generation',
+    }.items():
+        env.setdefault(key, value)
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD_CODE, module, RESULT_PREFIX],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{module} のimportに失敗しました:\n{result.stderr}")
+    # import時に作成されたバックグラウンドタスクがループ終了時に出力することがあるため、結果の行を探す
+    for line in result.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"計測結果を取得できませんでした:\n{result.stdout}")
+
+def loaded_sdk_modules(modules: list) -> list:
+    return [name for name in modules
+            if any(name == sdk or name.startswith(sdk + ".") for sdk in LAZY_SDK_MODULES)]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='app.main', help='importするモジュール')
+    parser.add_argument('--max-seconds', type=float, default=float(os.getenv('IMPORT_TIME_BUDGET_SECONDS', '2.0')))
+    parser.add_argument('--max-rss-mb', type=float, default=float(os.getenv('IMPORT_RSS_BUDGET_MB', '150')))
+    args = parser.parse_args()
+
+    stats = measure(args.module)
+    rss_mb = stats['max_rss_kb'] / 1024
+    sdk_modules = loaded_sdk_modules(stats['modules'])
+    print(f"[INFO] {args.module}: import {stats['seconds']:.3f}秒 (予算 {args.max_seconds}秒), "
+          f"RSS {rss_mb:.1f}MB (予算 {args.max_rss_mb}MB), モジュール数 {len(stats['modules'])}")
+
+    failed = False
+    if sdk_modules:
+        print(f"[ERROR] import時にSDKが読み込まれています: {', '.join(sdk_modules[:20])}")
+        failed = True
+    if stats['seconds'] > args.max_seconds:
+        print(f"[ERROR] import時間が予算を超えています: {stats['seconds']:.3f}秒 > {args.max_seconds}秒")
+        failed = True
+    if rss_mb > args.max_rss_mb:
+        print(f"[ERROR] RSSが予算を超えています: {rss_mb:.1f}MB > {args.max_rss_mb}MB")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
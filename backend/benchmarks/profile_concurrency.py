@@ -0,0 +1,85 @@
+"""プロファイルの同時読み取り中にイベントループが止まらないことを確認する
+
+N件のプロファイルを作成してキャッシュを空にし、N件の get_user_profile を同時に実行する。
+その間、1ミリ秒ごとに起きるタスクでイベントループの遅延を測る。
+同期クライアントのようにネットワーク待ちでループを止めると、遅延が往復時間分に伸びる。
+
+Firestoreエミュレータに対して実行する（本番のプロジェクトには書き込まない）:
+
+    gcloud emulators firestore start --host-port=localhost:8080
+    cd backend && FIRESTORE_EMULATOR_HOST=localhost:8080 GOOGLE_CLOUD_PROJECT=dinnercam-bench \\
+        python benchmarks/profile_concurrency.py --concurrency 200 --max-lag-ms 50
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.profile_storage import profile_storage
+
+USER_ID_PREFIX = "benchmark-profile-"
+
+async def measure_loop_lag(lags: list, interval: float = 0.001):
+    """interval ごとに起き、予定より遅れた時間を記録する"""
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started_at - interval)
+
+def percentile(values: list, ratio: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+async def run(concurrency: int) -> dict:
+    user_ids = [f"{USER_ID_PREFIX}{i}" for i in range(concurrency)]
+    for user_id in user_ids:
+        if await profile_storage.get_user_profile(user_id) is None:
+            await profile_storage.create_user_profile(user_id, {'display_name': user_id})
+    # キャッシュに当たらないよう、すべてFirestoreから読ませる
+    for user_id in user_ids:
+        profile_storage._invalidate_cached_profile(user_id)
+
+    lags = []
+    ticker = asyncio.create_task(measure_loop_lag(lags))
+    await asyncio.sleep(0.01)
+    started_at = time.perf_counter()
+    profiles = await asyncio.gather(*[profile_storage.get_user_profile(user_id) for user_id in user_ids])
+    seconds = time.perf_counter() - started_at
+    ticker.cancel()
+
+    return {
+        'seconds': seconds,
+        'found': sum(1 for profile in profiles if profile is not None),
+        'max_lag_ms': max(lags) * 1000 if lags else 0.0,
+        'p99_lag_ms': percentile(lags, 0.99) * 1000 if lags else 0.0,
+        'ticks': len(lags)
+    }
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--max-lag-ms', type=float, default=50.0, help='イベントループ遅延の上限（超えたら終了コード1）')
+    args = parser.parse_args()
+
+    if profile_storage.backend == "firestore" and not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        print("[ERROR] FIRESTORE_EMULATOR_HOST を設定してエミュレータに対して実行してください")
+        return 1
+
+    stats = asyncio.run(run(args.concurrency))
+    print(f"[INFO] {args.concurrency}件の同時読み取り: {stats['seconds']:.3f}秒 (取得 {stats['found']}件), "
+          f"ループ遅延 最大 {stats['max_lag_ms']:.1f}ms / p99 {stats['p99_lag_ms']:.1f}ms ({stats['ticks']}回計測), "
+          f"backend={profile_storage.backend}")
+
+    if stats['found'] != args.concurrency:
+        print(f"[ERROR] 取得できなかったプロファイルがあります: {args.concurrency - stats['found']}件")
+        return 1
+    if stats['max_lag_ms'] > args.max_lag_ms:
+        print(f"[ERROR] イベントループの遅延が上限を超えています: {stats['max_lag_ms']:.1f}ms > {args.max_lag_ms}ms")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
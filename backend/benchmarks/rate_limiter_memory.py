@@ -0,0 +1,92 @@
+"""メモリモードのレート制限カウンタのメモリ使用量を計測する
+
+異なるユーザーIDで1回ずつ reserve し、tracemallocで確保量を測る。
+比較のため、以前の構成（ユーザーごとのdictを持つdefaultdict）の確保量も測る。
+日付の切り替え（JSTの0時）でカウンタがまとめて解放されることも確認する。
+
+    cd backend && python benchmarks/rate_limiter_memory.py --users 1000000 --max-mb 200
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Firestore・SQLiteの設定があってもメモリモードで計測する
+os.environ.pop('GOOGLE_SERVICE_ACCOUNT_KEY', None)
+os.environ['STORAGE_BACKEND'] = 'memory'
+
+from rate_limiter import RateLimiter
+
+def user_ids(count: int):
+    # GoogleのユーザーID（sub）と同じ21桁の数字
+    return (str(100000000000000000000 + i) for i in range(count))
+
+async def measure_current(count: int) -> dict:
+    limiter = RateLimiter()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    for user_id in user_ids(count):
+        await limiter.reserve(user_id)
+    seconds = time.perf_counter() - started_at
+    allocated, _ = tracemalloc.get_traced_memory()
+
+    # 日付が変わったことにして、次の参照でカウンタがまとめて破棄されることを確認
+    limiter._memory_date = None
+    await limiter.check_limits('100000000000000000000')
+    after_rollover, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'allocated': allocated,
+        'after_rollover': after_rollover,
+        'seconds': seconds,
+        'entries_after_rollover': len(limiter.daily_counts)
+    }
+
+def measure_legacy(count: int) -> int:
+    """以前の構成（日付・カウントを持つdictをユーザーごとに保持）"""
+    tracemalloc.start()
+    daily_counts = defaultdict(lambda: {
+        'date': None,
+        'total_requests': 0,
+        'image_generation_requests': 0
+    })
+    today = '2026-01-01'
+    for user_id in user_ids(count):
+        user_data = daily_counts[user_id]
+        user_data['date'] = today
+        user_data['total_requests'] += 1
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del daily_counts
+    return allocated
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--max-mb', type=float, default=None, help='現在の構成の確保量の上限（超えたら終了コード1）')
+    parser.add_argument('--skip-legacy', action='store_true', help='以前の構成の計測を省略')
+    args = parser.parse_args()
+
+    mb = 1024 * 1024
+    current = asyncio.run(measure_current(args.users))
+    print(f"[INFO] 現在の構成: {args.users}ユーザーで {current['allocated'] / mb:.1f}MB "
+          f"({current['allocated'] / args.users:.0f}バイト/ユーザー, reserve {current['seconds']:.2f}秒)")
+    print(f"[INFO] 日付切り替え後: {current['after_rollover'] / mb:.1f}MB (エントリ数 {current['entries_after_rollover']})")
+    if not args.skip_legacy:
+        legacy = measure_legacy(args.users)
+        print(f"[INFO] 以前の構成: {legacy / mb:.1f}MB ({legacy / args.users:.0f}バイト/ユーザー)")
+
+    if args.max_mb is not None and current['allocated'] / mb > args.max_mb:
+        print(f"[ERROR] 確保量が上限を超えています: {current['allocated'] / mb:.1f}MB > {args.max_mb}MB")
+        return 1
+    if current['entries_after_rollover'] != 0:
+        print(f"[ERROR] 日付切り替え後もカウンタが残っています: {current['entries_after_rollover']}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,16 +3,68 @@ import json
 import base64
 import uuid
 import asyncio
+import hashlib
+import re
+import gzip
+from collections import OrderedDict, deque
 from datetime import datetime, timezone, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
+from services.sqlite_storage import sqlite_enabled, get_sqlite_store, to_json
+from agents.providers import LazyModule, module_available
 
-# Firebase Firestoreのインポート（エラー時はメモリモード）
-try:
-    import firebase_admin
-    from firebase_admin import credentials, firestore
-    FIREBASE_AVAILABLE = True
-except ImportError:
-    FIREBASE_AVAILABLE = False
+# Firebase Firestore（未インストール時はメモリモード）。起動を速くするため初回利用時に読み込む
+firebase_admin = LazyModule("firebase_admin")
+credentials = LazyModule("firebase_admin.credentials")
+firestore = LazyModule("firebase_admin.firestore")
+FIREBASE_AVAILABLE = module_available("firebase_admin")
+
+# メッセージ内の画像は添付ストアに保存し、この形式の参照に置き換える
+ATTACHMENT_PREFIX = "attachment://"
+# 取得用URL（署名付き）が再送された場合に添付IDを取り出すパターン
+ATTACHMENT_URL_PATTERN = re.compile(r"/conversations/attachments/([0-9a-f]{64})(?:\?|$)")
+# Firestoreの1ドキュメント上限（1MB）に収まるよう分割するサイズ
+ATTACHMENT_CHUNK_SIZE = 900_000
+
+# SQLiteモードのテーブル（メッセージはユーザーごとの連番で並べる）
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT PRIMARY KEY,
+    generation TEXT NOT NULL,
+    next_seq INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    user_message_count INTEGER NOT NULL DEFAULT 0,
+    bot_message_count INTEGER NOT NULL DEFAULT 0,
+    first_message_time TEXT,
+    last_message_time TEXT
+);
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    user_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message_id TEXT,
+    type TEXT,
+    timestamp TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_conversation_messages_id ON conversation_messages (user_id, message_id);
+CREATE TABLE IF NOT EXISTS conversation_attachments (
+    user_id TEXT NOT NULL,
+    attachment_id TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, attachment_id)
+) WITHOUT ROWID;
+"""
+
+# 集計カラム追加前に作成されたconversationsテーブルに追加するカラム（追加時に既存の履歴から一度だけ集計）
+SQLITE_STATS_COLUMNS = [
+    ("message_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("user_message_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("bot_message_count", "INTEGER NOT NULL DEFAULT 0"),
+    ("first_message_time", "TEXT"),
+    ("last_message_time", "TEXT"),
+]
 
 class LineStyleConversationStorage:
     def __init__(self):
@@ -21,12 +73,44 @@ class LineStyleConversationStorage:
         self.backend = "memory"
         self.firebase_initialized = False
         self.user_messages = {}  # メモリフォールバック用
+        self.migrated_users = set()  # 旧形式からの移行確認済みユーザー
+        self.user_stats = {}  # メモリモード用の会話統計
+        self.attachments = {}  # メモリモード用の添付ストア（(user_id, attachment_id) -> (mime_type, base64)）
+        self.known_attachments = set()  # 保存済みを確認した (user_id, attachment_id)
+        
+        # 書き込みバッファ（ユーザーごとに短時間まとめてWriteBatchで反映）
+        self.WRITE_BEHIND_SECONDS = float(os.getenv('CONVERSATION_WRITE_BEHIND_SECONDS', '0.5'))
+        self.pending_messages: Dict[str, List[Dict]] = {}
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
+        
+        # 圧縮チャンク形式（古いメッセージをN件ずつgzipでまとめ、直近の分は非圧縮のまま残す）
+        self.COMPRESSION_ENABLED = os.getenv('CONVERSATION_COMPRESSION_ENABLED', 'false').lower() == 'true'
+        self.CHUNK_MESSAGES = int(os.getenv('CONVERSATION_CHUNK_MESSAGES', '50'))
+        self.UNCOMPRESSED_TAIL = int(os.getenv('CONVERSATION_UNCOMPRESSED_TAIL', '100'))
+        
+        # メモリモードのバイト予算（超過時はユーザー単位で古い順に切り詰め、全体ではLRUで退避）
+        self.MEMORY_USER_BUDGET_BYTES = int(os.getenv('CONVERSATION_MEMORY_USER_BUDGET_BYTES', str(2 * 1024 * 1024)))
+        self.MEMORY_TOTAL_BUDGET_BYTES = int(os.getenv('CONVERSATION_MEMORY_BUDGET_BYTES', str(64 * 1024 * 1024)))
+        self.MEMORY_ATTACHMENT_BUDGET_BYTES = int(os.getenv('CONVERSATION_MEMORY_ATTACHMENT_BUDGET_BYTES', str(32 * 1024 * 1024)))
+        self.memory_metrics = {
+            'trimmed_messages': 0,
+            'evicted_users': 0,
+            'evicted_messages': 0,
+            'evicted_bytes': 0,
+            'evicted_attachments': 0
+        }
+        self.recent_evictions = deque(maxlen=int(os.getenv('CONVERSATION_MEMORY_EVICTION_LOG_SIZE', '100')))
+        # 予算超過で破棄した添付（取得時に404ではなく410を返すため、件数を制限して保持）
+        self.EVICTED_ATTACHMENT_KEYS_LIMIT = int(os.getenv('CONVERSATION_MEMORY_EVICTED_ATTACHMENT_KEYS', '10000'))
+        self.evicted_attachment_keys: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
         
         # 即座にメモリモードで開始（ブロッキングを避ける）
         self._init_memory()
         
+        if sqlite_enabled():
+            self._init_sqlite()
         # Firebaseは非同期で初期化を試行
-        if FIREBASE_AVAILABLE:
+        elif FIREBASE_AVAILABLE:
             # バックグラウンドでFirebase初期化を開始
             asyncio.create_task(self._async_init_firebase())
     
@@ -114,9 +198,45 @@ class LineStyleConversationStorage:
     
     def _init_memory(self):
         """メモリモードで初期化"""
-        self.user_messages = {}
+        self.user_messages = OrderedDict()  # 参照順（末尾が最新）
+        self.user_message_sizes: Dict[str, List[int]] = {}  # メッセージごとの推定バイト数
+        self.user_bytes: Dict[str, int] = {}
+        self.memory_bytes = 0
+        self.user_stats = {}
+        self.user_generations: Dict[str, str] = {}  # 履歴を作り直すたびに変わる世代（ETag用）
+        self.user_revisions: Dict[str, int] = {}  # 追記・上書きのたびに増える番号（ETag用）
+        self.attachment_bytes = 0
         self.backend = "memory"
     
+    def _init_sqlite(self):
+        """SQLiteモードで初期化（失敗時はメモリモードのまま）"""
+        try:
+            self.sqlite = get_sqlite_store()
+            self.sqlite.ensure_schema(SQLITE_SCHEMA)
+            self._sqlite_ensure_stats_columns()
+            self.backend = "sqlite"
+        except Exception as e:
+            print(f"[WARN] SQLiteの初期化に失敗したためメモリモードで起動します: {e}")
+    
+    def _sqlite_ensure_stats_columns(self):
+        """既存のconversationsテーブルに集計カラムを追加し、既存の履歴から集計する"""
+        columns = {row['name'] for row in self.sqlite.fetch_all("PRAGMA table_info(conversations)")}
+        missing = [(name, definition) for name, definition in SQLITE_STATS_COLUMNS if name not in columns]
+        if not missing:
+            return
+        with self.sqlite.transaction() as conn:
+            for name, definition in missing:
+                conn.execute(f"ALTER TABLE conversations ADD COLUMN {name} {definition}")
+            conn.execute(
+                "UPDATE conversations SET "
+                "message_count = (SELECT COUNT(*) FROM conversation_messages m WHERE m.user_id = conversations.user_id), "
+                "user_message_count = (SELECT COUNT(*) FROM conversation_messages m WHERE m.user_id = conversations.user_id AND m.type = 'user'), "
+                "bot_message_count = (SELECT COUNT(*) FROM conversation_messages m WHERE m.user_id = conversations.user_id AND m.type = 'bot'), "
+                "first_message_time = (SELECT timestamp FROM conversation_messages m WHERE m.user_id = conversations.user_id ORDER BY seq LIMIT 1), "
+                "last_message_time = (SELECT timestamp FROM conversation_messages m WHERE m.user_id = conversations.user_id ORDER BY seq DESC LIMIT 1)"
+            )
+        print(f"[INFO] 会話の集計カラムを追加しました: {', '.join(name for name, _ in missing)}")
+    
     def _get_jst_now(self) -> datetime:
         return datetime.now(self.JST)
     
@@ -133,24 +253,145 @@ class LineStyleConversationStorage:
         
         return False
     
+    def _stats_from_messages(self, messages: List[Dict]) -> Dict:
+        """メッセージ一覧から集計フィールドを計算（移行・全件保存時のみ使用）"""
+        return {
+            'message_count': len(messages),
+            'user_message_count': sum(1 for m in messages if m.get('type') == 'user'),
+            'bot_message_count': sum(1 for m in messages if m.get('type') == 'bot'),
+            'first_message_time': messages[0].get('timestamp') if messages else None,
+            'last_message_time': messages[-1].get('timestamp') if messages else None
+        }
+    
+    def _apply_stats_delta(self, stats: Dict, messages: List[Dict]):
+        """追記されたメッセージ分だけ集計を更新"""
+        if not messages:
+            return
+        stats['message_count'] += len(messages)
+        stats['user_message_count'] += sum(1 for m in messages if m.get('type') == 'user')
+        stats['bot_message_count'] += sum(1 for m in messages if m.get('type') == 'bot')
+        if stats['first_message_time'] is None:
+            stats['first_message_time'] = messages[0].get('timestamp')
+        stats['last_message_time'] = messages[-1].get('timestamp')
+    
     # === Firebase Firestore Methods ===
-    async def _firebase_get_messages(self, user_id: str) -> List[Dict]:
-        """ユーザーの全メッセージを取得"""
+    # 保存形式: user_conversations/{user_id}（メタ情報）
+    #           user_conversations/{user_id}/messages/{message_id}（1メッセージ1ドキュメント）
+    #           user_conversations/{user_id}/chunks/{seq}（圧縮モード時、古いメッセージをまとめたgzipブロック）
+    def _conversation_ref(self, user_id: str):
+        return self.db.collection('user_conversations').document(user_id)
+    
+    def _messages_ref(self, user_id: str):
+        return self._conversation_ref(user_id).collection('messages')
+    
+    def _chunks_ref(self, user_id: str):
+        return self._conversation_ref(user_id).collection('chunks')
+    
+    def _message_doc_id(self, message: Dict) -> str:
+        # FirestoreのドキュメントIDに'/'は使えない
+        return str(message.get('id') or uuid.uuid4().hex).replace('/', '_')
+    
+    def _dedupe_messages(self, messages: List[Dict]) -> List[Dict]:
+        """同じIDのメッセージは最初の位置に最後の内容を残す（IDで上書き保存した結果と同じ並びにする）"""
+        latest: Dict[Any, Dict] = {}
+        for index, message in enumerate(messages):
+            latest[message.get('id') or ('', index)] = message
+        return list(latest.values())
+    
+    def _ensure_migrated(self, user_id: str):
+        """messages配列で保存された旧形式のドキュメントをサブコレクションに移行
+        
+        ドキュメントIDは配列内の位置から決めるため、再試行や他インスタンスとの同時実行でも同じドキュメントに書き込まれる。
+        集計と移行済みの印はトランザクションで1回だけ反映する。
+        """
+        if user_id in self.migrated_users:
+            return
+        
+        doc_ref = self._conversation_ref(user_id)
+        doc = doc_ref.get()
+        legacy_messages = doc.to_dict().get('messages') if doc.exists else None
+        
+        if legacy_messages:
+            messages_ref = self._messages_ref(user_id)
+            seen_ids = set()
+            # バッチ上限（500件）を超えないよう分割して書き込む
+            for i in range(0, len(legacy_messages), 400):
+                batch = self.db.batch()
+                for index, message in enumerate(legacy_messages[i:i + 400], start=i):
+                    doc_id = self._message_doc_id(message) if message.get('id') else f"legacy-{index}"
+                    while doc_id in seen_ids:
+                        doc_id = f"{doc_id}-{index}"
+                    seen_ids.add(doc_id)
+                    # IDが重複していたメッセージは付け直したIDで保存し、カーソルが一意に決まるようにする
+                    migrated = {**message, 'timestamp': message.get('timestamp') or ''}
+                    if doc_id != self._message_doc_id(message):
+                        migrated['id'] = doc_id
+                    batch.set(messages_ref.document(doc_id), migrated)
+                batch.commit()
+            
+            @firestore.transactional
+            def finish_migration(transaction, doc_ref):
+                snapshot = doc_ref.get(transaction=transaction)
+                if not (snapshot.exists and snapshot.to_dict().get('messages')):
+                    # 他のインスタンスが移行を完了済み（以降の追記で増えた集計を上書きしない）
+                    return False
+                transaction.update(doc_ref, {
+                    **self._stats_from_messages(legacy_messages),
+                    'messages': firestore.DELETE_FIELD,
+                    'migrated_at': firestore.SERVER_TIMESTAMP
+                })
+                return True
+            
+            if finish_migration(self.db.transaction(), doc_ref):
+                print(f"[INFO] 会話履歴をサブコレクション形式に移行: {user_id} ({len(legacy_messages)}件)")
+        
+        self.migrated_users.add(user_id)
+    
+    def _delete_all_message_docs(self, user_id: str):
+        refs = [doc.reference for doc in self._messages_ref(user_id).stream()]
+        refs += [doc.reference for doc in self._chunks_ref(user_id).stream()]
+        for i in range(0, len(refs), 400):
+            batch = self.db.batch()
+            for ref in refs[i:i + 400]:
+                batch.delete(ref)
+            batch.commit()
+    
+    async def _firebase_get_messages(self, user_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """ユーザーのメッセージを取得（limit指定時は新しい順にlimit件、古い順に並べて返す）"""
         try:
             if not await self._ensure_firebase_ready():
-                return await self._memory_get_messages(user_id)
+                return await self._memory_get_messages(user_id, limit, before)
             
-            doc_ref = self.db.collection('user_conversations').document(user_id)
-            doc = doc_ref.get()
+            # 同一インスタンス内で書いた内容を必ず読めるよう、先にバッファを反映
+            await self._flush_pending_messages(user_id)
+            self._ensure_migrated(user_id)
+            messages_ref = self._messages_ref(user_id)
             
-            if doc.exists:
-                data = doc.to_dict()
-                messages = data.get('messages', [])
-                return messages
-            else:
-                return []
+            if limit is None and before is None:
+                docs = messages_ref.order_by('timestamp').stream()
+                return self._read_chunk_messages(user_id) + [doc.to_dict() for doc in docs]
+            
+            if before:
+                cursor_doc = messages_ref.document(before.replace('/', '_')).get()
+                if not cursor_doc.exists:
+                    # カーソルが圧縮済みの範囲にある場合はチャンクから読む
+                    return self._read_chunk_messages(user_id, limit, before)
+            
+            query = messages_ref.order_by('timestamp', direction=firestore.Query.DESCENDING)
+            if before:
+                query = query.start_after(cursor_doc)
+            if limit is not None:
+                query = query.limit(limit)
+            
+            messages = [doc.to_dict() for doc in query.stream()]
+            messages.reverse()
+            if limit is None or len(messages) < limit:
+                # 非圧縮の範囲で足りない分は圧縮チャンクから補う
+                remaining = None if limit is None else limit - len(messages)
+                messages = self._read_chunk_messages(user_id, remaining) + messages
+            return messages
         except Exception as e:
-            return await self._memory_get_messages(user_id)
+            return await self._memory_get_messages(user_id, limit, before)
     
     async def _firebase_save_messages(self, user_id: str, messages: List[Dict]) -> bool:
         """ユーザーの全メッセージを保存"""
@@ -158,144 +399,907 @@ class LineStyleConversationStorage:
             if not await self._ensure_firebase_ready():
                 return await self._memory_save_messages(user_id, messages)
             
-            doc_ref = self.db.collection('user_conversations').document(user_id)
+            self._discard_pending_messages(user_id)
+            self._ensure_migrated(user_id)
+            self._delete_all_message_docs(user_id)
+            
+            messages_ref = self._messages_ref(user_id)
+            for i in range(0, len(messages), 400):
+                batch = self.db.batch()
+                for message in messages[i:i + 400]:
+                    batch.set(messages_ref.document(self._message_doc_id(message)), message)
+                batch.commit()
             
-            doc_ref.set({
+            self._conversation_ref(user_id).set({
+                **self._stats_from_messages(messages),
+                'compressed_message_count': 0,
+                'chunk_seq': 0,
+                'next_compaction_count': 0,
+                'compacted_until': None,
+                'generation': uuid.uuid4().hex[:12],
                 'user_id': user_id,
-                'messages': messages,
-                'message_count': len(messages),
                 'updated_at': firestore.SERVER_TIMESTAMP,
                 'last_message_at': firestore.SERVER_TIMESTAMP if messages else None
             }, merge=True)
+            self._compact_messages(user_id, {'message_count': len(messages)})
             
             return True
         except Exception as e:
             return await self._memory_save_messages(user_id, messages)
     
-    async def _firebase_add_message(self, user_id: str, message: Dict) -> bool:
-        """新しいメッセージを追加"""
+    def _firebase_write_messages(self, user_id: str, messages: List[Dict]):
+        """メッセージ群とメタ情報の更新を1つのトランザクションで書き込む
+        
+        同じIDのメッセージ（ストリーミング中の更新の再送など）は最後の内容だけを書き、
+        集計は新しく作られたメッセージの分だけ増やす。
+        """
+        self._ensure_migrated(user_id)
+        doc_ref = self._conversation_ref(user_id)
+        messages_ref = self._messages_ref(user_id)
+        latest: Dict[str, Dict] = {}
+        for message in messages:
+            latest[self._message_doc_id(message)] = message
+        items = list(latest.items())
+        
+        @firestore.transactional
+        def write_messages(transaction, items):
+            refs = [messages_ref.document(doc_id) for doc_id, _ in items]
+            # メタ情報も同じ読み取りで取得する（get_allの結果は順不同なのでパスで引く）
+            snapshots = {snapshot.reference.path: snapshot for snapshot in transaction.get_all([doc_ref] + refs)}
+            parent = snapshots.get(doc_ref.path)
+            data = parent.to_dict() if parent is not None and parent.exists else {}
+            existing = {ref.id for ref in refs if ref.path in snapshots and snapshots[ref.path].exists}
+            created = [message for doc_id, message in items if doc_id not in existing]
+            for ref, (_, message) in zip(refs, items):
+                transaction.set(ref, message)
+            # 会話統計もメッセージと同じトランザクションでアトミックに更新（revisionは上書きでも進める）
+            stats = {
+                'user_id': user_id,
+                'message_count': firestore.Increment(len(created)),
+                'user_message_count': firestore.Increment(sum(1 for m in created if m.get('type') == 'user')),
+                'bot_message_count': firestore.Increment(sum(1 for m in created if m.get('type') == 'bot')),
+                'revision': firestore.Increment(1),
+                'updated_at': firestore.SERVER_TIMESTAMP,
+                'last_message_at': firestore.SERVER_TIMESTAMP
+            }
+            if created and (created[-1].get('timestamp') or '') >= (data.get('last_message_time') or ''):
+                stats['last_message_time'] = created[-1].get('timestamp')
+            transaction.set(doc_ref, stats, merge=True)
+            return {**data, 'message_count': data.get('message_count', 0) + len(created)}, created
+        
+        data, created = {}, []
+        for i in range(0, len(items), 400):
+            data, chunk_created = write_messages(self.db.transaction(), items[i:i + 400])
+            created += chunk_created
+        
+        # 圧縮済みの範囲のメッセージが再送された場合は、チャンク側に反映して重複を残さない
+        compacted_until = data.get('compacted_until')
+        if compacted_until and any((message.get('timestamp') or '') <= compacted_until for message in created):
+            refs = [messages_ref.document(self._message_doc_id(message)) for message in created if (message.get('timestamp') or '') <= compacted_until]
+            self._fold_into_chunks(user_id, [snapshot for snapshot in self.db.get_all(refs) if snapshot.exists])
+        self._compact_messages(user_id, data)
+    
+    # === Compressed Chunks ===
+    def _encode_chunk(self, messages: List[Dict]) -> bytes:
+        return gzip.compress(json.dumps(messages, ensure_ascii=False, default=str).encode('utf-8'))
+    
+    def _decode_chunk(self, data: Dict) -> List[Dict]:
+        return json.loads(gzip.decompress(data['data']).decode('utf-8'))
+    
+    def _compact_messages(self, user_id: str, data: Dict):
+        """非圧縮のメッセージが直近分を超えたら、古い方からN件ずつ圧縮チャンクにまとめる
+        
+        data: 書き込み後のメタ情報。集計値は圧縮を試すかどうかの目安にだけ使い、
+        直近 UNCOMPRESSED_TAIL 件（ストリーミング中のメッセージを含む）は実際のドキュメントから数えて除外する。
+        """
+        if not self.COMPRESSION_ENABLED or self.CHUNK_MESSAGES <= 0:
+            return
+        message_count = data.get('message_count', 0)
+        if message_count - data.get('compressed_message_count', 0) < self.UNCOMPRESSED_TAIL + self.CHUNK_MESSAGES:
+            return
+        if message_count < data.get('next_compaction_count', 0):
+            return
         try:
-            if not await self._ensure_firebase_ready():
-                return await self._memory_add_message(user_id, message)
+            doc_ref = self._conversation_ref(user_id)
+            messages_ref = self._messages_ref(user_id)
+            seq = data.get('chunk_seq', 0)
+            compacted = False
             
-            doc_ref = self.db.collection('user_conversations').document(user_id)
-            
-            # Firebase Firestoreのトランザクション
-            @firestore.transactional
-            def add_message_transaction(transaction, doc_ref, message):
-                doc = doc_ref.get(transaction=transaction)
-                
-                if doc.exists:
-                    data = doc.to_dict()
-                    messages = data.get('messages', [])
-                else:
-                    messages = []
+            while True:
+                # 新しい順に直近分を読み飛ばした先頭が、圧縮してよい最も新しいメッセージ
+                boundary = list(messages_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).offset(self.UNCOMPRESSED_TAIL).limit(1).stream())
+                if not boundary:
+                    break
+                docs = list(messages_ref.order_by('timestamp').end_at(boundary[0]).limit(self.CHUNK_MESSAGES).stream())
+                if len(docs) < self.CHUNK_MESSAGES:
+                    break
                 
-                messages.append(message)
+                # 既にチャンクにあるIDは二重に圧縮せず、チャンク側に反映する
+                folded = self._fold_into_chunks(user_id, docs)
+                docs = [doc for doc in docs if doc.id not in folded]
+                if not docs:
+                    continue
+                messages = [doc.to_dict() for doc in docs]
+                encoded = self._encode_chunk(messages)
+                # ドキュメント上限を超える場合は件数を減らしてまとめる
+                while len(encoded) > ATTACHMENT_CHUNK_SIZE and len(docs) > 1:
+                    docs = docs[:len(docs) // 2]
+                    messages = messages[:len(docs)]
+                    encoded = self._encode_chunk(messages)
                 
-                transaction.set(doc_ref, {
-                    'user_id': user_id,
-                    'messages': messages,
-                    'message_count': len(messages),
-                    'updated_at': firestore.SERVER_TIMESTAMP,
-                    'last_message_at': firestore.SERVER_TIMESTAMP
+                batch = self.db.batch()
+                batch.create(self._chunks_ref(user_id).document(f"{seq:08d}"), {
+                    'seq': seq,
+                    'codec': 'gzip',
+                    'data': encoded,
+                    'count': len(messages),
+                    'message_ids': [doc.id for doc in docs],
+                    'first_timestamp': messages[0].get('timestamp'),
+                    'last_timestamp': messages[-1].get('timestamp'),
+                    'created_at': firestore.SERVER_TIMESTAMP
+                })
+                for doc in docs:
+                    batch.delete(doc.reference)
+                batch.set(doc_ref, {
+                    'compressed_message_count': firestore.Increment(len(docs)),
+                    'chunk_seq': seq + 1,
+                    'compacted_until': messages[-1].get('timestamp')
                 }, merge=True)
+                batch.commit()
+                
+                seq += 1
+                compacted = True
             
-            transaction = self.db.transaction()
-            add_message_transaction(transaction, doc_ref, message)
+            if not compacted:
+                # 集計値と実際の件数がずれている場合、次のチャンク分が追記されるまでは確認しない
+                doc_ref.set({'next_compaction_count': message_count + self.CHUNK_MESSAGES}, merge=True)
+        except Exception as e:
+            # 圧縮は最適化なので、失敗しても非圧縮のまま読み書きできる
+            print(f"[WARN] 会話履歴の圧縮に失敗しました: {user_id}: {e}")
+    
+    def _fold_into_chunks(self, user_id: str, docs: List) -> set:
+        """圧縮後に同じIDで再送されたメッセージをチャンク内の内容に上書きし、非圧縮のドキュメントを削除する
+        
+        反映したIDを返す。再送時に新規として数えた分は集計から差し引く。
+        """
+        doc_by_id = {doc.id: doc for doc in docs}
+        ids = list(doc_by_id)
+        chunk_docs = {}
+        # array_contains_any は1回30件まで
+        for i in range(0, len(ids), 30):
+            for chunk_doc in self._chunks_ref(user_id).where('message_ids', 'array_contains_any', ids[i:i + 30]).stream():
+                chunk_docs[chunk_doc.id] = chunk_doc
+        if not chunk_docs:
+            return set()
+        
+        folded = set()
+        batch = self.db.batch()
+        for chunk_doc in chunk_docs.values():
+            data = chunk_doc.to_dict()
+            messages = self._decode_chunk(data)
+            for index, message_id in enumerate(data.get('message_ids', [])):
+                doc = doc_by_id.get(message_id)
+                if doc is not None and message_id not in folded:
+                    messages[index] = doc.to_dict()
+                    folded.add(message_id)
+                    batch.delete(doc.reference)
+            batch.update(chunk_doc.reference, {'data': self._encode_chunk(messages)})
+        
+        folded_messages = [doc_by_id[message_id].to_dict() for message_id in folded]
+        batch.set(self._conversation_ref(user_id), {
+            'message_count': firestore.Increment(-len(folded)),
+            'user_message_count': firestore.Increment(-sum(1 for m in folded_messages if m.get('type') == 'user')),
+            'bot_message_count': firestore.Increment(-sum(1 for m in folded_messages if m.get('type') == 'bot'))
+        }, merge=True)
+        batch.commit()
+        print(f"[INFO] 圧縮済みメッセージの更新をチャンクに反映: {user_id} ({len(folded)}件)")
+        return folded
+    
+    def _read_chunk_messages(self, user_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """圧縮チャンクから新しい方へ遡ってメッセージを復元（古い順で返す）"""
+        if limit is not None and limit <= 0:
+            return []
+        
+        chunks_ref = self._chunks_ref(user_id)
+        query = chunks_ref.order_by('seq', direction=firestore.Query.DESCENDING)
+        if before:
+            doc_id = before.replace('/', '_')
+            found = list(chunks_ref.where('message_ids', 'array_contains', doc_id).limit(1).stream())
+            if not found:
+                return []
+            query = chunks_ref.where('seq', '<=', found[0].to_dict()['seq']).order_by('seq', direction=firestore.Query.DESCENDING)
+        
+        messages: List[Dict] = []
+        for doc in query.stream():
+            data = doc.to_dict()
+            chunk = self._decode_chunk(data)
+            if before and doc_id in data.get('message_ids', []):
+                chunk = chunk[:data['message_ids'].index(doc_id)]
+            messages = chunk + messages
+            if limit is not None and len(messages) >= limit:
+                break
+        
+        if limit is not None:
+            messages = messages[-limit:]
+        return messages
+    
+    async def _firebase_add_message(self, user_id: str, message: Dict) -> bool:
+        """新しいメッセージを追加（書き込みは短時間バッファしてまとめて反映）"""
+        try:
+            if not await self._ensure_firebase_ready():
+                return await self._memory_add_message(user_id, message)
+            
+            if self.WRITE_BEHIND_SECONDS <= 0:
+                self._firebase_write_messages(user_id, [message])
+                return True
             
+            self.pending_messages.setdefault(user_id, []).append(message)
+            if user_id not in self.flush_tasks:
+                self.flush_tasks[user_id] = asyncio.create_task(self._delayed_flush(user_id))
             return True
         except Exception as e:
             return await self._memory_add_message(user_id, message)
     
+    async def _delayed_flush(self, user_id: str):
+        try:
+            await asyncio.sleep(self.WRITE_BEHIND_SECONDS)
+        except asyncio.CancelledError:
+            return
+        self.flush_tasks.pop(user_id, None)
+        await self._flush_pending_messages(user_id)
+    
+    async def _flush_pending_messages(self, user_id: str):
+        """バッファ済みのメッセージをFirestoreに書き込む（失敗時はメモリに退避）"""
+        task = self.flush_tasks.pop(user_id, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        
+        messages = self.pending_messages.pop(user_id, None)
+        if not messages:
+            return
+        try:
+            self._firebase_write_messages(user_id, messages)
+        except Exception as e:
+            for message in messages:
+                await self._memory_add_message(user_id, message)
+    
+    def _discard_pending_messages(self, user_id: str):
+        task = self.flush_tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+        self.pending_messages.pop(user_id, None)
+    
+    async def flush_all(self):
+        """全ユーザーのバッファを書き込む（シャットダウン時に呼び出す）"""
+        for user_id in list(self.pending_messages.keys()):
+            await self._flush_pending_messages(user_id)
+    
+    async def _firebase_get_stats(self, user_id: str) -> Dict:
+        """会話統計を取得（メタ情報ドキュメント1件の読み取りのみ）"""
+        try:
+            if not await self._ensure_firebase_ready():
+                return await self._memory_get_stats(user_id)
+            
+            await self._flush_pending_messages(user_id)
+            self._ensure_migrated(user_id)
+            doc_ref = self._conversation_ref(user_id)
+            doc = doc_ref.get()
+            data = doc.to_dict() if doc.exists else {}
+            
+            if data.get('message_count') and 'user_message_count' not in data:
+                # 集計フィールド導入前のドキュメントは一度だけ全件から再計算
+                docs = self._messages_ref(user_id).order_by('timestamp').stream()
+                stats = self._stats_from_messages([d.to_dict() for d in docs])
+                doc_ref.set(stats, merge=True)
+                data.update(stats)
+            elif data.get('message_count') and not data.get('first_message_time'):
+                # 最初のメッセージ時刻は追記時には分からないため、初回参照時に補完
+                first = list(self._chunks_ref(user_id).order_by('seq').limit(1).stream())
+                if first:
+                    data['first_message_time'] = first[0].to_dict().get('first_timestamp')
+                else:
+                    first = list(self._messages_ref(user_id).order_by('timestamp').limit(1).stream())
+                    if first:
+                        data['first_message_time'] = first[0].to_dict().get('timestamp')
+                if data.get('first_message_time'):
+                    doc_ref.set({'first_message_time': data['first_message_time']}, merge=True)
+            
+            return {
+                'message_count': data.get('message_count', 0),
+                'user_message_count': data.get('user_message_count', 0),
+                'bot_message_count': data.get('bot_message_count', 0),
+                'first_message_time': data.get('first_message_time'),
+                'last_message_time': data.get('last_message_time')
+            }
+        except Exception as e:
+            return await self._memory_get_stats(user_id)
+    
+    async def _firebase_get_version(self, user_id: str) -> str:
+        """会話のバージョン（世代.更新番号）。追記・上書きでは番号が進み、保存・クリアでは世代が変わる"""
+        try:
+            if not await self._ensure_firebase_ready():
+                return await self._memory_get_version(user_id)
+            
+            # バッファ中のメッセージを反映してから読み、返す内容とバージョンを一致させる
+            await self._flush_pending_messages(user_id)
+            self._ensure_migrated(user_id)
+            doc = self._conversation_ref(user_id).get()
+            data = doc.to_dict() if doc.exists else {}
+            return f"{data.get('generation', '0')}.{data.get('revision', 0)}"
+        except Exception as e:
+            return await self._memory_get_version(user_id)
+    
+    async def _firebase_get_messages_since(self, user_id: str, since: str, limit: Optional[int] = None) -> List[Dict]:
+        """指定したメッセージID（またはタイムスタンプ）より新しいメッセージを古い順に取得"""
+        try:
+            if not await self._ensure_firebase_ready():
+                return await self._memory_get_messages_since(user_id, since, limit)
+            
+            await self._flush_pending_messages(user_id)
+            self._ensure_migrated(user_id)
+            messages_ref = self._messages_ref(user_id)
+            
+            query = messages_ref.order_by('timestamp')
+            cursor_doc = messages_ref.document(since.replace('/', '_')).get()
+            if cursor_doc.exists:
+                query = query.start_after(cursor_doc)
+            elif list(self._chunks_ref(user_id).where('message_ids', 'array_contains', since.replace('/', '_')).limit(1).stream()):
+                # 圧縮済みの古いメッセージ以降を求められた場合は全件から切り出す
+                messages = self._read_chunk_messages(user_id) + [doc.to_dict() for doc in query.stream()]
+                index = next(i for i, m in enumerate(messages) if self._message_doc_id(m) == since.replace('/', '_'))
+                messages = messages[index + 1:]
+                return messages[:limit] if limit is not None else messages
+            else:
+                query = query.where('timestamp', '>', since)
+                # タイムスタンプ指定では、圧縮チャンクに入った新しいメッセージも含める（チャンクは古い順に並ぶ）
+                chunks = self._chunks_ref(user_id).where('last_timestamp', '>', since).order_by('last_timestamp').stream()
+                chunked = [m for doc in chunks for m in self._decode_chunk(doc.to_dict()) if (m.get('timestamp') or '') > since]
+                if chunked:
+                    if limit is not None and len(chunked) >= limit:
+                        return chunked[:limit]
+                    if limit is not None:
+                        query = query.limit(limit - len(chunked))
+                    return chunked + [doc.to_dict() for doc in query.stream()]
+            if limit is not None:
+                query = query.limit(limit)
+            return [doc.to_dict() for doc in query.stream()]
+        except Exception as e:
+            return await self._memory_get_messages_since(user_id, since, limit)
+    
     async def _firebase_clear_messages(self, user_id: str) -> bool:
-        """ユーザーの全メッセージをクリア"""
+        """ユーザーの全メッセージと添付をクリア"""
         try:
             if not await self._ensure_firebase_ready():
                 return await self._memory_clear_messages(user_id)
             
-            doc_ref = self.db.collection('user_conversations').document(user_id)
-            doc_ref.delete()
+            self._discard_pending_messages(user_id)
+            self._delete_all_message_docs(user_id)
+            self._delete_attachment_docs(user_id)
+            # 世代を更新して、クリア前のETagが一致しないようにする
+            self._conversation_ref(user_id).set({
+                'user_id': user_id,
+                'generation': uuid.uuid4().hex[:12],
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+            self.migrated_users.add(user_id)
             return True
         except Exception as e:
             return await self._memory_clear_messages(user_id)
     
+    # === Attachments ===
+    def _parse_data_url(self, value: Any) -> Optional[Tuple[str, str]]:
+        """data:<mime>;base64,<data> 形式なら (mime_type, base64) を返す"""
+        if not isinstance(value, str) or not value.startswith('data:'):
+            return None
+        header, sep, data = value.partition(',')
+        if not sep or not header.endswith(';base64'):
+            return None
+        return header[len('data:'):-len(';base64')] or 'application/octet-stream', data
+    
+    def _attachments_ref(self, user_id: str):
+        return self._conversation_ref(user_id).collection('attachments')
+    
+    def _store_attachment(self, user_id: str, mime_type: str, data: str) -> str:
+        """添付をユーザーごとにコンテンツハッシュで重複排除して保存し、添付IDを返す"""
+        attachment_id = hashlib.sha256(base64.b64decode(data)).hexdigest()
+        if (user_id, attachment_id) in self.known_attachments:
+            return attachment_id
+        
+        if self.db is not None and self.firebase_initialized:
+            doc_ref = self._attachments_ref(user_id).document(attachment_id)
+            if not doc_ref.get().exists:
+                chunks = [data[i:i + ATTACHMENT_CHUNK_SIZE] for i in range(0, len(data), ATTACHMENT_CHUNK_SIZE)]
+                batch = self.db.batch()
+                for index, chunk in enumerate(chunks):
+                    batch.set(doc_ref.collection('chunks').document(str(index)), {'index': index, 'data': chunk})
+                batch.set(doc_ref, {
+                    'mime_type': mime_type,
+                    'size': len(data),
+                    'chunk_count': len(chunks),
+                    'created_at': firestore.SERVER_TIMESTAMP
+                })
+                batch.commit()
+        elif self.backend == "sqlite":
+            self.sqlite.execute(
+                "INSERT OR IGNORE INTO conversation_attachments (user_id, attachment_id, mime_type, data) VALUES (?, ?, ?, ?)",
+                (user_id, attachment_id, mime_type, data)
+            )
+        else:
+            self.attachments[(user_id, attachment_id)] = (mime_type, data)
+            self.evicted_attachment_keys.pop((user_id, attachment_id), None)
+            self.attachment_bytes += len(data)
+            self._enforce_attachment_budget()
+        
+        self.known_attachments.add((user_id, attachment_id))
+        return attachment_id
+    
+    def _externalize_value(self, user_id: str, value: Any) -> Any:
+        """base64画像は添付ストアに移して参照に置き換え、取得用URLは参照に戻す"""
+        parsed = self._parse_data_url(value)
+        if parsed:
+            return ATTACHMENT_PREFIX + self._store_attachment(user_id, *parsed)
+        # 復元したメッセージが更新で再送されると期限付きURLのまま届くため、保存前に参照へ戻す
+        match = ATTACHMENT_URL_PATTERN.search(value) if isinstance(value, str) else None
+        if match:
+            return ATTACHMENT_PREFIX + match.group(1)
+        return value
+    
+    def _externalize_attachments(self, user_id: str, message: Dict) -> Dict:
+        """メッセージ内のbase64画像を添付ストアに移し、参照に置き換えたコピーを返す"""
+        message = dict(message)
+        try:
+            message['image'] = self._externalize_value(user_id, message.get('image'))
+            
+            step_image = message.get('stepImage')
+            if isinstance(step_image, dict):
+                message['stepImage'] = {**step_image, 'image_url': self._externalize_value(user_id, step_image.get('image_url'))}
+        except Exception as e:
+            # 保存に失敗した場合は従来どおりインラインのまま保存する
+            print(f"[WARN] 添付の保存に失敗しました: {e}")
+        return message
+    
+    async def get_attachment(self, user_id: str, attachment_id: str) -> Optional[Tuple[str, bytes]]:
+        """ユーザーの添付を取得（mime_type, バイナリ）"""
+        if (user_id, attachment_id) in self.attachments:
+            mime_type, data = self.attachments[(user_id, attachment_id)]
+            return mime_type, base64.b64decode(data)
+        
+        if self.backend == "sqlite":
+            row = self.sqlite.fetch_one(
+                "SELECT mime_type, data FROM conversation_attachments WHERE user_id = ? AND attachment_id = ?",
+                (user_id, attachment_id)
+            )
+            return (row['mime_type'], base64.b64decode(row['data'])) if row else None
+        
+        if self.db is None or not self.firebase_initialized:
+            return None
+        try:
+            doc_ref = self._attachments_ref(user_id).document(attachment_id)
+            doc = doc_ref.get()
+            if not doc.exists:
+                return None
+            chunks = doc_ref.collection('chunks').order_by('index').stream()
+            data = ''.join(chunk.to_dict().get('data', '') for chunk in chunks)
+            return doc.to_dict().get('mime_type', 'application/octet-stream'), base64.b64decode(data)
+        except Exception as e:
+            return None
+    
+    def _forget_attachments(self, user_id: str):
+        """メモリ上の添付と保存済みの印を破棄（履歴クリア時）"""
+        for key in [key for key in self.attachments if key[0] == user_id]:
+            _, data = self.attachments.pop(key)
+            self.attachment_bytes -= len(data)
+        self.known_attachments = {key for key in self.known_attachments if key[0] != user_id}
+        for key in [key for key in self.evicted_attachment_keys if key[0] == user_id]:
+            del self.evicted_attachment_keys[key]
+    
+    def is_attachment_evicted(self, user_id: str, attachment_id: str) -> bool:
+        """メモリモードで予算超過により破棄された添付か"""
+        return (user_id, attachment_id) in self.evicted_attachment_keys
+    
+    def _delete_attachment_docs(self, user_id: str):
+        refs = []
+        for doc in self._attachments_ref(user_id).stream():
+            refs += [chunk.reference for chunk in doc.reference.collection('chunks').stream()]
+            refs.append(doc.reference)
+        for i in range(0, len(refs), 400):
+            batch = self.db.batch()
+            for ref in refs[i:i + 400]:
+                batch.delete(ref)
+            batch.commit()
+    
+    # === Memory Budget ===
+    def _estimate_message_bytes(self, message: Dict) -> int:
+        """メッセージのおおよそのサイズ（JSONシリアライズ後のバイト数）"""
+        try:
+            return len(json.dumps(message, ensure_ascii=False, default=str).encode('utf-8'))
+        except Exception:
+            return len(str(message).encode('utf-8'))
+    
+    def _memory_drop_user(self, user_id: str) -> Tuple[int, int]:
+        """ユーザーの履歴をメモリから取り除き、(件数, バイト数) を返す"""
+        messages = self.user_messages.pop(user_id, None) or []
+        self.user_message_sizes.pop(user_id, None)
+        size = self.user_bytes.pop(user_id, 0)
+        self.memory_bytes -= size
+        self.user_stats.pop(user_id, None)
+        self.user_generations.pop(user_id, None)
+        self.user_revisions.pop(user_id, None)
+        return len(messages), size
+    
+    def _enforce_memory_budget(self, user_id: str):
+        """ユーザー単位・全体のバイト予算を超えた分を退避する"""
+        messages = self.user_messages.get(user_id)
+        sizes = self.user_message_sizes.get(user_id)
+        if messages and self.user_bytes.get(user_id, 0) > self.MEMORY_USER_BUDGET_BYTES:
+            # 最新のメッセージは必ず残し、古い方から切り詰める
+            trimmed = 0
+            while len(messages) > 1 and self.user_bytes[user_id] > self.MEMORY_USER_BUDGET_BYTES:
+                messages.pop(0)
+                size = sizes.pop(0)
+                self.user_bytes[user_id] -= size
+                self.memory_bytes -= size
+                trimmed += 1
+            if trimmed:
+                self.memory_metrics['trimmed_messages'] += trimmed
+                self.user_stats[user_id] = self._stats_from_messages(messages)
+                self.user_generations[user_id] = uuid.uuid4().hex[:12]
+        
+        while self.memory_bytes > self.MEMORY_TOTAL_BUDGET_BYTES and len(self.user_messages) > 1:
+            victim = next(iter(self.user_messages))
+            if victim == user_id:
+                break
+            count, size = self._memory_drop_user(victim)
+            self.memory_metrics['evicted_users'] += 1
+            self.memory_metrics['evicted_messages'] += count
+            self.memory_metrics['evicted_bytes'] += size
+            self.recent_evictions.append({
+                'user_id': victim,
+                'messages': count,
+                'bytes': size,
+                'evicted_at': self._get_jst_now().isoformat()
+            })
+            print(f"[WARN] メモリ予算超過のため会話履歴を退避: {victim} ({count}件, {size} bytes)")
+    
+    def _enforce_attachment_budget(self):
+        """メモリモードの添付ストアが予算を超えたら古いものから破棄
+        
+        履歴の参照は残るため、どのユーザーのどの添付を破棄したかを記録し、取得時は410で知らせる。
+        """
+        while self.attachment_bytes > self.MEMORY_ATTACHMENT_BUDGET_BYTES and len(self.attachments) > 1:
+            key = next(iter(self.attachments))
+            _, data = self.attachments.pop(key)
+            self.attachment_bytes -= len(data)
+            self.known_attachments.discard(key)
+            self.memory_metrics['evicted_attachments'] += 1
+            
+            user_id, attachment_id = key
+            self.evicted_attachment_keys[key] = None
+            while len(self.evicted_attachment_keys) > self.EVICTED_ATTACHMENT_KEYS_LIMIT:
+                self.evicted_attachment_keys.popitem(last=False)
+            self.recent_evictions.append({
+                'user_id': user_id,
+                'attachment_id': attachment_id,
+                'bytes': len(data),
+                'evicted_at': self._get_jst_now().isoformat()
+            })
+            print(f"[WARN] メモリ予算超過のため添付を破棄: {user_id} ({attachment_id[:12]}, {len(data)} bytes)")
+    
+    def get_memory_usage(self) -> Dict:
+        """メモリモードの使用量と退避状況（ヘルスチェック用）"""
+        return {
+            'users': len(self.user_messages),
+            'bytes': self.memory_bytes,
+            'budget_bytes': self.MEMORY_TOTAL_BUDGET_BYTES,
+            'user_budget_bytes': self.MEMORY_USER_BUDGET_BYTES,
+            'attachments': len(self.attachments),
+            'attachment_bytes': self.attachment_bytes,
+            'attachment_budget_bytes': self.MEMORY_ATTACHMENT_BUDGET_BYTES,
+            **self.memory_metrics,
+            'recent_evictions': list(self.recent_evictions)
+        }
+    
     # === Memory Methods ===
-    async def _memory_get_messages(self, user_id: str) -> List[Dict]:
-        """ユーザーの全メッセージを取得"""
+    async def _memory_get_messages(self, user_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """ユーザーのメッセージを取得"""
         messages = self.user_messages.get(user_id, [])
+        if user_id in self.user_messages:
+            self.user_messages.move_to_end(user_id)
+        if before:
+            index = next((i for i, m in enumerate(messages) if m.get('id') == before), None)
+            if index is None:
+                return []
+            messages = messages[:index]
+        if limit is not None:
+            messages = messages[-limit:] if limit > 0 else []
         return messages
     
     async def _memory_save_messages(self, user_id: str, messages: List[Dict]) -> bool:
         """ユーザーの全メッセージを保存"""
+        self._memory_drop_user(user_id)
+        messages = list(messages)
+        sizes = [self._estimate_message_bytes(message) for message in messages]
         self.user_messages[user_id] = messages
+        self.user_generations[user_id] = uuid.uuid4().hex[:12]
+        self.user_message_sizes[user_id] = sizes
+        self.user_bytes[user_id] = sum(sizes)
+        self.memory_bytes += self.user_bytes[user_id]
+        self.user_stats[user_id] = self._stats_from_messages(messages)
+        self._enforce_memory_budget(user_id)
         return True
     
     async def _memory_add_message(self, user_id: str, message: Dict) -> bool:
         """新しいメッセージを追加"""
         if user_id not in self.user_messages:
             self.user_messages[user_id] = []
+            self.user_generations[user_id] = uuid.uuid4().hex[:12]
+            self.user_message_sizes[user_id] = []
+            self.user_bytes[user_id] = 0
+        self.user_messages.move_to_end(user_id)
+        self.user_revisions[user_id] = self.user_revisions.get(user_id, 0) + 1
         
-        self.user_messages[user_id].append(message)
+        messages = self.user_messages[user_id]
+        sizes = self.user_message_sizes[user_id]
+        size = self._estimate_message_bytes(message)
+        # 同じIDのメッセージ（ストリーミング中の更新など）は上書きする。更新は末尾付近が多いため後ろから探す
+        index = next((i for i in range(len(messages) - 1, -1, -1) if message.get('id') and messages[i].get('id') == message['id']), None)
+        if index is not None:
+            previous_type = messages[index].get('type')
+            messages[index] = message
+            self.user_bytes[user_id] += size - sizes[index]
+            self.memory_bytes += size - sizes[index]
+            sizes[index] = size
+            if previous_type != message.get('type'):
+                self.user_stats[user_id] = self._stats_from_messages(messages)
+        else:
+            messages.append(message)
+            sizes.append(size)
+            self.user_bytes[user_id] += size
+            self.memory_bytes += size
+            stats = self.user_stats.setdefault(user_id, self._stats_from_messages([]))
+            self._apply_stats_delta(stats, [message])
+        self._enforce_memory_budget(user_id)
         return True
     
     async def _memory_clear_messages(self, user_id: str) -> bool:
         """ユーザーの全メッセージをクリア"""
-        if user_id in self.user_messages:
-            del self.user_messages[user_id]
+        self._memory_drop_user(user_id)
         return True
     
+    async def _memory_get_stats(self, user_id: str) -> Dict:
+        """会話統計を取得"""
+        return dict(self.user_stats.get(user_id) or self._stats_from_messages([]))
+    
+    async def _memory_get_version(self, user_id: str) -> str:
+        """会話のバージョン（世代.更新番号）。同じIDの上書きでも番号が進む"""
+        if user_id not in self.user_messages:
+            return "empty.0"
+        return f"{self.user_generations.get(user_id, '0')}.{self.user_revisions.get(user_id, 0)}"
+    
+    async def _memory_get_messages_since(self, user_id: str, since: str, limit: Optional[int] = None) -> List[Dict]:
+        """指定したメッセージID（またはタイムスタンプ）より新しいメッセージを古い順に取得"""
+        messages = self.user_messages.get(user_id, [])
+        index = next((i for i, m in enumerate(messages) if m.get('id') == since), None)
+        if index is not None:
+            messages = messages[index + 1:]
+        else:
+            messages = [m for m in messages if (m.get('timestamp') or '') > since]
+        return messages[:limit] if limit is not None else messages
+    
+    # === SQLite Methods ===
+    # テーブル: conversations（世代・次の連番）/ conversation_messages（1メッセージ1行、seq順）
+    # 全件保存・追記はそれぞれ1トランザクションにまとめて書き込む
+    def _sqlite_message_rows(self, user_id: str, messages: List[Dict], start_seq: int) -> List[Tuple]:
+        return [
+            (user_id, start_seq + i, message.get('id'), message.get('type'), message.get('timestamp'), to_json(message))
+            for i, message in enumerate(messages)
+        ]
+    
+    def _sqlite_find_seq(self, user_id: str, message_id: str) -> Optional[int]:
+        row = self.sqlite.fetch_one(
+            "SELECT seq FROM conversation_messages WHERE user_id = ? AND message_id = ?",
+            (user_id, message_id)
+        )
+        return row['seq'] if row else None
+    
+    async def _sqlite_get_messages(self, user_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """ユーザーのメッセージを取得（古い順）"""
+        if limit is not None and limit <= 0:
+            return []
+        before_seq = None
+        if before:
+            before_seq = self._sqlite_find_seq(user_id, before)
+            if before_seq is None:
+                return []
+        # LIMIT -1 は件数制限なし
+        rows = self.sqlite.fetch_all(
+            "SELECT data FROM conversation_messages WHERE user_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+            (user_id, before_seq if before_seq is not None else 2 ** 62, limit if limit is not None else -1)
+        )
+        return [json.loads(row['data']) for row in reversed(rows)]
+    
+    async def _sqlite_get_messages_since(self, user_id: str, since: str, limit: Optional[int] = None) -> List[Dict]:
+        """指定したメッセージID（またはタイムスタンプ）より新しいメッセージを古い順に取得"""
+        since_seq = self._sqlite_find_seq(user_id, since)
+        if since_seq is not None:
+            rows = self.sqlite.fetch_all(
+                "SELECT data FROM conversation_messages WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (user_id, since_seq, limit if limit is not None else -1)
+            )
+        else:
+            rows = self.sqlite.fetch_all(
+                "SELECT data FROM conversation_messages WHERE user_id = ? AND timestamp > ? ORDER BY seq LIMIT ?",
+                (user_id, since, limit if limit is not None else -1)
+            )
+        return [json.loads(row['data']) for row in rows]
+    
+    async def _sqlite_save_messages(self, user_id: str, messages: List[Dict]) -> bool:
+        """ユーザーの全メッセージを保存（世代を更新）"""
+        with self.sqlite.transaction() as conn:
+            conn.execute("DELETE FROM conversation_messages WHERE user_id = ?", (user_id,))
+            conn.executemany(
+                "INSERT INTO conversation_messages (user_id, seq, message_id, type, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+                self._sqlite_message_rows(user_id, messages, 0)
+            )
+            stats = self._stats_from_messages(messages)
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (user_id, generation, next_seq, updated_at, message_count, "
+                "user_message_count, bot_message_count, first_message_time, last_message_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (user_id, uuid.uuid4().hex[:12], len(messages), self._get_jst_now().isoformat(), stats['message_count'],
+                 stats['user_message_count'], stats['bot_message_count'], stats['first_message_time'], stats['last_message_time'])
+            )
+        return True
+    
+    async def _sqlite_add_message(self, user_id: str, message: Dict) -> bool:
+        """新しいメッセージを追加（同じIDのメッセージがあれば位置を変えずに上書き）
+        
+        next_seq は上書き時にも進め、会話のバージョンとして使う。
+        集計カラムも同じトランザクションで更新する（上書き時は種別が変わった分だけ）。
+        """
+        with self.sqlite.transaction() as conn:
+            row = conn.execute("SELECT next_seq FROM conversations WHERE user_id = ?", (user_id,)).fetchone()
+            seq = row['next_seq'] if row else 0
+            if row is None:
+                conn.execute(
+                    "INSERT INTO conversations (user_id, generation, next_seq, updated_at) VALUES (?, ?, 0, ?)",
+                    (user_id, uuid.uuid4().hex[:12], self._get_jst_now().isoformat())
+                )
+            existing = conn.execute(
+                "SELECT seq, type FROM conversation_messages WHERE user_id = ? AND message_id = ? LIMIT 1",
+                (user_id, message.get('id'))
+            ).fetchone() if message.get('id') else None
+            new_type = message.get('type')
+            if existing:
+                conn.execute(
+                    "UPDATE conversation_messages SET type = ?, timestamp = ?, data = ? WHERE user_id = ? AND seq = ?",
+                    (new_type, message.get('timestamp'), to_json(message), user_id, existing['seq'])
+                )
+                old_type = existing['type']
+                conn.execute(
+                    "UPDATE conversations SET next_seq = ?, updated_at = ?, "
+                    "user_message_count = user_message_count + ? - ?, bot_message_count = bot_message_count + ? - ? "
+                    "WHERE user_id = ?",
+                    (seq + 1, self._get_jst_now().isoformat(),
+                     int(new_type == 'user'), int(old_type == 'user'), int(new_type == 'bot'), int(old_type == 'bot'), user_id)
+                )
+            else:
+                conn.execute(
+                    "INSERT INTO conversation_messages (user_id, seq, message_id, type, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    self._sqlite_message_rows(user_id, [message], seq)[0]
+                )
+                conn.execute(
+                    "UPDATE conversations SET next_seq = ?, updated_at = ?, message_count = message_count + 1, "
+                    "user_message_count = user_message_count + ?, bot_message_count = bot_message_count + ?, "
+                    "first_message_time = COALESCE(first_message_time, ?), last_message_time = ? WHERE user_id = ?",
+                    (seq + 1, self._get_jst_now().isoformat(), int(new_type == 'user'), int(new_type == 'bot'),
+                     message.get('timestamp'), message.get('timestamp'), user_id)
+                )
+        return True
+    
+    async def _sqlite_clear_messages(self, user_id: str) -> bool:
+        """ユーザーの全メッセージと添付をクリア（世代を更新）"""
+        with self.sqlite.transaction() as conn:
+            conn.execute("DELETE FROM conversation_messages WHERE user_id = ?", (user_id,))
+            conn.execute("DELETE FROM conversation_attachments WHERE user_id = ?", (user_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO conversations (user_id, generation, next_seq, updated_at) VALUES (?, ?, 0, ?)",
+                (user_id, uuid.uuid4().hex[:12], self._get_jst_now().isoformat())
+            )
+        return True
+    
+    async def _sqlite_get_stats(self, user_id: str) -> Dict:
+        """会話統計を取得（conversationsの集計カラム1行の読み取りのみ）"""
+        row = self.sqlite.fetch_one(
+            "SELECT message_count, user_message_count, bot_message_count, first_message_time, last_message_time "
+            "FROM conversations WHERE user_id = ?",
+            (user_id,)
+        )
+        return dict(row) if row else self._stats_from_messages([])
+    
+    async def _sqlite_get_version(self, user_id: str) -> str:
+        """会話のバージョン（世代.次の連番）。連番は追記・上書きのたびに進む"""
+        row = self.sqlite.fetch_one("SELECT generation, next_seq FROM conversations WHERE user_id = ?", (user_id,))
+        if row is None:
+            return "empty.0"
+        return f"{row['generation']}.{row['next_seq']}"
+    
     # === Public Interface ===
-    async def get_user_messages(self, user_id: str) -> List[Dict]:
-        """ユーザーの全メッセージを取得（LINEスタイル）"""
-        if self.backend == "firebase" or self.firebase_initialized:
-            return await self._firebase_get_messages(user_id)
+    async def get_user_messages(self, user_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+        """ユーザーのメッセージを取得（LINEスタイル）
+        
+        limit: 新しい方から取得する件数（省略時は全件）
+        before: このメッセージIDより古いメッセージのみ取得（ページング用カーソル）
+        """
+        if self.backend == "sqlite":
+            return await self._sqlite_get_messages(user_id, limit, before)
+        elif self.backend == "firebase" or self.firebase_initialized:
+            return await self._firebase_get_messages(user_id, limit, before)
         else:
-            return await self._memory_get_messages(user_id)
+            return await self._memory_get_messages(user_id, limit, before)
+    
+    async def get_messages_since(self, user_id: str, since: str, limit: Optional[int] = None) -> List[Dict]:
+        """差分同期用: since（メッセージIDまたはタイムスタンプ）より新しいメッセージを古い順に取得"""
+        if self.backend == "sqlite":
+            return await self._sqlite_get_messages_since(user_id, since, limit)
+        elif self.backend == "firebase" or self.firebase_initialized:
+            return await self._firebase_get_messages_since(user_id, since, limit)
+        else:
+            return await self._memory_get_messages_since(user_id, since, limit)
+    
+    async def get_conversation_version(self, user_id: str) -> str:
+        """会話のバージョンを取得（ETag用。内容が変わらない限り同じ値を返す）"""
+        if self.backend == "sqlite":
+            return await self._sqlite_get_version(user_id)
+        elif self.backend == "firebase" or self.firebase_initialized:
+            return await self._firebase_get_version(user_id)
+        else:
+            return await self._memory_get_version(user_id)
     
     async def save_user_messages(self, user_id: str, messages: List[Dict]) -> bool:
         """ユーザーの全メッセージを保存"""
-        if self.backend == "firebase" or self.firebase_initialized:
+        messages = self._dedupe_messages([self._externalize_attachments(user_id, message) for message in messages])
+        if self.backend == "sqlite":
+            return await self._sqlite_save_messages(user_id, messages)
+        elif self.backend == "firebase" or self.firebase_initialized:
             return await self._firebase_save_messages(user_id, messages)
         else:
             return await self._memory_save_messages(user_id, messages)
     
     async def add_user_message(self, user_id: str, message: Dict) -> bool:
         """新しいメッセージを追加"""
-        if self.backend == "firebase" or self.firebase_initialized:
+        message = self._externalize_attachments(user_id, message)
+        if self.backend == "sqlite":
+            return await self._sqlite_add_message(user_id, message)
+        elif self.backend == "firebase" or self.firebase_initialized:
             return await self._firebase_add_message(user_id, message)
         else:
             return await self._memory_add_message(user_id, message)
     
     async def clear_user_messages(self, user_id: str) -> bool:
-        """ユーザーの全メッセージをクリア（新規会話開始）"""
-        if self.backend == "firebase" or self.firebase_initialized:
+        """ユーザーの全メッセージと添付をクリア（新規会話開始）"""
+        self._forget_attachments(user_id)
+        if self.backend == "sqlite":
+            return await self._sqlite_clear_messages(user_id)
+        elif self.backend == "firebase" or self.firebase_initialized:
             return await self._firebase_clear_messages(user_id)
         else:
             return await self._memory_clear_messages(user_id)
     
     async def get_user_stats(self, user_id: str) -> Dict:
-        """ユーザーの統計情報を取得"""
-        messages = await self.get_user_messages(user_id)
-        
-        total_messages = len(messages)
-        user_messages = len([m for m in messages if m.get('type') == 'user'])
-        bot_messages = len([m for m in messages if m.get('type') == 'bot'])
-        
-        # 最初と最後のメッセージ時刻
-        first_message_time = None
-        last_message_time = None
-        
-        if messages:
-            first_message_time = messages[0].get('timestamp')
-            last_message_time = messages[-1].get('timestamp')
+        """ユーザーの統計情報を取得（追記・クリア時に更新される集計を参照）"""
+        if self.backend == "sqlite":
+            stats = await self._sqlite_get_stats(user_id)
+        elif self.backend == "firebase" or self.firebase_initialized:
+            stats = await self._firebase_get_stats(user_id)
+        else:
+            stats = await self._memory_get_stats(user_id)
         
         return {
-            'total_messages': total_messages,
-            'user_messages': user_messages,
-            'bot_messages': bot_messages,
-            'first_message_time': first_message_time,
-            'last_message_time': last_message_time,
+            'total_messages': stats['message_count'],
+            'user_messages': stats['user_message_count'],
+            'bot_messages': stats['bot_message_count'],
+            'first_message_time': stats['first_message_time'],
+            'last_message_time': stats['last_message_time'],
             'backend': self.backend,
             'firebase_initialized': self.firebase_initialized
         }
@@ -1,6 +1,3 @@
-from langchain_google_vertexai import ChatVertexAI
-from langchain.agents import initialize_agent, AgentType
-from langchain.tools import Tool
 from typing import List, Dict, Any
 import asyncio
 import json
@@ -9,9 +6,14 @@ from agents.vision_agent import extract_ingredients_from_image
 from agents.recipe_agent import recipe_agent
 from agents.generate_image_agent import image_agent
 from agents.nutrition_agent import nutrition_agent
+from agents.providers import providers
 
 class DinnerCamOrchestrator:
     def __init__(self):
+        # LangChainは読み込みに時間がかかるため、オーケストレーターの初回利用時にimportする
+        from langchain_google_vertexai import ChatVertexAI
+        from langchain.agents import initialize_agent, AgentType
+        
         self.llm = ChatVertexAI(
             model="gemini-2.5-flash-preview-05-20",
             temperature=0.7
@@ -24,8 +26,9 @@ class DinnerCamOrchestrator:
             verbose=True
         )
     
-    def _setup_tools(self) -> List[Tool]:
+    def _setup_tools(self) -> List[Any]:
         """エージェントツールをセットアップ"""
+        from langchain.tools import Tool
         return [
             Tool(
                 name="ImageIngredientAnalyzer",
@@ -119,9 +122,10 @@ class DinnerCamOrchestrator:
         
         return result
 
-# シングルトンインスタンス
-orchestrator = DinnerCamOrchestrator()
+# シングルトンインスタンス（ReActエージェントの構築は初回利用時）
+def get_orchestrator() -> DinnerCamOrchestrator:
+    return providers.get("orchestrator", DinnerCamOrchestrator)
 
 # 従来の関数インターフェース（互換性のため）
 def run_agent(message: str) -> str:
-    return orchestrator.run_agent(message)
\ No newline at end of file
+    return get_orchestrator().run_agent(message)
\ No newline at end of file
@@ -1,16 +1,44 @@
 import os
 import json
+import time
+import random
+import asyncio
 from datetime import datetime, date, timezone, timedelta
-from typing import Dict, Tuple, List
-from collections import defaultdict
+from typing import Dict, Tuple, List, Optional
+from services.sqlite_storage import sqlite_enabled, get_sqlite_store
+from agents.providers import LazyModule, module_available
 
-# Firestoreのインポート（エラー時はメモリモード）
-try:
-    from google.cloud import firestore
-    from google.oauth2 import service_account
-    FIRESTORE_AVAILABLE = True
-except ImportError:
-    FIRESTORE_AVAILABLE = False
+# Firestore（未インストール時はメモリモード）。起動を速くするため初回利用時に読み込む
+firestore = LazyModule("google.cloud.firestore")
+service_account = LazyModule("google.oauth2.service_account")
+FIRESTORE_AVAILABLE = module_available("google.cloud.firestore")
+
+# SQLiteモードのテーブル（日付ごとのユーザー別カウンタと管理者）
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    date TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    total_requests INTEGER NOT NULL DEFAULT 0,
+    image_generation_requests INTEGER NOT NULL DEFAULT 0,
+    last_request_at TEXT,
+    PRIMARY KEY (date, user_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_rate_limits_date_total ON rate_limits (date, total_requests DESC, user_id);
+CREATE TABLE IF NOT EXISTS admin_users (
+    user_id TEXT PRIMARY KEY,
+    added_by TEXT,
+    created_at TEXT
+);
+"""
+SQLITE_USAGE_SQL = "SELECT total_requests, image_generation_requests FROM rate_limits WHERE date = ? AND user_id = ?"
+
+class _DailyCount:
+    """メモリモード用の1ユーザー分の当日カウンタ（__slots__で省メモリ化）"""
+    __slots__ = ('total_requests', 'image_generation_requests')
+    
+    def __init__(self):
+        self.total_requests = 0
+        self.image_generation_requests = 0
 
 class RateLimiter:
     def __init__(self):
@@ -18,7 +46,38 @@ class RateLimiter:
         self.DAILY_IMAGE_GENERATION_LIMIT = 3
         self.JST = timezone(timedelta(hours=9))
         
-        if FIRESTORE_AVAILABLE and os.getenv('GOOGLE_SERVICE_ACCOUNT_KEY'):
+        # ローカルカウンタ層の設定（Firestoreモードのみ）
+        self.LOCAL_QUOTA_ENABLED = os.getenv('RATE_LIMIT_LOCAL_CACHE', 'true').lower() == 'true'
+        self.LOCAL_FLUSH_INTERVAL_SECONDS = float(os.getenv('RATE_LIMIT_FLUSH_INTERVAL_SECONDS', '10'))
+        self.LOCAL_FLUSH_THRESHOLD = int(os.getenv('RATE_LIMIT_FLUSH_THRESHOLD', '50'))
+        self.LOCAL_STALENESS_SECONDS = float(os.getenv('RATE_LIMIT_STALENESS_SECONDS', '60'))
+        self.LOCAL_NEAR_LIMIT_MARGIN = int(os.getenv('RATE_LIMIT_NEAR_LIMIT_MARGIN', '3'))
+        self.LOCAL_NEAR_IMAGE_LIMIT_MARGIN = int(os.getenv('RATE_LIMIT_NEAR_IMAGE_LIMIT_MARGIN', '1'))
+        self._local_counts = {}
+        self._pending_increments = 0
+        self._last_flush_at = time.monotonic()
+        self._flush_task = None
+        self._threshold_flush_task = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        
+        # 管理者向け集計の設定（Firestoreモードのみ）
+        self.STATS_SHARD_COUNT = int(os.getenv('RATE_LIMIT_STATS_SHARDS', '10'))
+        self.STATS_TOP_K = int(os.getenv('ADMIN_STATS_TOP_K', '20'))
+        # 集計の初期化（全件集計による補正）が済んでいる日付
+        self._backfilled_dates = set()
+        
+        # メモリモードのカウンタ（Firestore障害時のフォールバックでも使用）
+        self._memory_date = None
+        self.daily_counts: Dict[str, _DailyCount] = {}
+        
+        # 管理者判定のキャッシュ（user_id -> (is_admin, 有効期限)）
+        self.ADMIN_CACHE_TTL_SECONDS = float(os.getenv('ADMIN_CACHE_TTL_SECONDS', '60'))
+        self._admin_cache: Dict[str, Tuple[bool, float]] = {}
+        self._admin_watch = None
+        
+        if sqlite_enabled():
+            self._init_sqlite()
+        elif FIRESTORE_AVAILABLE and os.getenv('GOOGLE_SERVICE_ACCOUNT_KEY'):
             self._init_firestore()
         else:
             self._init_memory()
@@ -31,15 +90,27 @@ class RateLimiter:
             self.db = firestore.Client(credentials=credentials, project=credentials_dict['project_id'])
             self.backend = "firestore"
             self._init_admin_users_firestore()
+            if os.getenv('ADMIN_CACHE_WATCH', 'false').lower() == 'true':
+                self._watch_admin_users()
         except Exception as e:
             self._init_memory()
     
+    def _init_sqlite(self):
+        try:
+            self.sqlite = get_sqlite_store()
+            self.sqlite.ensure_schema(SQLITE_SCHEMA)
+            now = self._get_jst_now().isoformat()
+            with self.sqlite.transaction() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO admin_users (user_id, added_by, created_at) VALUES (?, 'env', ?)",
+                    [(admin_id.strip(), now) for admin_id in os.getenv('ADMIN_USER_IDS', '').split(',') if admin_id.strip()]
+                )
+            self.backend = "sqlite"
+        except Exception as e:
+            print(f"[WARN] SQLiteの初期化に失敗したためメモリモードで起動します: {e}")
+            self._init_memory()
+    
     def _init_memory(self):
-        self.daily_counts = defaultdict(lambda: {
-            'date': None,
-            'total_requests': 0,
-            'image_generation_requests': 0
-        })
         self.admin_users = set()
         admin_ids = os.getenv('ADMIN_USER_IDS', '').split(',')
         for admin_id in admin_ids:
@@ -62,13 +133,84 @@ class RateLimiter:
         except Exception as e:
             pass
     
+    def _watch_admin_users(self):
+        """他インスタンスでの管理者変更を検知してキャッシュを無効化"""
+        try:
+            self._admin_watch = self.db.collection('admin_users').on_snapshot(self._on_admin_users_snapshot)
+        except Exception as e:
+            self._admin_watch = None
+    
+    def _on_admin_users_snapshot(self, col_snapshot, changes, read_time):
+        for change in changes:
+            self._admin_cache.pop(change.document.id, None)
+    
+    def _get_cached_admin(self, user_id: str) -> Optional[bool]:
+        cached = self._admin_cache.get(user_id)
+        if cached is None:
+            return None
+        is_admin, expires_at = cached
+        if time.monotonic() >= expires_at:
+            self._admin_cache.pop(user_id, None)
+            return None
+        return is_admin
+    
+    def _set_cached_admin(self, user_id: str, is_admin: bool):
+        self._admin_cache[user_id] = (is_admin, time.monotonic() + self.ADMIN_CACHE_TTL_SECONDS)
+    
     def _get_today_key(self) -> str:
         return datetime.now(self.JST).date().isoformat()
     
     def _get_jst_now(self) -> datetime:
         return datetime.now(self.JST)
     
+    def _within_limits(self, total_requests: int, image_requests: int, with_images: bool) -> bool:
+        if total_requests >= self.DAILY_TOTAL_LIMIT:
+            return False
+        if with_images and image_requests >= self.DAILY_IMAGE_GENERATION_LIMIT:
+            return False
+        return True
+    
+    def _build_user_status(self, total_used: int, image_used: int, backend: str) -> Dict:
+        return {
+            'date': self._get_today_key(),
+            'total_used': total_used,
+            'total_remaining': max(0, self.DAILY_TOTAL_LIMIT - total_used),
+            'image_generation_used': image_used,
+            'image_generation_remaining': max(0, self.DAILY_IMAGE_GENERATION_LIMIT - image_used),
+            'limits': {
+                'total': self.DAILY_TOTAL_LIMIT,
+                'image_generation': self.DAILY_IMAGE_GENERATION_LIMIT
+            },
+            'jst_time': self._get_jst_now().isoformat(),
+            'backend': backend
+        }
+    
+    def _build_remaining(self, total_requests: int, image_requests: int) -> Dict:
+        return {
+            'total_remaining': max(0, self.DAILY_TOTAL_LIMIT - total_requests),
+            'image_generation_remaining': max(0, self.DAILY_IMAGE_GENERATION_LIMIT - image_requests),
+            'total_limit': self.DAILY_TOTAL_LIMIT,
+            'image_generation_limit': self.DAILY_IMAGE_GENERATION_LIMIT
+        }
+    
     # === Firestore Methods ===
+    def _stats_shard_ref(self, date_key: str, shard: Optional[int] = None):
+        """日次集計のシャードドキュメント（書き込み競合を避けるため分散）"""
+        if shard is None:
+            shard = random.randrange(self.STATS_SHARD_COUNT)
+        return (self.db.collection('rate_limit_stats')
+                .document(date_key)
+                .collection('shards')
+                .document(str(shard)))
+    
+    def _stats_delta(self, new_users: int, total_delta: int, image_delta: int) -> Dict:
+        return {
+            'total_users': firestore.Increment(new_users),
+            'total_requests': firestore.Increment(total_delta),
+            'image_generation_requests': firestore.Increment(image_delta),
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }
+    
     async def _firestore_check_limits(self, user_id: str, with_images: bool) -> Tuple[bool, Dict]:
         try:
             doc_id = f"{user_id}_{self._get_today_key()}"
@@ -82,6 +224,10 @@ class RateLimiter:
                 total_requests = 0
                 image_requests = 0
             
+            pending_total, pending_image = self._get_local_pending(user_id)
+            total_requests += pending_total
+            image_requests += pending_image
+            
             total_ok = total_requests < self.DAILY_TOTAL_LIMIT
             image_ok = True
             if with_images:
@@ -130,12 +276,140 @@ class RateLimiter:
                     'last_request_at': firestore.SERVER_TIMESTAMP,
                     'updated_at': firestore.SERVER_TIMESTAMP
                 }, merge=True)
+                transaction.set(
+                    self._stats_shard_ref(self._get_today_key()),
+                    self._stats_delta(0 if doc.exists else 1, 1, 1 if with_images else 0),
+                    merge=True
+                )
             
             transaction = self.db.transaction()
             update_counts(transaction, doc_ref)
         except Exception as e:
             pass
     
+    def _firestore_reserve_sync(self, user_id: str, with_images: bool, pending_total: int, pending_image: int) -> Tuple[bool, Dict, int, int]:
+        """制限チェックとカウント加算を1トランザクションで実行（ローカル未反映分も同時に書き込む）"""
+        today = self._get_today_key()
+        doc_ref = self.db.collection('rate_limits').document(f"{user_id}_{today}")
+        
+        @firestore.transactional
+        def reserve_transaction(transaction, doc_ref):
+            doc = doc_ref.get(transaction=transaction)
+            if doc.exists:
+                data = doc.to_dict()
+                total_requests = data.get('total_requests', 0)
+                image_requests = data.get('image_generation_requests', 0)
+            else:
+                total_requests = 0
+                image_requests = 0
+            
+            total_requests += pending_total
+            image_requests += pending_image
+            allowed = self._within_limits(total_requests, image_requests, with_images)
+            total_delta = pending_total
+            image_delta = pending_image
+            if allowed:
+                total_requests += 1
+                total_delta += 1
+                if with_images:
+                    image_requests += 1
+                    image_delta += 1
+            
+            if total_delta or image_delta:
+                transaction.set(doc_ref, {
+                    'user_id': user_id,
+                    'date': today,
+                    'total_requests': total_requests,
+                    'image_generation_requests': image_requests,
+                    'last_request_at': firestore.SERVER_TIMESTAMP,
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                }, merge=True)
+                transaction.set(
+                    self._stats_shard_ref(today),
+                    self._stats_delta(0 if doc.exists else 1, total_delta, image_delta),
+                    merge=True
+                )
+            
+            return allowed, self._build_remaining(total_requests, image_requests), total_requests, image_requests
+        
+        return reserve_transaction(self.db.transaction(), doc_ref)
+    
+    async def _firestore_reserve(self, user_id: str, with_images: bool) -> Tuple[bool, Dict]:
+        try:
+            if not self.LOCAL_QUOTA_ENABLED:
+                allowed, remaining, _, _ = await asyncio.get_running_loop().run_in_executor(
+                    None, self._firestore_reserve_sync, user_id, with_images, 0, 0
+                )
+                return allowed, remaining
+            
+            entry = await self._get_local_entry(user_id)
+            total_requests = entry['synced_total'] + entry['pending_total']
+            image_requests = entry['synced_image'] + entry['pending_image']
+            
+            # 上限から遠いユーザーはローカルで加算し、Firestoreへは後でまとめて反映
+            if not self._is_near_limit(total_requests, image_requests, with_images):
+                entry['pending_total'] += 1
+                if with_images:
+                    entry['pending_image'] += 1
+                self._pending_increments += 1
+                self._maybe_flush_local_counts()
+                return True, self._build_remaining(total_requests + 1, image_requests + (1 if with_images else 0))
+            
+            # 上限付近はFirestoreのトランザクションで判定（未反映分もここで書き込む）
+            async with entry['lock']:
+                pending_total = entry['pending_total']
+                pending_image = entry['pending_image']
+                allowed, remaining, total_requests, image_requests = await asyncio.get_running_loop().run_in_executor(
+                    None, self._firestore_reserve_sync, user_id, with_images, pending_total, pending_image
+                )
+                entry['synced_total'] = total_requests
+                entry['synced_image'] = image_requests
+                entry['pending_total'] -= pending_total
+                entry['pending_image'] -= pending_image
+                entry['synced_at'] = time.monotonic()
+                entry['exists'] = entry['exists'] or total_requests > 0
+                self._settle_pending_increments(entry, pending_total)
+            return allowed, remaining
+        except Exception as e:
+            return True, self._build_remaining(0, 0)
+    
+    async def _firestore_refund(self, user_id: str, with_images: bool):
+        doc_id = f"{user_id}_{self._get_today_key()}"
+        entry = self._local_counts.get(doc_id)
+        
+        # まだFirestoreに反映していない分はローカルで取り消す
+        if entry and entry['pending_total'] > 0 and (not with_images or entry['pending_image'] > 0):
+            entry['pending_total'] -= 1
+            if with_images:
+                entry['pending_image'] -= 1
+            self._pending_increments -= 1
+            return
+        
+        try:
+            update_data = {
+                'total_requests': firestore.Increment(-1),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }
+            if with_images:
+                update_data['image_generation_requests'] = firestore.Increment(-1)
+            batch = self.db.batch()
+            batch.update(self.db.collection('rate_limits').document(doc_id), update_data)
+            batch.set(
+                self._stats_shard_ref(self._get_today_key()),
+                self._stats_delta(0, -1, -1 if with_images else 0),
+                merge=True
+            )
+            if entry is None:
+                await asyncio.get_running_loop().run_in_executor(None, batch.commit)
+                return
+            async with entry['lock']:
+                await asyncio.get_running_loop().run_in_executor(None, batch.commit)
+                entry['synced_total'] = max(0, entry['synced_total'] - 1)
+                if with_images:
+                    entry['synced_image'] = max(0, entry['synced_image'] - 1)
+        except Exception as e:
+            pass
+    
     async def _firestore_get_user_status(self, user_id: str) -> Dict:
         try:
             doc_id = f"{user_id}_{self._get_today_key()}"
@@ -149,201 +423,668 @@ class RateLimiter:
                 total_used = 0
                 image_used = 0
             
-            return {
-                'date': self._get_today_key(),
-                'total_used': total_used,
-                'total_remaining': max(0, self.DAILY_TOTAL_LIMIT - total_used),
-                'image_generation_used': image_used,
-                'image_generation_remaining': max(0, self.DAILY_IMAGE_GENERATION_LIMIT - image_used),
-                'limits': {
-                    'total': self.DAILY_TOTAL_LIMIT,
-                    'image_generation': self.DAILY_IMAGE_GENERATION_LIMIT
-                },
-                'jst_time': self._get_jst_now().isoformat(),
-                'backend': 'firestore'
-            }
+            pending_total, pending_image = self._get_local_pending(user_id)
+            total_used += pending_total
+            image_used += pending_image
+            
+            return self._build_user_status(total_used, image_used, 'firestore')
         except Exception as e:
             return await self._memory_get_user_status(user_id)
     
     async def _firestore_is_admin(self, user_id: str) -> bool:
+        cached = self._get_cached_admin(user_id)
+        if cached is not None:
+            return cached
         try:
             doc = self.db.collection('admin_users').document(user_id).get()
-            return doc.exists and doc.to_dict().get('is_admin', False)
+            is_admin = bool(doc.exists and doc.to_dict().get('is_admin', False))
+            self._set_cached_admin(user_id, is_admin)
+            return is_admin
         except Exception as e:
             return False
     
     async def _firestore_reset_user_limits(self, user_id: str) -> bool:
         try:
-            doc_id = f"{user_id}_{self._get_today_key()}"
-            self.db.collection('rate_limits').document(doc_id).set({
-                'user_id': user_id,
-                'date': self._get_today_key(),
-                'total_requests': 0,
-                'image_generation_requests': 0,
-                'reset_at': firestore.SERVER_TIMESTAMP,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
+            today = self._get_today_key()
+            doc_id = f"{user_id}_{today}"
+            self._discard_local_entries([doc_id])
+            doc_ref = self.db.collection('rate_limits').document(doc_id)
+            
+            @firestore.transactional
+            def reset_transaction(transaction, doc_ref):
+                doc = doc_ref.get(transaction=transaction)
+                data = doc.to_dict() if doc.exists else {}
+                transaction.set(doc_ref, {
+                    'user_id': user_id,
+                    'date': today,
+                    'total_requests': 0,
+                    'image_generation_requests': 0,
+                    'reset_at': firestore.SERVER_TIMESTAMP,
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                })
+                # 集計からも差し引く（ユーザー数は従来どおり維持）
+                transaction.set(
+                    self._stats_shard_ref(today),
+                    self._stats_delta(
+                        0 if doc.exists else 1,
+                        -data.get('total_requests', 0),
+                        -data.get('image_generation_requests', 0)
+                    ),
+                    merge=True
+                )
+            
+            reset_transaction(self.db.transaction(), doc_ref)
             return True
         except Exception as e:
             return False
     
+    def _stats_marker_ref(self, date_key: str):
+        """日次集計の初期化済みマーカー（シャードの親ドキュメント）"""
+        return self.db.collection('rate_limit_stats').document(date_key)
+    
+    def _firestore_get_aggregate_totals(self, today: str) -> Dict:
+        """シャード化された日次集計を合算（シャード数分の読み取りのみ）"""
+        self._firestore_ensure_backfilled(today)
+        shard_refs = [self._stats_shard_ref(today, i) for i in range(self.STATS_SHARD_COUNT)]
+        totals = {'total_users': 0, 'total_requests': 0, 'image_generation_requests': 0}
+        for doc in self.db.get_all(shard_refs):
+            if doc.exists:
+                data = doc.to_dict()
+                for key in totals:
+                    totals[key] += data.get(key, 0)
+        
+        # このインスタンスで未反映のローカル加算分も含める
+        for entry in self._local_counts.values():
+            if entry['date'] == today:
+                totals['total_requests'] += entry['pending_total']
+                totals['image_generation_requests'] += entry['pending_image']
+                if entry['exists'] is False and entry['pending_total']:
+                    totals['total_users'] += 1
+        return totals
+    
+    def _firestore_ensure_backfilled(self, today: str):
+        """集計を導入する前から存在する当日のカウントを集計に反映する（日付ごとに1回）
+        
+        シャードは導入後の加算しか含まないため、マーカーの無い日は全件集計との差分をシャードに加える。
+        前日にマーカーがあれば当日は日付の変わり目から全ての加算がシャードに入っているので、全件集計は不要。
+        """
+        if today in self._backfilled_dates:
+            return
+        marker_ref = self._stats_marker_ref(today)
+        if marker_ref.get().exists:
+            self._backfilled_dates.add(today)
+            return
+        
+        yesterday = (date.fromisoformat(today) - timedelta(days=1)).isoformat()
+        if self._stats_marker_ref(yesterday).get().exists:
+            marker_ref.set({'backfilled': False, 'created_at': firestore.SERVER_TIMESTAMP}, merge=True)
+            self._backfilled_dates.add(today)
+            return
+        
+        shard_refs = [self._stats_shard_ref(today, i) for i in range(self.STATS_SHARD_COUNT)]
+        query = self.db.collection('rate_limits').where('date', '==', today)
+        
+        @firestore.transactional
+        def backfill_transaction(transaction, marker_ref):
+            if marker_ref.get(transaction=transaction).exists:
+                return
+            # シャードを読んでロックし、全件集計との差分を求める間の加算を待たせる
+            # （カウントとシャードは同じコミットで加算されるため、差分は導入前の分だけになる）
+            counted = {'total_users': 0, 'total_requests': 0, 'image_generation_requests': 0}
+            for doc in transaction.get_all(shard_refs):
+                if doc.exists:
+                    data = doc.to_dict()
+                    for key in counted:
+                        counted[key] += data.get(key, 0)
+            
+            scanned = {'total_users': 0, 'total_requests': 0, 'image_generation_requests': 0}
+            for doc in query.stream(transaction=transaction):
+                data = doc.to_dict()
+                scanned['total_users'] += 1
+                scanned['total_requests'] += data.get('total_requests', 0)
+                scanned['image_generation_requests'] += data.get('image_generation_requests', 0)
+            
+            transaction.set(shard_refs[0], self._stats_delta(
+                scanned['total_users'] - counted['total_users'],
+                scanned['total_requests'] - counted['total_requests'],
+                scanned['image_generation_requests'] - counted['image_generation_requests']
+            ), merge=True)
+            transaction.set(marker_ref, {
+                'backfilled': True,
+                'backfilled_users': scanned['total_users'],
+                'created_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+        
+        backfill_transaction(self.db.transaction(), marker_ref)
+        self._backfilled_dates.add(today)
+        print(f"[INFO] 日次集計を初期化しました: {today}")
+    
+    def _rate_limit_doc_to_user_stats(self, doc) -> Dict:
+        data = doc.to_dict()
+        return {
+            'user_id': data.get('user_id', 'unknown'),
+            'total_requests': data.get('total_requests', 0),
+            'image_requests': data.get('image_generation_requests', 0),
+            'last_request_at': data.get('last_request_at')
+        }
+    
+    def _firestore_user_stats_query(self, today: str):
+        # 複合インデックス（date ASC, total_requests DESC）が必要
+        return (self.db.collection('rate_limits')
+                .where('date', '==', today)
+                .order_by('total_requests', direction=firestore.Query.DESCENDING))
+    
     async def _firestore_get_all_stats(self) -> Dict:
         try:
             today = self._get_today_key()
-            docs = self.db.collection('rate_limits').where('date', '==', today).stream()
-            
-            total_users = 0
-            total_requests_today = 0
-            image_requests_today = 0
-            users = []
-            
-            for doc in docs:
-                data = doc.to_dict()
-                total_users += 1
-                total_requests_today += data.get('total_requests', 0)
-                image_requests_today += data.get('image_generation_requests', 0)
-                users.append({
-                    'user_id': data.get('user_id', 'unknown'),
-                    'total_requests': data.get('total_requests', 0),
-                    'image_requests': data.get('image_generation_requests', 0),
-                    'last_request_at': data.get('last_request_at')
-                })
+            totals = self._firestore_get_aggregate_totals(today)
+            docs = self._firestore_user_stats_query(today).limit(self.STATS_TOP_K).stream()
+            users = [self._rate_limit_doc_to_user_stats(doc) for doc in docs]
             
             return {
                 'date': today,
                 'jst_time': self._get_jst_now().isoformat(),
-                'total_users': total_users,
-                'total_requests_today': total_requests_today,
-                'image_requests_today': image_requests_today,
-                'users': sorted(users, key=lambda x: x['total_requests'], reverse=True),
+                'total_users': totals['total_users'],
+                'total_requests_today': totals['total_requests'],
+                'image_requests_today': totals['image_generation_requests'],
+                'users': users,
+                'top_k': self.STATS_TOP_K,
                 'backend': 'firestore'
             }
         except Exception as e:
             return await self._memory_get_all_stats()
     
-    # === Memory Methods ===
-    def _reset_if_new_day(self, user_id: str):
-        today = self._get_today_key()
-        user_data = self.daily_counts[user_id]
-        if user_data['date'] != today:
-            self.daily_counts[user_id] = {
+    async def _firestore_get_user_stats_page(self, limit: int, cursor: Optional[str]) -> Dict:
+        try:
+            today = self._get_today_key()
+            query = self._firestore_user_stats_query(today)
+            if cursor:
+                cursor_doc = self.db.collection('rate_limits').document(cursor).get()
+                if cursor_doc.exists:
+                    query = query.start_after(cursor_doc)
+            
+            docs = list(query.limit(limit + 1).stream())
+            has_more = len(docs) > limit
+            docs = docs[:limit]
+            
+            return {
                 'date': today,
-                'total_requests': 0,
-                'image_generation_requests': 0
+                'users': [self._rate_limit_doc_to_user_stats(doc) for doc in docs],
+                'next_cursor': docs[-1].id if has_more else None,
+                'backend': 'firestore'
             }
+        except Exception as e:
+            return await self._memory_get_user_stats_page(limit, cursor)
+    
+    # === Local Quota Tier (Firestore) ===
+    # 同期クライアントの呼び出しはスレッドで実行し、イベントループを止めない。
+    # 同じエントリへの読み込み・トランザクション・フラッシュはエントリごとのロックで直列化する
+    # （未反映分の二重書き込みや、書き込み済みの値を古い読み込み結果で上書きするのを防ぐ）
+    def _is_local_entry_stale(self, entry: Dict) -> bool:
+        return entry['synced_at'] is None or time.monotonic() - entry['synced_at'] > self.LOCAL_STALENESS_SECONDS
+    
+    async def _get_local_entry(self, user_id: str) -> Dict:
+        """ローカルカウンタを取得（未取得・鮮度切れの場合のみFirestoreを読む）"""
+        today = self._get_today_key()
+        doc_id = f"{user_id}_{today}"
+        while True:
+            entry = self._local_counts.get(doc_id)
+            if entry is None:
+                entry = {
+                    'user_id': user_id,
+                    'date': today,
+                    'synced_total': 0,
+                    'synced_image': 0,
+                    'pending_total': 0,
+                    'pending_image': 0,
+                    'synced_at': None,
+                    'exists': None,
+                    'lock': asyncio.Lock()
+                }
+                self._local_counts[doc_id] = entry
+            if not self._is_local_entry_stale(entry):
+                return entry
+            
+            async with entry['lock']:
+                # ロック待ちの間に他のリクエストが読み込んでいれば読み直さない
+                if self._local_counts.get(doc_id) is entry and self._is_local_entry_stale(entry):
+                    try:
+                        doc = await asyncio.get_running_loop().run_in_executor(
+                            None, self.db.collection('rate_limits').document(doc_id).get
+                        )
+                        if doc.exists:
+                            data = doc.to_dict()
+                            entry['synced_total'] = data.get('total_requests', 0)
+                            entry['synced_image'] = data.get('image_generation_requests', 0)
+                        else:
+                            entry['synced_total'] = 0
+                            entry['synced_image'] = 0
+                        entry['synced_at'] = time.monotonic()
+                        entry['exists'] = entry['exists'] or doc.exists
+                    except Exception as e:
+                        pass
+            # 待っている間にフラッシュ・リセットで破棄された場合は取り直す
+            if self._local_counts.get(doc_id) is entry:
+                return entry
+    
+    def _settle_pending_increments(self, entry: Dict, pending_total: int):
+        """Firestoreに書き込んだ分を未反映件数から差し引く（破棄済みのエントリは破棄時に差し引き済み）"""
+        if self._local_counts.get(f"{entry['user_id']}_{entry['date']}") is entry:
+            self._pending_increments -= pending_total
+    
+    def _get_local_pending(self, user_id: str) -> Tuple[int, int]:
+        entry = self._local_counts.get(f"{user_id}_{self._get_today_key()}")
+        if not entry:
+            return 0, 0
+        return entry['pending_total'], entry['pending_image']
+    
+    def _is_near_limit(self, total_requests: int, image_requests: int, with_images: bool) -> bool:
+        if self.DAILY_TOTAL_LIMIT - total_requests <= self.LOCAL_NEAR_LIMIT_MARGIN:
+            return True
+        if with_images and self.DAILY_IMAGE_GENERATION_LIMIT - image_requests <= self.LOCAL_NEAR_IMAGE_LIMIT_MARGIN:
+            return True
+        return False
+    
+    def _maybe_flush_local_counts(self):
+        if (self._pending_increments >= self.LOCAL_FLUSH_THRESHOLD or
+                time.monotonic() - self._last_flush_at >= self.LOCAL_FLUSH_INTERVAL_SECONDS):
+            # 書き込みはバックグラウンドで行い、リクエストは待たせない
+            if self._threshold_flush_task is None or self._threshold_flush_task.done():
+                self._last_flush_at = time.monotonic()
+                self._threshold_flush_task = asyncio.get_running_loop().create_task(self._flush_local_counts())
+        self._ensure_flush_task()
+    
+    def _ensure_flush_task(self):
+        """一定間隔でローカルカウンタを反映するバックグラウンドタスクを起動"""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+        except RuntimeError:
+            pass
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.LOCAL_FLUSH_INTERVAL_SECONDS)
+            if self._pending_increments > 0:
+                await self._flush_local_counts()
+    
+    async def _flush_local_counts(self) -> int:
+        """未反映のローカル加算分をバッチでFirestoreに書き込む"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            self._last_flush_at = time.monotonic()
+            dirty = [
+                (doc_id, entry) for doc_id, entry in self._local_counts.items()
+                if entry['pending_total'] or entry['pending_image']
+            ]
+            
+            flushed = 0
+            # Firestoreのバッチ上限（500件）ごとにコミット（日付をまたぐ場合の集計シャード2件分を残す）
+            for i in range(0, len(dirty), 498):
+                held = []
+                try:
+                    # 読み込み・トランザクション中のエントリは終わるまで待ってから未反映分を取り出す
+                    for doc_id, entry in dirty[i:i + 498]:
+                        await entry['lock'].acquire()
+                        held.append((doc_id, entry, entry['pending_total'], entry['pending_image']))
+                    chunk = [item for item in held if item[2] or item[3]]
+                    if not chunk:
+                        continue
+                    try:
+                        batch = self.db.batch()
+                        stats_deltas = {}
+                        for doc_id, entry, pending_total, pending_image in chunk:
+                            batch.set(self.db.collection('rate_limits').document(doc_id), {
+                                'user_id': entry['user_id'],
+                                'date': entry['date'],
+                                'total_requests': firestore.Increment(pending_total),
+                                'image_generation_requests': firestore.Increment(pending_image),
+                                'last_request_at': firestore.SERVER_TIMESTAMP,
+                                'updated_at': firestore.SERVER_TIMESTAMP
+                            }, merge=True)
+                            delta = stats_deltas.setdefault(entry['date'], [0, 0, 0])
+                            delta[0] += 1 if entry['exists'] is False and pending_total > 0 else 0
+                            delta[1] += pending_total
+                            delta[2] += pending_image
+                        # 日次集計は日付ごとに1シャードへまとめて加算
+                        for date_key, (new_users, total_delta, image_delta) in stats_deltas.items():
+                            batch.set(self._stats_shard_ref(date_key), self._stats_delta(new_users, total_delta, image_delta), merge=True)
+                        await asyncio.get_running_loop().run_in_executor(None, batch.commit)
+                    except Exception as e:
+                        continue
+                    
+                    # コミット中に加算された分は次回のフラッシュで反映する
+                    for doc_id, entry, pending_total, pending_image in chunk:
+                        if pending_total > 0:
+                            entry['exists'] = True
+                        entry['synced_total'] += pending_total
+                        entry['synced_image'] += pending_image
+                        entry['pending_total'] -= pending_total
+                        entry['pending_image'] -= pending_image
+                        self._settle_pending_increments(entry, pending_total)
+                        flushed += 1
+                finally:
+                    for doc_id, entry, pending_total, pending_image in held:
+                        entry['lock'].release()
+            
+            # 反映済みで日付が変わった・鮮度切れのエントリは破棄（使用中のエントリは残す）
+            today = self._get_today_key()
+            now = time.monotonic()
+            for doc_id, entry in list(self._local_counts.items()):
+                if entry['pending_total'] or entry['pending_image'] or entry['lock'].locked():
+                    continue
+                if entry['date'] != today or entry['synced_at'] is None or now - entry['synced_at'] > self.LOCAL_STALENESS_SECONDS:
+                    del self._local_counts[doc_id]
+            
+            return flushed
+    
+    def _discard_local_entries(self, doc_ids: List[str]):
+        for doc_id in doc_ids:
+            entry = self._local_counts.pop(doc_id, None)
+            if entry:
+                self._pending_increments -= entry['pending_total']
+    
+    # === Memory Methods ===
+    def _rollover_memory_if_new_day(self):
+        """JSTの日付が変わったら前日分のカウンタをまとめて破棄"""
+        today = self._get_today_key()
+        if self._memory_date != today:
+            self.daily_counts = {}
+            self._memory_date = today
+    
+    def _get_memory_count(self, user_id: str) -> Optional[_DailyCount]:
+        # 参照系では未知のユーザーのエントリを作らない
+        self._rollover_memory_if_new_day()
+        return self.daily_counts.get(user_id)
+    
+    def _get_or_create_memory_count(self, user_id: str) -> _DailyCount:
+        self._rollover_memory_if_new_day()
+        count = self.daily_counts.get(user_id)
+        if count is None:
+            count = _DailyCount()
+            self.daily_counts[user_id] = count
+        return count
+    
+    def _memory_usage(self, user_id: str) -> Tuple[int, int]:
+        count = self._get_memory_count(user_id)
+        if count is None:
+            return 0, 0
+        return count.total_requests, count.image_generation_requests
     
     async def _memory_check_limits(self, user_id: str, with_images: bool) -> Tuple[bool, Dict]:
-        self._reset_if_new_day(user_id)
-        user_data = self.daily_counts[user_id]
-        
-        total_ok = user_data['total_requests'] < self.DAILY_TOTAL_LIMIT
-        image_ok = True
+        total_requests, image_requests = self._memory_usage(user_id)
+        return self._within_limits(total_requests, image_requests, with_images), self._build_remaining(total_requests, image_requests)
+    
+    async def _memory_increment_count(self, user_id: str, with_images: bool):
+        count = self._get_or_create_memory_count(user_id)
+        count.total_requests += 1
         if with_images:
-            image_ok = user_data['image_generation_requests'] < self.DAILY_IMAGE_GENERATION_LIMIT
-        
-        remaining = {
-            'total_remaining': max(0, self.DAILY_TOTAL_LIMIT - user_data['total_requests']),
-            'image_generation_remaining': max(0, self.DAILY_IMAGE_GENERATION_LIMIT - user_data['image_generation_requests']),
-            'total_limit': self.DAILY_TOTAL_LIMIT,
-            'image_generation_limit': self.DAILY_IMAGE_GENERATION_LIMIT
-        }
+            count.image_generation_requests += 1
+    
+    async def _memory_reserve(self, user_id: str, with_images: bool) -> Tuple[bool, Dict]:
+        # awaitを挟まないのでイベントループ上ではアトミックに実行される
+        total_requests, image_requests = self._memory_usage(user_id)
+        if not self._within_limits(total_requests, image_requests, with_images):
+            return False, self._build_remaining(total_requests, image_requests)
         
-        return total_ok and image_ok, remaining
+        count = self._get_or_create_memory_count(user_id)
+        count.total_requests += 1
+        if with_images:
+            count.image_generation_requests += 1
+        return True, self._build_remaining(count.total_requests, count.image_generation_requests)
     
-    async def _memory_increment_count(self, user_id: str, with_images: bool):
-        self._reset_if_new_day(user_id)
-        user_data = self.daily_counts[user_id]
-        user_data['total_requests'] += 1
+    async def _memory_refund(self, user_id: str, with_images: bool):
+        count = self._get_memory_count(user_id)
+        if count is None:
+            return
+        count.total_requests = max(0, count.total_requests - 1)
         if with_images:
-            user_data['image_generation_requests'] += 1
+            count.image_generation_requests = max(0, count.image_generation_requests - 1)
     
     async def _memory_get_user_status(self, user_id: str) -> Dict:
-        self._reset_if_new_day(user_id)
-        user_data = self.daily_counts[user_id]
-        
-        return {
-            'date': self._get_today_key(),
-            'total_used': user_data['total_requests'],
-            'total_remaining': max(0, self.DAILY_TOTAL_LIMIT - user_data['total_requests']),
-            'image_generation_used': user_data['image_generation_requests'],
-            'image_generation_remaining': max(0, self.DAILY_IMAGE_GENERATION_LIMIT - user_data['image_generation_requests']),
-            'limits': {
-                'total': self.DAILY_TOTAL_LIMIT,
-                'image_generation': self.DAILY_IMAGE_GENERATION_LIMIT
-            },
-            'jst_time': self._get_jst_now().isoformat(),
-            'backend': 'memory'
-        }
+        total_used, image_used = self._memory_usage(user_id)
+        return self._build_user_status(total_used, image_used, 'memory')
     
     async def _memory_is_admin(self, user_id: str) -> bool:
         return user_id in self.admin_users
     
     async def _memory_reset_user_limits(self, user_id: str) -> bool:
+        count = self._get_memory_count(user_id)
+        if count is not None:
+            count.total_requests = 0
+            count.image_generation_requests = 0
+        return True
+    
+    def _memory_sorted_user_stats(self) -> List[Dict]:
+        self._rollover_memory_if_new_day()
+        users = [
+            {
+                'user_id': user_id,
+                'total_requests': count.total_requests,
+                'image_requests': count.image_generation_requests,
+                'last_request_at': None
+            }
+            for user_id, count in self.daily_counts.items()
+        ]
+        return sorted(users, key=lambda x: x['total_requests'], reverse=True)
+    
+    async def _memory_get_all_stats(self) -> Dict:
         today = self._get_today_key()
-        self.daily_counts[user_id] = {
+        users = self._memory_sorted_user_stats()
+        
+        return {
             'date': today,
-            'total_requests': 0,
-            'image_generation_requests': 0
+            'jst_time': self._get_jst_now().isoformat(),
+            'total_users': len(users),
+            'total_requests_today': sum(user['total_requests'] for user in users),
+            'image_requests_today': sum(user['image_requests'] for user in users),
+            'users': users[:self.STATS_TOP_K],
+            'top_k': self.STATS_TOP_K,
+            'backend': 'memory'
+        }
+    
+    async def _memory_get_user_stats_page(self, limit: int, cursor: Optional[str]) -> Dict:
+        users = self._memory_sorted_user_stats()
+        start = 0
+        if cursor:
+            for i, user in enumerate(users):
+                if user['user_id'] == cursor:
+                    start = i + 1
+                    break
+        page = users[start:start + limit]
+        has_more = start + limit < len(users)
+        
+        return {
+            'date': self._get_today_key(),
+            'users': page,
+            'next_cursor': page[-1]['user_id'] if has_more and page else None,
+            'backend': 'memory'
         }
+    
+    # === SQLite Methods ===
+    # 1ユーザー1日1行。確保・返却は1トランザクション（BEGIN IMMEDIATE）内で判定と更新を行う
+    def _sqlite_usage(self, row) -> Tuple[int, int]:
+        if row is None:
+            return 0, 0
+        return row['total_requests'], row['image_generation_requests']
+    
+    def _sqlite_add_usage(self, conn, user_id: str, today: str, with_images: bool):
+        image_delta = 1 if with_images else 0
+        conn.execute(
+            "INSERT INTO rate_limits (date, user_id, total_requests, image_generation_requests, last_request_at) VALUES (?, ?, 1, ?, ?) "
+            "ON CONFLICT(date, user_id) DO UPDATE SET total_requests = total_requests + 1, "
+            "image_generation_requests = image_generation_requests + excluded.image_generation_requests, last_request_at = excluded.last_request_at",
+            (today, user_id, image_delta, self._get_jst_now().isoformat())
+        )
+    
+    def _sqlite_row_to_user_stats(self, row) -> Dict:
+        return {
+            'user_id': row['user_id'],
+            'total_requests': row['total_requests'],
+            'image_requests': row['image_generation_requests'],
+            'last_request_at': row['last_request_at']
+        }
+    
+    async def _sqlite_check_limits(self, user_id: str, with_images: bool) -> Tuple[bool, Dict]:
+        total_requests, image_requests = self._sqlite_usage(self.sqlite.fetch_one(SQLITE_USAGE_SQL, (self._get_today_key(), user_id)))
+        return self._within_limits(total_requests, image_requests, with_images), self._build_remaining(total_requests, image_requests)
+    
+    async def _sqlite_increment_count(self, user_id: str, with_images: bool):
+        with self.sqlite.transaction() as conn:
+            self._sqlite_add_usage(conn, user_id, self._get_today_key(), with_images)
+    
+    async def _sqlite_reserve(self, user_id: str, with_images: bool) -> Tuple[bool, Dict]:
+        today = self._get_today_key()
+        with self.sqlite.transaction() as conn:
+            total_requests, image_requests = self._sqlite_usage(conn.execute(SQLITE_USAGE_SQL, (today, user_id)).fetchone())
+            if not self._within_limits(total_requests, image_requests, with_images):
+                return False, self._build_remaining(total_requests, image_requests)
+            self._sqlite_add_usage(conn, user_id, today, with_images)
+        return True, self._build_remaining(total_requests + 1, image_requests + (1 if with_images else 0))
+    
+    async def _sqlite_refund(self, user_id: str, with_images: bool):
+        self.sqlite.execute(
+            "UPDATE rate_limits SET total_requests = MAX(total_requests - 1, 0), "
+            "image_generation_requests = MAX(image_generation_requests - ?, 0) WHERE date = ? AND user_id = ?",
+            (1 if with_images else 0, self._get_today_key(), user_id)
+        )
+    
+    async def _sqlite_get_user_status(self, user_id: str) -> Dict:
+        total_used, image_used = self._sqlite_usage(self.sqlite.fetch_one(SQLITE_USAGE_SQL, (self._get_today_key(), user_id)))
+        return self._build_user_status(total_used, image_used, 'sqlite')
+    
+    async def _sqlite_is_admin(self, user_id: str) -> bool:
+        return self.sqlite.fetch_one("SELECT 1 FROM admin_users WHERE user_id = ?", (user_id,)) is not None
+    
+    async def _sqlite_reset_user_limits(self, user_id: str) -> bool:
+        self.sqlite.execute(
+            "UPDATE rate_limits SET total_requests = 0, image_generation_requests = 0 WHERE date = ? AND user_id = ?",
+            (self._get_today_key(), user_id)
+        )
         return True
     
-    async def _memory_get_all_stats(self) -> Dict:
+    async def _sqlite_reset_all_limits(self) -> int:
+        return self.sqlite.execute(
+            "UPDATE rate_limits SET total_requests = 0, image_generation_requests = 0 WHERE date = ?",
+            (self._get_today_key(),)
+        )
+    
+    async def _sqlite_get_all_stats(self) -> Dict:
         today = self._get_today_key()
-        total_users = 0
-        total_requests_today = 0
-        image_requests_today = 0
-        users = []
-        
-        for user_id, data in self.daily_counts.items():
-            if data['date'] == today:
-                total_users += 1
-                total_requests_today += data['total_requests']
-                image_requests_today += data['image_generation_requests']
-                users.append({
-                    'user_id': user_id,
-                    'total_requests': data['total_requests'],
-                    'image_requests': data['image_generation_requests'],
-                    'last_request_at': None
-                })
+        totals = self.sqlite.fetch_one(
+            "SELECT COUNT(*) AS users, COALESCE(SUM(total_requests), 0) AS total, COALESCE(SUM(image_generation_requests), 0) AS image "
+            "FROM rate_limits WHERE date = ?",
+            (today,)
+        )
+        rows = self.sqlite.fetch_all(
+            "SELECT * FROM rate_limits WHERE date = ? ORDER BY total_requests DESC, user_id LIMIT ?",
+            (today, self.STATS_TOP_K)
+        )
         
         return {
             'date': today,
             'jst_time': self._get_jst_now().isoformat(),
-            'total_users': total_users,
-            'total_requests_today': total_requests_today,
-            'image_requests_today': image_requests_today,
-            'users': sorted(users, key=lambda x: x['total_requests'], reverse=True),
-            'backend': 'memory'
+            'total_users': totals['users'],
+            'total_requests_today': totals['total'],
+            'image_requests_today': totals['image'],
+            'users': [self._sqlite_row_to_user_stats(row) for row in rows],
+            'top_k': self.STATS_TOP_K,
+            'backend': 'sqlite'
+        }
+    
+    async def _sqlite_get_user_stats_page(self, limit: int, cursor: Optional[str]) -> Dict:
+        today = self._get_today_key()
+        cursor_row = None
+        if cursor:
+            cursor_row = self.sqlite.fetch_one(
+                "SELECT total_requests FROM rate_limits WHERE date = ? AND user_id = ?",
+                (today, cursor)
+            )
+        if cursor_row is not None:
+            rows = self.sqlite.fetch_all(
+                "SELECT * FROM rate_limits WHERE date = ? AND (total_requests < ? OR (total_requests = ? AND user_id > ?)) "
+                "ORDER BY total_requests DESC, user_id LIMIT ?",
+                (today, cursor_row['total_requests'], cursor_row['total_requests'], cursor, limit + 1)
+            )
+        else:
+            rows = self.sqlite.fetch_all(
+                "SELECT * FROM rate_limits WHERE date = ? ORDER BY total_requests DESC, user_id LIMIT ?",
+                (today, limit + 1)
+            )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        return {
+            'date': today,
+            'users': [self._sqlite_row_to_user_stats(row) for row in rows],
+            'next_cursor': rows[-1]['user_id'] if has_more else None,
+            'backend': 'sqlite'
         }
     
     # === Public Interface ===
     async def check_limits(self, user_id: str, with_images: bool = False) -> Tuple[bool, Dict]:
         if self.backend == "firestore":
             return await self._firestore_check_limits(user_id, with_images)
+        elif self.backend == "sqlite":
+            return await self._sqlite_check_limits(user_id, with_images)
         else:
             return await self._memory_check_limits(user_id, with_images)
     
     async def increment_count(self, user_id: str, with_images: bool = False):
         if self.backend == "firestore":
             await self._firestore_increment_count(user_id, with_images)
+        elif self.backend == "sqlite":
+            await self._sqlite_increment_count(user_id, with_images)
         else:
             await self._memory_increment_count(user_id, with_images)
     
+    async def reserve(self, user_id: str, with_images: bool = False) -> Tuple[bool, Dict]:
+        """制限内であれば1回分の利用枠をアトミックに確保する"""
+        if self.backend == "firestore":
+            return await self._firestore_reserve(user_id, with_images)
+        elif self.backend == "sqlite":
+            return await self._sqlite_reserve(user_id, with_images)
+        else:
+            return await self._memory_reserve(user_id, with_images)
+    
+    async def refund(self, user_id: str, with_images: bool = False):
+        """reserveで確保した利用枠を返却する（処理失敗・中断時）"""
+        if self.backend == "firestore":
+            await self._firestore_refund(user_id, with_images)
+        elif self.backend == "sqlite":
+            await self._sqlite_refund(user_id, with_images)
+        else:
+            await self._memory_refund(user_id, with_images)
+    
+    async def flush_local_counts(self) -> int:
+        """ローカルカウンタの未反映分をFirestoreに書き込む（シャットダウン時など）"""
+        if self.backend == "firestore":
+            return await self._flush_local_counts()
+        return 0
+    
     async def get_user_status(self, user_id: str) -> Dict:
         if self.backend == "firestore":
             return await self._firestore_get_user_status(user_id)
+        elif self.backend == "sqlite":
+            return await self._sqlite_get_user_status(user_id)
         else:
             return await self._memory_get_user_status(user_id)
     
     async def is_admin(self, user_id: str) -> bool:
         if self.backend == "firestore":
             return await self._firestore_is_admin(user_id)
+        elif self.backend == "sqlite":
+            return await self._sqlite_is_admin(user_id)
         else:
             return await self._memory_is_admin(user_id)
     
     async def reset_user_limits(self, user_id: str) -> bool:
         if self.backend == "firestore":
             return await self._firestore_reset_user_limits(user_id)
+        elif self.backend == "sqlite":
+            return await self._sqlite_reset_user_limits(user_id)
         else:
             return await self._memory_reset_user_limits(user_id)
     
@@ -351,48 +1092,68 @@ class RateLimiter:
         if self.backend == "firestore":
             try:
                 today = self._get_today_key()
-                docs = self.db.collection('rate_limits').where('date', '==', today).stream()
-                reset_count = 0
-                batch = self.db.batch()
-                
-                for doc in docs:
-                    data = doc.to_dict()
-                    user_id = data.get('user_id')
-                    if user_id:
-                        doc_ref = self.db.collection('rate_limits').document(doc.id)
-                        batch.set(doc_ref, {
-                            'user_id': user_id,
+                self._discard_local_entries([doc_id for doc_id, entry in self._local_counts.items() if entry['date'] == today])
+                # 日次集計は導入前の分を含めてから差し引く（ユーザー数は維持）
+                self._firestore_ensure_backfilled(today)
+                docs = [doc for doc in self.db.collection('rate_limits').where('date', '==', today).stream()
+                        if doc.to_dict().get('user_id')]
+            except Exception as e:
+                print(f"[ERROR] 全ユーザーの制限リセットに失敗しました: {e}")
+                return 0
+            
+            # Firestoreのバッチ上限（500件）に収まるよう、集計の減算1件を含めて分割してコミット
+            reset_count = 0
+            for i in range(0, len(docs), 499):
+                chunk = docs[i:i + 499]
+                try:
+                    batch = self.db.batch()
+                    total_delta = 0
+                    image_delta = 0
+                    for doc in chunk:
+                        data = doc.to_dict()
+                        batch.set(doc.reference, {
+                            'user_id': data['user_id'],
                             'date': today,
                             'total_requests': 0,
                             'image_generation_requests': 0,
                             'reset_at': firestore.SERVER_TIMESTAMP,
                             'updated_at': firestore.SERVER_TIMESTAMP
                         })
-                        reset_count += 1
-                
-                if reset_count > 0:
+                        total_delta -= data.get('total_requests', 0)
+                        image_delta -= data.get('image_generation_requests', 0)
+                    # 同じコミットで集計からも差し引き、途中で失敗しても集計とカウントを一致させる
+                    batch.set(self._stats_shard_ref(today), self._stats_delta(0, total_delta, image_delta), merge=True)
                     batch.commit()
-                return reset_count
-            except Exception as e:
-                return 0
-        else:
-            today = self._get_today_key()
-            reset_count = 0
-            for user_id in list(self.daily_counts.keys()):
-                self.daily_counts[user_id] = {
-                    'date': today,
-                    'total_requests': 0,
-                    'image_generation_requests': 0
-                }
-                reset_count += 1
+                    reset_count += len(chunk)
+                except Exception as e:
+                    print(f"[ERROR] 制限リセットのコミットに失敗しました ({i}件目から{len(chunk)}件): {e}")
             return reset_count
+        elif self.backend == "sqlite":
+            return await self._sqlite_reset_all_limits()
+        else:
+            self._rollover_memory_if_new_day()
+            for count in self.daily_counts.values():
+                count.total_requests = 0
+                count.image_generation_requests = 0
+            return len(self.daily_counts)
     
     async def get_all_stats(self) -> Dict:
         if self.backend == "firestore":
             return await self._firestore_get_all_stats()
+        elif self.backend == "sqlite":
+            return await self._sqlite_get_all_stats()
         else:
             return await self._memory_get_all_stats()
     
+    async def get_user_stats_page(self, limit: int = 50, cursor: Optional[str] = None) -> Dict:
+        """当日のユーザー別利用状況をリクエスト数の多い順にページ単位で取得"""
+        if self.backend == "firestore":
+            return await self._firestore_get_user_stats_page(limit, cursor)
+        elif self.backend == "sqlite":
+            return await self._sqlite_get_user_stats_page(limit, cursor)
+        else:
+            return await self._memory_get_user_stats_page(limit, cursor)
+    
     async def add_admin(self, user_id: str, added_by: str) -> bool:
         if self.backend == "firestore":
             try:
@@ -402,9 +1163,16 @@ class RateLimiter:
                     'added_by': added_by,
                     'created_at': firestore.SERVER_TIMESTAMP
                 })
+                self._set_cached_admin(user_id, True)
                 return True
             except Exception as e:
                 return False
+        elif self.backend == "sqlite":
+            self.sqlite.execute(
+                "INSERT OR REPLACE INTO admin_users (user_id, added_by, created_at) VALUES (?, ?, ?)",
+                (user_id, added_by, self._get_jst_now().isoformat())
+            )
+            return True
         else:
             self.admin_users.add(user_id)
             return True
@@ -413,9 +1181,12 @@ class RateLimiter:
         if self.backend == "firestore":
             try:
                 self.db.collection('admin_users').document(user_id).delete()
+                self._set_cached_admin(user_id, False)
                 return True
             except Exception as e:
                 return False
+        elif self.backend == "sqlite":
+            return self.sqlite.execute("DELETE FROM admin_users WHERE user_id = ?", (user_id,)) > 0
         else:
             if user_id in self.admin_users:
                 self.admin_users.remove(user_id)
@@ -0,0 +1,125 @@
+import os
+import time
+import asyncio
+from typing import Dict, Any, Callable, Awaitable, Optional
+
+class BackgroundTaskManager:
+    """レスポンス後に行う処理を、上限付きキューと固定数のワーカーで実行する
+    
+    - 同じkeyのジョブが未実行のままキューにあれば、新しい内容で置き換える（coalesce）
+    - キューが満杯の場合は BACKGROUND_OVERFLOW_POLICY に従って新しいジョブ（drop_new）か最も古いジョブ（drop_oldest）を破棄
+    - シャットダウン時は drain() でキューを処理し終えてからワーカーを停止
+    """
+    
+    def __init__(self):
+        self.QUEUE_SIZE = int(os.getenv('BACKGROUND_QUEUE_SIZE', '200'))
+        self.WORKER_COUNT = int(os.getenv('BACKGROUND_WORKERS', '4'))
+        self.OVERFLOW_POLICY = os.getenv('BACKGROUND_OVERFLOW_POLICY', 'drop_new')
+        self.DRAIN_TIMEOUT_SECONDS = float(os.getenv('BACKGROUND_DRAIN_TIMEOUT_SECONDS', '10'))
+        
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers = []
+        self.queued_by_key: Dict[str, Dict[str, Any]] = {}
+        self.closed = False
+        self.running = 0
+        self.metrics = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'wait_seconds_total': 0.0,
+            'run_seconds_total': 0.0,
+            'run_seconds_max': 0.0,
+            'last_error': None
+        }
+    
+    def _ensure_started(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.QUEUE_SIZE)
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.WORKER_COUNT)]
+    
+    def submit(self, name: str, factory: Callable[[], Awaitable[Any]], key: Optional[str] = None) -> bool:
+        """ジョブを登録（factoryは実行時に呼び出してコルーチンを作る関数）。破棄された場合はFalseを返す"""
+        self.metrics['submitted'] += 1
+        if self.closed:
+            self.metrics['dropped'] += 1
+            print(f"[WARN] シャットダウン中のためバックグラウンド処理を破棄: {name}")
+            return False
+        self._ensure_started()
+        
+        if key is not None and key in self.queued_by_key:
+            # まだ実行されていない同じkeyのジョブは最新の内容に置き換える
+            self.queued_by_key[key]['factory'] = factory
+            self.metrics['coalesced'] += 1
+            return True
+        
+        job = {'name': name, 'key': key, 'factory': factory, 'enqueued_at': time.monotonic()}
+        if self.queue.full():
+            if self.OVERFLOW_POLICY != 'drop_oldest':
+                self.metrics['dropped'] += 1
+                print(f"[WARN] バックグラウンドキューが満杯のため破棄: {name}")
+                return False
+            oldest = self.queue.get_nowait()
+            self.queue.task_done()
+            self._forget(oldest)
+            self.metrics['dropped'] += 1
+            print(f"[WARN] バックグラウンドキューが満杯のため古い処理を破棄: {oldest['name']}")
+        
+        self.queue.put_nowait(job)
+        if key is not None:
+            self.queued_by_key[key] = job
+        return True
+    
+    def _forget(self, job: Dict[str, Any]):
+        if job['key'] is not None and self.queued_by_key.get(job['key']) is job:
+            del self.queued_by_key[job['key']]
+    
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            self._forget(job)
+            started_at = time.monotonic()
+            self.metrics['wait_seconds_total'] += started_at - job['enqueued_at']
+            self.running += 1
+            try:
+                await job['factory']()
+                self.metrics['completed'] += 1
+            except Exception as e:
+                self.metrics['failed'] += 1
+                self.metrics['last_error'] = f"{job['name']}: {e}"
+                print(f"[ERROR] バックグラウンド処理エラー ({job['name']}): {e}")
+            finally:
+                elapsed = time.monotonic() - started_at
+                self.metrics['run_seconds_total'] += elapsed
+                self.metrics['run_seconds_max'] = max(self.metrics['run_seconds_max'], elapsed)
+                self.running -= 1
+                self.queue.task_done()
+    
+    async def drain(self):
+        """新規受付を止め、キューに残った処理を待ってからワーカーを停止（シャットダウン時に呼び出す）"""
+        self.closed = True
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=self.DRAIN_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                print(f"[WARN] バックグラウンド処理が時間内に完了しませんでした（残り{self.queue.qsize()}件）")
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """キュー長・実行中件数・失敗数・待ち時間などの統計"""
+        finished = self.metrics['completed'] + self.metrics['failed']
+        return {
+            **{k: v for k, v in self.metrics.items() if not k.endswith('_total')},
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'running': self.running,
+            'workers': len(self.workers),
+            'avg_wait_seconds': round(self.metrics['wait_seconds_total'] / finished, 4) if finished else 0,
+            'avg_run_seconds': round(self.metrics['run_seconds_total'] / finished, 4) if finished else 0
+        }
+
+# シングルトンインスタンス
+background_tasks = BackgroundTaskManager()
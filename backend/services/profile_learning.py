@@ -0,0 +1,112 @@
+import os
+import asyncio
+from typing import Dict, Any, List
+from services.profile_storage import profile_storage
+from services.background_tasks import background_tasks
+
+# 会話から学習したリスト項目（既存の値との和集合で更新）
+LIST_FIELDS = [
+    "dietary_restrictions",
+    "allergies",
+    "preferred_cuisines",
+    "health_goals",
+    "disliked_ingredients",
+    "favorite_ingredients",
+    "preferred_cooking_methods",
+    "taste_preferences",
+    "food_interests",
+    "special_situations"
+]
+
+# 単一値の項目（抽出結果のキー -> プロファイルのフィールド。最後に抽出された値で上書き）
+SCALAR_FIELDS = {
+    "cooking_skill_level": "cooking_skill_level",
+    "available_cooking_time": "available_cooking_time",
+    "family_size": "family_size",
+    "meal_timing": "meal_timing_context"
+}
+
+class ProfileLearningQueue:
+    """会話から抽出したプロファイル情報をユーザーごとに一定時間まとめ、1回のトランザクションで反映する"""
+    
+    def __init__(self):
+        self.DEBOUNCE_SECONDS = float(os.getenv('PROFILE_LEARNING_DEBOUNCE_SECONDS', '5'))
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self.flush_tasks: Dict[str, asyncio.Task] = {}
+        self.metrics = {
+            'submitted': 0,
+            'flushes': 0,
+            'writes': 0,
+            'no_change': 0,
+            'failed': 0
+        }
+    
+    def _merge(self, delta: Dict[str, Any], profile_info: Dict[str, Any]):
+        for field in LIST_FIELDS:
+            values = profile_info.get(field)
+            if values:
+                merged = delta['lists'].setdefault(field, [])
+                merged.extend(value for value in values if value not in merged)
+        for key, field in SCALAR_FIELDS.items():
+            if profile_info.get(key):
+                delta['scalars'][field] = profile_info[key]
+    
+    def submit(self, user_id: str, profile_info: Dict[str, Any]):
+        """プロファイル情報を登録（反映はデバウンス後にまとめて行う）"""
+        self.metrics['submitted'] += 1
+        delta = self.pending.setdefault(user_id, {'lists': {}, 'scalars': {}})
+        self._merge(delta, profile_info)
+        
+        if user_id not in self.flush_tasks:
+            self.flush_tasks[user_id] = asyncio.create_task(self._delayed_flush(user_id))
+    
+    async def _delayed_flush(self, user_id: str):
+        try:
+            await asyncio.sleep(self.DEBOUNCE_SECONDS)
+        except asyncio.CancelledError:
+            return
+        self.flush_tasks.pop(user_id, None)
+        # 書き込みはワーカーで実行（同じユーザーの未実行の反映は1件にまとまる）
+        background_tasks.submit(
+            "profile_learning_flush",
+            lambda: self.flush(user_id),
+            key=f"profile_learning:{user_id}"
+        )
+    
+    async def flush(self, user_id: str):
+        """まとめた差分をプロファイルに反映"""
+        task = self.flush_tasks.pop(user_id, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        
+        delta = self.pending.pop(user_id, None)
+        if not delta or not (delta['lists'] or delta['scalars']):
+            return
+        
+        self.metrics['flushes'] += 1
+        try:
+            changed = await profile_storage.apply_learned_profile(user_id, delta['lists'], delta['scalars'])
+            if changed:
+                self.metrics['writes'] += 1
+                print(f"[INFO] ユーザー {user_id} のプロファイルを自動更新: {changed}")
+            else:
+                self.metrics['no_change'] += 1
+        except Exception as e:
+            self.metrics['failed'] += 1
+            print(f"[ERROR] プロファイル自動更新エラー: {e}")
+    
+    async def flush_all(self):
+        """全ユーザーの差分を反映（シャットダウン時に呼び出す）"""
+        for user_id in list(self.pending.keys()):
+            await self.flush(user_id)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """まとめ書きの統計（coalescing_ratio: 1回の反映あたりの登録件数）"""
+        return {
+            **self.metrics,
+            'pending_users': len(self.pending),
+            'coalescing_ratio': round(self.metrics['submitted'] / self.metrics['flushes'], 2) if self.metrics['flushes'] else 0
+        }
+
+# シングルトンインスタンス
+profile_learning_queue = ProfileLearningQueue()
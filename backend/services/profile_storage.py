@@ -1,32 +1,191 @@
 import json
-from datetime import datetime
-from typing import Optional, Dict, Any, List
-from google.cloud import firestore
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
 from models.user_profile import UserProfile, UserProfileUpdate, RecipeFeedback, CookingSession
+from services.sqlite_storage import sqlite_enabled, get_sqlite_store, to_json
+from agents.providers import providers, LazyModule
 import os
 
+# Firestoreは初回利用時に読み込む（起動時間を短縮）
+firestore = LazyModule("google.cloud.firestore")
+
+# プロファイルに保持する最近の調理履歴の件数
+COOKING_HISTORY_LIMIT = 10
+# 調理頻度（週あたりの回数）の算出に使う直近の週数
+COOKING_FREQUENCY_WEEKS = 4
+
+# SQLiteモードのテーブル（プロファイル・セッション・フィードバック・統計はJSONで保持）
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_profiles (
+    user_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS recipe_feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    recipe_id TEXT,
+    created_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_recipe_feedback_user ON recipe_feedback (user_id, created_at);
+CREATE TABLE IF NOT EXISTS cooking_sessions (
+    user_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    created_at TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, session_id)
+);
+CREATE TABLE IF NOT EXISTS cooking_stats (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
 class ProfileStorageService:
     def __init__(self):
-        self.db = firestore.Client()
+        self.sqlite = None
+        if sqlite_enabled():
+            # 単一ノード向け: ローカルのSQLiteに保存（GCPの認証情報は不要）
+            self.sqlite = get_sqlite_store()
+            self.sqlite.ensure_schema(SQLITE_SCHEMA)
+            self.backend = "sqlite"
+        else:
+            self.backend = "firestore"
         self.profiles_collection = "user_profiles"
         self.feedback_collection = "recipe_feedback"
         self.sessions_collection = "cooking_sessions"
+        self.stats_collection = "stats"
+        
+        # プロファイルの読み取りキャッシュ（ローカルの書き込みで無効化、TTLで他インスタンスの更新も反映）
+        self.PROFILE_CACHE_TTL_SECONDS = float(os.getenv('PROFILE_CACHE_TTL_SECONDS', '60'))
+        self.PROFILE_CACHE_MAX_ENTRIES = int(os.getenv('PROFILE_CACHE_MAX_ENTRIES', '1000'))
+        self._profile_cache: "OrderedDict[str, Tuple[UserProfile, float]]" = OrderedDict()
+        self.cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        # 無効化のたびに進める。読み取り中に無効化された結果はキャッシュしない
+        self._invalidation_seq = 0
+        # エージェント用の嗜好サマリー（プロファイルのバージョンが変わらない限り再利用）
+        self._summary_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._profile_watch = None
+        if self.backend == "firestore" and os.getenv('PROFILE_CACHE_WATCH', 'false').lower() == 'true':
+            self._watch_profiles()
+    
+    @property
+    def db(self):
+        # ネットワーク待ちでイベントループを止めないよう非同期クライアントを使う（初回利用時に作成）
+        return providers.get_firestore_client()
+    
+    # === Profile Cache ===
+    def _watch_profiles(self):
+        """他インスタンスでのプロファイル更新を検知してキャッシュを無効化"""
+        try:
+            # on_snapshotは同期クライアントのみ対応のため、監視用に別途作成する
+            watch_db = firestore.Client()
+            query = watch_db.collection(self.profiles_collection).where('updated_at', '>=', datetime.utcnow())
+            self._profile_watch = query.on_snapshot(self._on_profiles_snapshot)
+        except Exception as e:
+            print(f"[WARN] プロファイル変更の監視を開始できませんでした: {e}")
+            self._profile_watch = None
+    
+    def _on_profiles_snapshot(self, col_snapshot, changes, read_time):
+        for change in changes:
+            cached = self._profile_cache.get(change.document.id)
+            data = change.document.to_dict() or {}
+            # 自インスタンスの書き込みで既に反映済みのバージョンなら無効化しない
+            if cached is not None and data.get('version') != cached[0].version:
+                self._invalidate_cached_profile(change.document.id)
+    
+    def _get_cached_profile(self, user_id: str) -> Optional[UserProfile]:
+        cached = self._profile_cache.get(user_id)
+        if cached is None:
+            return None
+        profile, expires_at = cached
+        if time.monotonic() >= expires_at:
+            self._profile_cache.pop(user_id, None)
+            return None
+        self._profile_cache.move_to_end(user_id)
+        return profile
+    
+    def _set_cached_profile(self, user_id: str, profile: UserProfile, expires_at: Optional[float] = None):
+        cached = self._profile_cache.get(user_id)
+        if cached is not None and cached[0].version > profile.version:
+            # より新しいバージョンを保持している場合は上書きしない
+            return
+        if expires_at is None:
+            expires_at = time.monotonic() + self.PROFILE_CACHE_TTL_SECONDS
+        self._profile_cache[user_id] = (profile, expires_at)
+        self._profile_cache.move_to_end(user_id)
+        while len(self._profile_cache) > self.PROFILE_CACHE_MAX_ENTRIES:
+            self._profile_cache.popitem(last=False)
+    
+    def _replace_cached_profile(self, user_id: str, expected: UserProfile, profile: UserProfile):
+        """書き込み前に読んだキャッシュが書き込み中に置き換わっていなければ更新、置き換わっていれば無効化
+        
+        手元でマージした結果はサーバーから読んだ値ではないため、有効期限は元のエントリのまま延長しない
+        （他インスタンスの更新を取りこぼした状態がTTLを超えて残らないようにする）。
+        """
+        cached = self._profile_cache.get(user_id)
+        if cached is not None and cached[0] is expected:
+            self._set_cached_profile(user_id, profile, expires_at=cached[1])
+        else:
+            # 並行する書き込みと手元のマージ結果が食い違うため、次回は読み直す
+            self._invalidate_cached_profile(user_id)
+    
+    def _invalidate_cached_profile(self, user_id: str):
+        self._invalidation_seq += 1
+        self._summary_cache.pop(user_id, None)
+        if self._profile_cache.pop(user_id, None) is not None:
+            self.cache_stats['invalidations'] += 1
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """プロファイルキャッシュの統計（ヘルスチェック用）"""
+        return {
+            **self.cache_stats,
+            'entries': len(self._profile_cache),
+            'ttl_seconds': self.PROFILE_CACHE_TTL_SECONDS,
+            'watching': self._profile_watch is not None,
+            'backend': self.backend
+        }
+    
+    # === Profiles ===
+    def _profile_from_dict(self, data: Dict[str, Any]) -> UserProfile:
+        # datetimeフィールドの変換
+        if 'created_at' in data and data['created_at']:
+            data['created_at'] = data['created_at'].replace(tzinfo=None)
+        if 'updated_at' in data and data['updated_at']:
+            data['updated_at'] = data['updated_at'].replace(tzinfo=None)
+        return UserProfile(**data)
+    
+    def _merge_profile(self, profile: UserProfile, updates: Dict[str, Any]) -> UserProfile:
+        """書き込んだ内容を手元のプロファイルに反映（再読み込みを省く）"""
+        data = profile.dict()
+        data.update(updates)
+        data['version'] = profile.version + 1
+        return UserProfile(**data)
     
     async def get_user_profile(self, user_id: str) -> Optional[UserProfile]:
-        """ユーザープロファイルを取得"""
+        """ユーザープロファイルを取得（キャッシュ優先。返り値は共有されるため変更しないこと）"""
+        cached = self._get_cached_profile(user_id)
+        if cached is not None:
+            self.cache_stats['hits'] += 1
+            return cached
+        self.cache_stats['misses'] += 1
+        if self.backend == "sqlite":
+            return await self._sqlite_get_user_profile(user_id)
+        
         try:
             doc_ref = self.db.collection(self.profiles_collection).document(user_id)
-            doc = doc_ref.get()
+            invalidation_seq = self._invalidation_seq
+            doc = await doc_ref.get()
             
             if doc.exists:
-                data = doc.to_dict()
-                # datetimeフィールドの変換
-                if 'created_at' in data and data['created_at']:
-                    data['created_at'] = data['created_at'].replace(tzinfo=None)
-                if 'updated_at' in data and data['updated_at']:
-                    data['updated_at'] = data['updated_at'].replace(tzinfo=None)
-                
-                return UserProfile(**data)
+                profile = self._profile_from_dict(doc.to_dict())
+                if invalidation_seq == self._invalidation_seq:
+                    self._set_cached_profile(user_id, profile)
+                return profile
             return None
         except Exception as e:
             print(f"[ERROR] プロファイル取得エラー (user_id: {user_id}): {e}")
@@ -46,16 +205,22 @@ class ProfileStorageService:
             else:
                 profile = default_profile
             
-            # Firestoreに保存
-            doc_ref = self.db.collection(self.profiles_collection).document(user_id)
-            profile_dict = profile.dict()
-            
-            # datetime オブジェクトをタイムスタンプに変換
-            for key, value in profile_dict.items():
-                if isinstance(value, datetime):
-                    profile_dict[key] = value
-            
-            doc_ref.set(profile_dict)
+            if self.backend == "sqlite":
+                with self.sqlite.transaction() as conn:
+                    self._sqlite_write_profile(conn, user_id, profile.dict())
+            else:
+                # Firestoreに保存
+                doc_ref = self.db.collection(self.profiles_collection).document(user_id)
+                profile_dict = profile.dict()
+                
+                # datetime オブジェクトをタイムスタンプに変換
+                for key, value in profile_dict.items():
+                    if isinstance(value, datetime):
+                        profile_dict[key] = value
+                
+                await doc_ref.set(profile_dict)
+            self._invalidate_cached_profile(user_id)
+            self._set_cached_profile(user_id, profile)
             
             print(f"[INFO] 新規プロファイル作成完了: {user_id}")
             return profile
@@ -65,7 +230,9 @@ class ProfileStorageService:
             raise
     
     async def update_user_profile(self, user_id: str, updates: UserProfileUpdate) -> Optional[UserProfile]:
-        """ユーザープロファイルを更新"""
+        """ユーザープロファイルを更新（更新後のプロファイルは再読み込みせずに組み立てる）"""
+        if self.backend == "sqlite":
+            return await self._sqlite_update_user_profile(user_id, updates)
         try:
             doc_ref = self.db.collection(self.profiles_collection).document(user_id)
             
@@ -77,13 +244,33 @@ class ProfileStorageService:
             
             # 更新時刻を追加
             update_data['updated_at'] = datetime.utcnow()
-            update_data['version'] = firestore.Increment(1)
             
-            # Firestoreを更新
-            doc_ref.update(update_data)
+            cached = self._get_cached_profile(user_id)
+            if cached is not None:
+                # キャッシュ済みなら書き込みのみ行い、結果は手元でマージ
+                await doc_ref.update({**update_data, 'version': firestore.Increment(1)})
+                updated_profile = self._merge_profile(cached, update_data)
+                self._replace_cached_profile(user_id, cached, updated_profile)
+            else:
+                # 未キャッシュならトランザクションで読み書きし、書き込んだ状態をそのまま返す
+                @firestore.async_transactional
+                async def update_in_transaction(transaction, doc_ref):
+                    doc = await doc_ref.get(transaction=transaction)
+                    if not doc.exists:
+                        return None
+                    data = doc.to_dict()
+                    data.update(update_data)
+                    data['version'] = data.get('version', 1) + 1
+                    transaction.update(doc_ref, {**update_data, 'version': data['version']})
+                    return data
+                
+                data = await update_in_transaction(self.db.transaction(), doc_ref)
+                if data is None:
+                    print(f"[ERROR] プロファイル更新エラー (user_id: {user_id}): プロファイルが存在しません")
+                    return None
+                updated_profile = self._profile_from_dict(data)
+                self._set_cached_profile(user_id, updated_profile)
             
-            # 更新後のプロファイルを取得
-            updated_profile = await self.get_user_profile(user_id)
             print(f"[INFO] プロファイル更新完了: {user_id}")
             return updated_profile
             
@@ -91,6 +278,54 @@ class ProfileStorageService:
             print(f"[ERROR] プロファイル更新エラー (user_id: {user_id}): {e}")
             return None
     
+    async def apply_learned_profile(self, user_id: str, list_additions: Dict[str, List[Any]], scalar_updates: Dict[str, Any]) -> List[str]:
+        """会話から学習した内容を1回のトランザクションで反映（リストは和集合、単一値は上書き）
+        
+        変更したフィールド名の一覧を返す（変更がなければ書き込まない）
+        """
+        if self.backend == "sqlite":
+            return await self._sqlite_apply_learned_profile(user_id, list_additions, scalar_updates)
+        doc_ref = self.db.collection(self.profiles_collection).document(user_id)
+        
+        @firestore.async_transactional
+        async def apply_in_transaction(transaction, doc_ref):
+            doc = await doc_ref.get(transaction=transaction)
+            if not doc.exists:
+                return None, {}
+            data = doc.to_dict()
+            
+            changes = self._learned_changes(data, list_additions, scalar_updates)
+            if not changes:
+                return data, {}
+            data.update(changes)
+            data['updated_at'] = datetime.utcnow()
+            data['version'] = data.get('version', 1) + 1
+            transaction.update(doc_ref, {**changes, 'updated_at': data['updated_at'], 'version': data['version']})
+            return data, changes
+        
+        data, changes = await apply_in_transaction(self.db.transaction(), doc_ref)
+        if data is None:
+            print(f"[WARN] ユーザー {user_id} のプロファイルが見つかりません")
+            return []
+        if changes:
+            self._set_cached_profile(user_id, self._profile_from_dict(data))
+        return list(changes.keys())
+    
+    def _learned_changes(self, data: Dict[str, Any], list_additions: Dict[str, List[Any]], scalar_updates: Dict[str, Any]) -> Dict[str, Any]:
+        """現在のプロファイルに対する学習結果の差分（書き込む値はモデルで検証済み）"""
+        changes = {}
+        for field, values in list_additions.items():
+            existing = list(data.get(field) or [])
+            additions = [value for value in values if value not in existing]
+            if additions:
+                changes[field] = existing + additions
+        for field, value in scalar_updates.items():
+            if value != data.get(field):
+                changes[field] = value
+        if not changes:
+            return {}
+        return {field: value for field, value in UserProfileUpdate(**changes).dict(exclude_unset=True).items() if value is not None}
+    
     async def get_or_create_profile(self, user_id: str, user_info: Dict[str, Any] = None) -> UserProfile:
         """プロファイルを取得、なければ作成"""
         profile = await self.get_user_profile(user_id)
@@ -108,6 +343,8 @@ class ProfileStorageService:
     
     async def add_recipe_feedback(self, user_id: str, feedback: RecipeFeedback) -> bool:
         """レシピフィードバックを追加"""
+        if self.backend == "sqlite":
+            return await self._sqlite_add_recipe_feedback(user_id, feedback)
         try:
             # フィードバックをサブコレクションに保存
             feedback_ref = (self.db.collection(self.profiles_collection)
@@ -120,18 +357,30 @@ class ProfileStorageService:
             if 'created_at' in feedback_dict:
                 feedback_dict['created_at'] = feedback_dict['created_at']
             
-            feedback_ref.set(feedback_dict)
+            # フィードバック・プロファイルの履歴・調理統計を1つのバッチで更新
+            batch = self.db.batch()
+            batch.set(feedback_ref, feedback_dict)
             
-            # メインプロファイルのフィードバック履歴も更新
             profile_ref = self.db.collection(self.profiles_collection).document(user_id)
-            profile_ref.update({
+            batch.update(profile_ref, {
                 f'recipe_feedback.{feedback.recipe_id}': {
                     'rating': feedback.rating,
                     'last_feedback': feedback_dict['created_at'],
                     'feedback_count': firestore.Increment(1)
                 },
-                'updated_at': datetime.utcnow()
+                'updated_at': datetime.utcnow(),
+                'version': firestore.Increment(1)
             })
+            new_stats_fields = await self._new_stats_fields(user_id)
+            batch.set(self._cooking_stats_ref(user_id), {
+                **self._as_increments(self._feedback_stats_values(feedback_dict)),
+                **new_stats_fields,
+                # 高評価（4以上）のレシピは最新の評価で入れ替える
+                'high_rated_recipes': (firestore.ArrayUnion if feedback.rating >= 4 else firestore.ArrayRemove)([feedback.recipe_id]),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            await batch.commit()
+            self._invalidate_cached_profile(user_id)
             
             print(f"[INFO] レシピフィードバック追加: {user_id} -> {feedback.recipe_id}")
             return True
@@ -142,6 +391,8 @@ class ProfileStorageService:
     
     async def add_cooking_session(self, user_id: str, session: CookingSession) -> bool:
         """調理セッションを記録"""
+        if self.backend == "sqlite":
+            return await self._sqlite_add_cooking_session(user_id, session)
         try:
             # セッションをサブコレクションに保存
             session_ref = (self.db.collection(self.profiles_collection)
@@ -154,30 +405,44 @@ class ProfileStorageService:
             if 'created_at' in session_dict:
                 session_dict['created_at'] = session_dict['created_at']
             
-            session_ref.set(session_dict)
-            
-            # メインプロファイルの調理履歴も更新
+            # メインプロファイルの調理履歴も同じコミットで更新（最新10件を保持）
             profile_ref = self.db.collection(self.profiles_collection).document(user_id)
+            entry = {
+                'session_id': session.session_id,
+                'recipe_name': session.recipe_name,
+                'date': session_dict['created_at'],
+                'success_rating': session.success_rating
+            }
+            updated_at = datetime.utcnow()
+            session_stats = {
+                **self._as_increments(self._session_stats_values(session_dict)),
+                'last_cooked_at': session_dict['created_at'],
+                'updated_at': firestore.SERVER_TIMESTAMP,
+                **(await self._new_stats_fields(user_id))
+            }
             
-            # 最近の調理履歴を追加（最新10件を保持）
-            current_profile = await self.get_user_profile(user_id)
-            if current_profile:
-                cooking_history = current_profile.cooking_history.copy()
-                cooking_history.append({
-                    'session_id': session.session_id,
-                    'recipe_name': session.recipe_name,
-                    'date': session_dict['created_at'],
-                    'success_rating': session.success_rating
-                })
-                
-                # 最新10件のみ保持
-                if len(cooking_history) > 10:
-                    cooking_history = cooking_history[-10:]
-                
-                profile_ref.update({
-                    'cooking_history': cooking_history,
-                    'updated_at': datetime.utcnow()
+            # 上限（最新10件）の判定はキャッシュではなくトランザクション内で読んだ最新の履歴で行う
+            @firestore.async_transactional
+            async def append_in_transaction(transaction, profile_ref):
+                doc = await profile_ref.get(transaction=transaction)
+                transaction.set(session_ref, session_dict)
+                transaction.set(self._cooking_stats_ref(user_id), session_stats, merge=True)
+                if not doc.exists:
+                    return None
+                data = doc.to_dict()
+                data['cooking_history'] = (data.get('cooking_history') or [])[-(COOKING_HISTORY_LIMIT - 1):] + [entry]
+                data['updated_at'] = updated_at
+                data['version'] = data.get('version', 1) + 1
+                transaction.update(profile_ref, {
+                    'cooking_history': data['cooking_history'],
+                    'updated_at': updated_at,
+                    'version': data['version']
                 })
+                return data
+            
+            data = await append_in_transaction(self.db.transaction(), profile_ref)
+            if data is not None:
+                self._set_cached_profile(user_id, self._profile_from_dict(data))
             
             print(f"[INFO] 調理セッション記録: {user_id} -> {session.session_id}")
             return True
@@ -193,7 +458,15 @@ class ProfileStorageService:
             if not profile:
                 return {}
             
-            return {
+            cached = self._summary_cache.get(user_id)
+            if cached is not None and cached['profile_version'] == profile.version:
+                self._summary_cache.move_to_end(user_id)
+                return dict(cached)
+            
+            # user_id と profile_version はレシピの制約文キャッシュのキーとして使われる
+            summary = {
+                'user_id': user_id,
+                'profile_version': profile.version,
                 'dietary_restrictions': profile.dietary_restrictions,
                 'allergies': profile.allergies,
                 'disliked_ingredients': profile.disliked_ingredients,
@@ -208,6 +481,11 @@ class ProfileStorageService:
                 'family_size': profile.family_size,
                 'kitchen_equipment': profile.kitchen_equipment
             }
+            self._summary_cache[user_id] = summary
+            self._summary_cache.move_to_end(user_id)
+            while len(self._summary_cache) > self.PROFILE_CACHE_MAX_ENTRIES:
+                self._summary_cache.popitem(last=False)
+            return dict(summary)
             
         except Exception as e:
             print(f"[ERROR] 嗜好サマリー取得エラー: {e}")
@@ -215,6 +493,8 @@ class ProfileStorageService:
     
     async def get_recent_feedback(self, user_id: str, limit: int = 10) -> List[Dict[str, Any]]:
         """最近のフィードバックを取得"""
+        if self.backend == "sqlite":
+            return await self._sqlite_get_recent_feedback(user_id, limit)
         try:
             feedback_ref = (self.db.collection(self.profiles_collection)
                           .document(user_id)
@@ -222,10 +502,9 @@ class ProfileStorageService:
                           .order_by('created_at', direction=firestore.Query.DESCENDING)
                           .limit(limit))
             
-            docs = feedback_ref.stream()
             feedback_list = []
             
-            for doc in docs:
+            async for doc in feedback_ref.stream():
                 data = doc.to_dict()
                 if 'created_at' in data and data['created_at']:
                     data['created_at'] = data['created_at'].isoformat() if hasattr(data['created_at'], 'isoformat') else str(data['created_at'])
@@ -237,39 +516,318 @@ class ProfileStorageService:
             print(f"[ERROR] フィードバック取得エラー: {e}")
             return []
     
+    # === Cooking Stats ===
+    # 保存形式: user_profiles/{user_id}/stats/cooking（セッション・フィードバックの書き込みと同じバッチで加算）
+    def _cooking_stats_ref(self, user_id: str):
+        return (self.db.collection(self.profiles_collection)
+                .document(user_id)
+                .collection(self.stats_collection)
+                .document("cooking"))
+    
+    async def _new_stats_fields(self, user_id: str) -> Dict[str, Any]:
+        """集計ドキュメントを新規作成する書き込みに付ける項目
+        
+        それ以前の履歴が無いユーザーは加算だけで全件を数えられるため、初回の取得で全件集計しないよう backfilled を付ける。
+        """
+        if (await self._cooking_stats_ref(user_id).get()).exists:
+            return {}
+        profile_ref = self.db.collection(self.profiles_collection).document(user_id)
+        for collection in (self.sessions_collection, self.feedback_collection):
+            async for _ in profile_ref.collection(collection).limit(1).stream():
+                return {}
+        return {'backfilled': True}
+    
+    def _week_key(self, value: Any) -> str:
+        if not isinstance(value, datetime):
+            value = datetime.utcnow()
+        year, week, _ = value.isocalendar()
+        return f"{year}-W{week:02d}"
+    
+    def _session_stats_values(self, session: Dict[str, Any]) -> Dict[str, Any]:
+        """調理セッション1件分の加算値"""
+        values = {
+            'session_count': 1,
+            'weekly_counts': {self._week_key(session.get('created_at')): 1},
+            'ingredient_counts': {
+                ingredient: 1 for ingredient in set(session.get('ingredients_used') or [])
+                if isinstance(ingredient, str) and ingredient.strip()
+            }
+        }
+        rating = session.get('success_rating')
+        if rating:
+            values['success_rating_sum'] = rating
+            values['success_rating_count'] = 1
+            values['success_rating_histogram'] = {str(rating): 1}
+        if session.get('cooking_time'):
+            values['cooking_time_sum'] = session['cooking_time']
+            values['cooking_time_count'] = 1
+        return values
+    
+    def _feedback_stats_values(self, feedback: Dict[str, Any]) -> Dict[str, Any]:
+        """フィードバック1件分の加算値"""
+        return {
+            'feedback_count': 1,
+            'feedback_rating_sum': feedback['rating'],
+            'feedback_rating_histogram': {str(feedback['rating']): 1}
+        }
+    
+    def _as_increments(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: self._as_increments(value) if isinstance(value, dict) else firestore.Increment(value)
+                for key, value in values.items()}
+    
+    def _add_values(self, total: Dict[str, Any], values: Dict[str, Any]):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                self._add_values(total.setdefault(key, {}), value)
+            else:
+                total[key] = total.get(key, 0) + value
+    
+    async def _backfill_cooking_stats(self, user_id: str) -> Dict[str, Any]:
+        """集計ドキュメント導入前の履歴から一度だけ全件集計する
+        
+        集計ドキュメントを先にトランザクション内で読んでから履歴を数える。並行する記録の加算は、
+        先にコミットされていれば集計に含まれ、そうでなければこのコミットの後に加算される。
+        """
+        profile_ref = self.db.collection(self.profiles_collection).document(user_id)
+        stats_ref = self._cooking_stats_ref(user_id)
+        
+        @firestore.async_transactional
+        async def backfill_in_transaction(transaction):
+            doc = await stats_ref.get(transaction=transaction)
+            if doc.exists and doc.to_dict().get('backfilled'):
+                # 他のリクエストが集計済み
+                return doc.to_dict()
+            
+            stats: Dict[str, Any] = {}
+            last_cooked_at = None
+            async for session_doc in profile_ref.collection(self.sessions_collection).stream(transaction=transaction):
+                session = session_doc.to_dict()
+                self._add_values(stats, self._session_stats_values(session))
+                created_at = session.get('created_at')
+                if isinstance(created_at, datetime) and (last_cooked_at is None or created_at > last_cooked_at):
+                    last_cooked_at = created_at
+            
+            latest_ratings: Dict[str, Any] = {}
+            async for feedback_doc in profile_ref.collection(self.feedback_collection).order_by('created_at').stream(transaction=transaction):
+                feedback = feedback_doc.to_dict()
+                if feedback.get('rating'):
+                    self._add_values(stats, self._feedback_stats_values(feedback))
+                    latest_ratings[feedback.get('recipe_id')] = feedback['rating']
+            
+            stats['high_rated_recipes'] = [recipe_id for recipe_id, rating in latest_ratings.items() if recipe_id and rating >= 4]
+            stats['last_cooked_at'] = last_cooked_at
+            stats['backfilled'] = True
+            transaction.set(stats_ref, {**stats, 'updated_at': firestore.SERVER_TIMESTAMP})
+            return stats
+        
+        return await backfill_in_transaction(self.db.transaction())
+    
     async def get_cooking_stats(self, user_id: str) -> Dict[str, Any]:
-        """調理統計を取得"""
+        """調理統計を取得（集計ドキュメント1件の読み取りのみ）"""
         try:
-            profile = await self.get_user_profile(user_id)
-            if not profile:
-                return {}
+            if self.backend == "sqlite":
+                row = self.sqlite.fetch_one("SELECT data FROM cooking_stats WHERE user_id = ?", (user_id,))
+                return self._format_cooking_stats(json.loads(row['data']) if row else {})
             
-            # 基本統計
-            stats = {
-                'total_recipes_tried': len(profile.cooking_history),
-                'average_success_rating': 0,
-                'favorite_cuisines': [],
-                'most_used_ingredients': [],
-                'cooking_frequency': 0
-            }
+            doc = await self._cooking_stats_ref(user_id).get()
+            data = doc.to_dict() if doc.exists else {}
+            if not data.get('backfilled'):
+                data = await self._backfill_cooking_stats(user_id)
+            return self._format_cooking_stats(data)
+            
+        except Exception as e:
+            print(f"[ERROR] 統計取得エラー: {e}")
+            return {}
+    
+    def _format_cooking_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """集計ドキュメントからAPIの統計形式に変換"""
+        ingredient_counts = data.get('ingredient_counts') or {}
+        weekly_counts = data.get('weekly_counts') or {}
+        now = datetime.utcnow()
+        recent_weeks = [self._week_key(now - timedelta(weeks=i)) for i in range(8)][::-1]
+        
+        stats = {
+            'total_recipes_tried': data.get('session_count', 0),
+            'average_success_rating': 0,
+            'favorite_cuisines': [],
+            'most_used_ingredients': [name for name, _ in sorted(ingredient_counts.items(), key=lambda item: (-item[1], item[0]))[:5]],
+            'cooking_frequency': round(sum(weekly_counts.get(week, 0) for week in recent_weeks[-COOKING_FREQUENCY_WEEKS:]) / COOKING_FREQUENCY_WEEKS, 2),
+            'success_rating_histogram': {str(r): (data.get('success_rating_histogram') or {}).get(str(r), 0) for r in range(1, 6)},
+            'weekly_counts': {week: weekly_counts.get(week, 0) for week in recent_weeks},
+            'feedback_count': data.get('feedback_count', 0),
+            'feedback_rating_histogram': {str(r): (data.get('feedback_rating_histogram') or {}).get(str(r), 0) for r in range(1, 6)}
+        }
+        
+        # 成功率の計算
+        if data.get('success_rating_count'):
+            stats['average_success_rating'] = data['success_rating_sum'] / data['success_rating_count']
+        if data.get('cooking_time_count'):
+            stats['average_cooking_time'] = data['cooking_time_sum'] / data['cooking_time_count']
+        
+        # フィードバックから好みを抽出
+        if data.get('feedback_count'):
+            stats['high_rated_recipes_count'] = len(data.get('high_rated_recipes') or [])
+        
+        return stats
+    
+    # === SQLite Methods ===
+    # テーブル: user_profiles / recipe_feedback / cooking_sessions / cooking_stats（SQLITE_SCHEMA参照）
+    # 各書き込みは1トランザクションで行い、プロファイル・統計の更新も同じコミットに含める
+    def _sqlite_profile_from_data(self, data: Dict[str, Any]) -> UserProfile:
+        for key in ('created_at', 'updated_at'):
+            if isinstance(data.get(key), str):
+                data[key] = datetime.fromisoformat(data[key])
+        return UserProfile(**data)
+    
+    def _sqlite_read_profile_data(self, conn, user_id: str) -> Optional[Dict[str, Any]]:
+        row = conn.execute("SELECT data FROM user_profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row['data']) if row else None
+    
+    def _sqlite_write_profile(self, conn, user_id: str, data: Dict[str, Any]):
+        conn.execute(
+            "INSERT INTO user_profiles (user_id, version, data, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET version = excluded.version, data = excluded.data, updated_at = excluded.updated_at",
+            (user_id, data.get('version', 1), to_json(data), to_json(data.get('updated_at')))
+        )
+    
+    def _sqlite_apply_stats(self, conn, user_id: str, values: Dict[str, Any], updates: Dict[str, Any] = None, high_rated: Optional[Tuple[str, bool]] = None):
+        row = conn.execute("SELECT data FROM cooking_stats WHERE user_id = ?", (user_id,)).fetchone()
+        stats = json.loads(row['data']) if row else {}
+        self._add_values(stats, values)
+        stats.update(updates or {})
+        if high_rated is not None:
+            # 高評価（4以上）のレシピは最新の評価で入れ替える
+            recipe_id, is_high = high_rated
+            stats['high_rated_recipes'] = [r for r in stats.get('high_rated_recipes', []) if r != recipe_id] + ([recipe_id] if is_high else [])
+        conn.execute(
+            "INSERT INTO cooking_stats (user_id, data) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+            (user_id, to_json(stats))
+        )
+    
+    async def _sqlite_get_user_profile(self, user_id: str) -> Optional[UserProfile]:
+        try:
+            row = self.sqlite.fetch_one("SELECT data FROM user_profiles WHERE user_id = ?", (user_id,))
+            if row is None:
+                return None
+            profile = self._sqlite_profile_from_data(json.loads(row['data']))
+            self._set_cached_profile(user_id, profile)
+            return profile
+        except Exception as e:
+            print(f"[ERROR] プロファイル取得エラー (user_id: {user_id}): {e}")
+            return None
+    
+    async def _sqlite_update_user_profile(self, user_id: str, updates: UserProfileUpdate) -> Optional[UserProfile]:
+        try:
+            update_data = {field: value for field, value in updates.dict(exclude_unset=True).items() if value is not None}
+            update_data['updated_at'] = datetime.utcnow()
+            
+            with self.sqlite.transaction() as conn:
+                data = self._sqlite_read_profile_data(conn, user_id)
+                if data is None:
+                    print(f"[ERROR] プロファイル更新エラー (user_id: {user_id}): プロファイルが存在しません")
+                    return None
+                data.update(update_data)
+                data['version'] = data.get('version', 1) + 1
+                self._sqlite_write_profile(conn, user_id, data)
+            
+            updated_profile = self._sqlite_profile_from_data(dict(data))
+            self._set_cached_profile(user_id, updated_profile)
+            print(f"[INFO] プロファイル更新完了: {user_id}")
+            return updated_profile
             
-            # 成功率の計算
-            if profile.cooking_history:
-                success_ratings = [h.get('success_rating', 0) for h in profile.cooking_history if h.get('success_rating')]
-                if success_ratings:
-                    stats['average_success_rating'] = sum(success_ratings) / len(success_ratings)
+        except Exception as e:
+            print(f"[ERROR] プロファイル更新エラー (user_id: {user_id}): {e}")
+            return None
+    
+    async def _sqlite_apply_learned_profile(self, user_id: str, list_additions: Dict[str, List[Any]], scalar_updates: Dict[str, Any]) -> List[str]:
+        with self.sqlite.transaction() as conn:
+            data = self._sqlite_read_profile_data(conn, user_id)
+            if data is None:
+                print(f"[WARN] ユーザー {user_id} のプロファイルが見つかりません")
+                return []
+            changes = self._learned_changes(data, list_additions, scalar_updates)
+            if not changes:
+                return []
+            data.update(changes)
+            data['updated_at'] = datetime.utcnow()
+            data['version'] = data.get('version', 1) + 1
+            self._sqlite_write_profile(conn, user_id, data)
+        
+        self._set_cached_profile(user_id, self._sqlite_profile_from_data(dict(data)))
+        return list(changes.keys())
+    
+    async def _sqlite_add_recipe_feedback(self, user_id: str, feedback: RecipeFeedback) -> bool:
+        try:
+            feedback_dict = feedback.dict()
+            with self.sqlite.transaction() as conn:
+                conn.execute(
+                    "INSERT INTO recipe_feedback (user_id, recipe_id, created_at, data) VALUES (?, ?, ?, ?)",
+                    (user_id, feedback.recipe_id, to_json(feedback_dict['created_at']), to_json(feedback_dict))
+                )
+                data = self._sqlite_read_profile_data(conn, user_id)
+                if data is not None:
+                    previous = (data.get('recipe_feedback') or {}).get(feedback.recipe_id) or {}
+                    data.setdefault('recipe_feedback', {})[feedback.recipe_id] = {
+                        'rating': feedback.rating,
+                        'last_feedback': feedback_dict['created_at'],
+                        'feedback_count': previous.get('feedback_count', 0) + 1
+                    }
+                    data['updated_at'] = datetime.utcnow()
+                    data['version'] = data.get('version', 1) + 1
+                    self._sqlite_write_profile(conn, user_id, data)
+                self._sqlite_apply_stats(conn, user_id, self._feedback_stats_values(feedback_dict),
+                                         high_rated=(feedback.recipe_id, feedback.rating >= 4))
+            self._invalidate_cached_profile(user_id)
             
-            # フィードバックから好みを抽出
-            if profile.recipe_feedback:
-                high_rated_recipes = [recipe_id for recipe_id, feedback in profile.recipe_feedback.items() 
-                                    if feedback.get('rating', 0) >= 4]
-                stats['high_rated_recipes_count'] = len(high_rated_recipes)
+            print(f"[INFO] レシピフィードバック追加: {user_id} -> {feedback.recipe_id}")
+            return True
             
-            return stats
+        except Exception as e:
+            print(f"[ERROR] フィードバック追加エラー: {e}")
+            return False
+    
+    async def _sqlite_add_cooking_session(self, user_id: str, session: CookingSession) -> bool:
+        try:
+            session_dict = session.dict()
+            entry = {
+                'session_id': session.session_id,
+                'recipe_name': session.recipe_name,
+                'date': session_dict['created_at'],
+                'success_rating': session.success_rating
+            }
+            with self.sqlite.transaction() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cooking_sessions (user_id, session_id, created_at, data) VALUES (?, ?, ?, ?)",
+                    (user_id, session.session_id, to_json(session_dict['created_at']), to_json(session_dict))
+                )
+                self._sqlite_apply_stats(conn, user_id, self._session_stats_values(session_dict),
+                                         updates={'last_cooked_at': session_dict['created_at']})
+                data = self._sqlite_read_profile_data(conn, user_id)
+                if data is not None:
+                    data['cooking_history'] = (data.get('cooking_history') or [])[-(COOKING_HISTORY_LIMIT - 1):] + [entry]
+                    data['updated_at'] = datetime.utcnow()
+                    data['version'] = data.get('version', 1) + 1
+                    self._sqlite_write_profile(conn, user_id, data)
+            
+            if data is not None:
+                self._set_cached_profile(user_id, self._sqlite_profile_from_data(dict(data)))
+            print(f"[INFO] 調理セッション記録: {user_id} -> {session.session_id}")
+            return True
             
         except Exception as e:
-            print(f"[ERROR] 統計取得エラー: {e}")
-            return {}
+            print(f"[ERROR] セッション記録エラー: {e}")
+            return False
+    
+    async def _sqlite_get_recent_feedback(self, user_id: str, limit: int) -> List[Dict[str, Any]]:
+        try:
+            rows = self.sqlite.fetch_all(
+                "SELECT data FROM recipe_feedback WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?",
+                (user_id, limit)
+            )
+            return [json.loads(row['data']) for row in rows]
+        except Exception as e:
+            print(f"[ERROR] フィードバック取得エラー: {e}")
+            return []
 
 # シングルトンインスタンス
 profile_storage = ProfileStorageService()
\ No newline at end of file
@@ -0,0 +1,81 @@
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, List, Optional, Sequence
+
+# STORAGE_BACKEND=sqlite でプロファイル・利用制限・会話履歴をローカルのSQLiteに保存する（単一ノード向け）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data/dinner_cam.db")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+def sqlite_enabled() -> bool:
+    return STORAGE_BACKEND == "sqlite"
+
+def to_json(value: Any) -> str:
+    """datetimeはISO形式の文字列にしてJSON化"""
+    return json.dumps(value, ensure_ascii=False, default=lambda v: v.isoformat() if isinstance(v, datetime) else str(v))
+
+class SQLiteStore:
+    """WALモードのSQLite接続
+    
+    - 1つの接続をロックで共有する（読み取りも書き込みもローカルで完結するため待ち時間はごく短い）
+    - SQLはパラメータ付きの固定文字列のみを使い、接続の文キャッシュでコンパイル済みの文を再利用する
+    - 複数行の書き込みは transaction() 内でまとめて1回のコミットにする
+    """
+    
+    def __init__(self, path: str = SQLITE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # isolation_level=None: トランザクションは transaction() で明示的に開始する
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        self._lock = threading.RLock()
+    
+    def ensure_schema(self, schema: str):
+        """CREATE TABLE IF NOT EXISTS 形式のスキーマを適用"""
+        with self._lock:
+            self.conn.executescript(schema)
+    
+    def fetch_one(self, sql: str, params: Sequence[Any] = ()) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+    
+    def fetch_all(self, sql: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+    
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> int:
+        """1文だけの書き込み（自動コミット）。変更した行数を返す"""
+        with self._lock:
+            return self.conn.execute(sql, params).rowcount
+    
+    @contextmanager
+    def transaction(self):
+        """書き込みロックを取ってトランザクションを開始し、例外時はロールバック"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+_store: Optional[SQLiteStore] = None
+_store_lock = threading.Lock()
+
+def get_sqlite_store() -> SQLiteStore:
+    """プロセス内で共有するSQLiteStoreを取得（初回呼び出し時に接続）"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SQLiteStore()
+        return _store
@@ -13,6 +13,28 @@ import { AuthProvider, useAuth } from './contexts/AuthContext';
 const GOOGLE_CLIENT_ID = import.meta.env.VITE_GOOGLE_CLIENT_ID;
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL;
 
+// 添付画像のURLが相対パスで返された場合はAPIサーバーのURLを付ける
+const resolveApiUrl = (url) => (typeof url === 'string' && url.startsWith('/') ? `${API_BASE_URL}${url}` : url);
+
+// サーバーから取得したメッセージを表示用に変換（IDが無い・重複する場合は新しいユニークIDを生成）
+const restoreMessages = (serverMessages, seenIds) => serverMessages.map((msg, index) => {
+  let uniqueId = msg.id || `restored-${Date.now()}-${index}-${Math.random().toString(36).slice(2, 11)}`;
+  
+  // IDの重複をチェック、重複していたら新しいIDを生成
+  while (seenIds.has(uniqueId)) {
+    uniqueId = `${uniqueId}-${Math.random().toString(36).slice(2, 5)}`;
+  }
+  seenIds.add(uniqueId);
+  
+  return {
+    ...msg,
+    id: uniqueId,
+    timestamp: new Date(msg.timestamp),
+    image: resolveApiUrl(msg.image),
+    stepImage: msg.stepImage ? { ...msg.stepImage, image_url: resolveApiUrl(msg.stepImage.image_url) } : msg.stepImage
+  };
+});
+
 function AppContent() {
   const { user, isAuthenticated, loading, getAuthHeaders } = useAuth();
   
@@ -20,6 +42,9 @@ function AppContent() {
   const [messages, setMessages] = useState([]);
   const [isLoadingMessages, setIsLoadingMessages] = useState(false);
   const [messagesSynced, setMessagesSynced] = useState(false);
+  // さらに古い履歴の取得用カーソル（無ければ全件表示済み）
+  const [olderCursor, setOlderCursor] = useState(null);
+  const [isLoadingOlder, setIsLoadingOlder] = useState(false);
   
   const [currentRecipe, setCurrentRecipe] = useState(null);
   const [currentNutrition, setCurrentNutrition] = useState(null);
@@ -41,6 +66,9 @@ function AppContent() {
   const currentRecipeMessageIdRef = useRef(null);
   
   const messagesEndRef = useRef(null);
+  const messagesContainerRef = useRef(null);
+  // 古い履歴を先頭に追加したときは最下部へスクロールしない
+  const skipScrollRef = useRef(false);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -68,6 +96,10 @@ function AppContent() {
   };
 
   useEffect(() => {
+    if (skipScrollRef.current) {
+      skipScrollRef.current = false;
+      return;
+    }
     scrollToBottom();
   }, [messages, isTyping, showIngredientCheck]);
 
@@ -88,25 +120,11 @@ function AppContent() {
         console.log(`[INFO] ${data.message_count}件のメッセージを復元しました (${data.backend})`);
         
         if (data.messages && data.messages.length > 0) {
-          // メッセージを復元（IDが文字列でない場合は新しいユニークIDを生成）
-          const seenIds = new Set();
-          const restoredMessages = data.messages.map((msg, index) => {
-            let uniqueId = msg.id || `restored-${Date.now()}-${index}-${Math.random().toString(36).slice(2, 11)}`;
-            
-            // IDの重複をチェック、重複していたら新しいIDを生成
-            while (seenIds.has(uniqueId)) {
-              uniqueId = `${uniqueId}-${Math.random().toString(36).slice(2, 5)}`;
-            }
-            seenIds.add(uniqueId);
-            
-            return {
-              ...msg,
-              id: uniqueId,
-              timestamp: new Date(msg.timestamp)
-            };
-          });
+          // メッセージを復元（最新のページのみ。古い履歴は「以前のメッセージ」から読み込む）
+          const restoredMessages = restoreMessages(data.messages, new Set());
           
           setMessages(restoredMessages);
+          setOlderCursor(data.has_more ? data.next_cursor : null);
           console.log(`[INFO] 会話復元完了！${restoredMessages.length}件のメッセージを復元`);
         } else {
           // 新規ユーザーの場合は初回メッセージを表示
@@ -148,6 +166,46 @@ function AppContent() {
     }
   };
 
+  // 古い履歴の読み込み：表示中の最古のメッセージより前のページを先頭に追加
+  const loadOlderMessages = async () => {
+    if (!olderCursor || isLoadingOlder) return;
+    
+    setIsLoadingOlder(true);
+    try {
+      const response = await fetch(`${API_BASE_URL}/conversations/messages?before=${encodeURIComponent(olderCursor)}`, {
+        headers: getAuthHeaders()
+      });
+      
+      if (response.ok) {
+        const data = await response.json();
+        const container = messagesContainerRef.current;
+        const previousScrollHeight = container ? container.scrollHeight : 0;
+        
+        skipScrollRef.current = true;
+        setMessages(prev => {
+          const seenIds = new Set(prev.map(msg => msg.id));
+          const olderMessages = restoreMessages(data.messages || [], seenIds);
+          return [...olderMessages, ...prev];
+        });
+        setOlderCursor(data.has_more ? data.next_cursor : null);
+        
+        // 追加した分だけスクロール位置をずらし、読んでいた位置を保つ
+        requestAnimationFrame(() => {
+          if (container) {
+            container.scrollTop += container.scrollHeight - previousScrollHeight;
+          }
+        });
+        console.log(`[INFO] 以前のメッセージを${data.message_count}件読み込みました`);
+      } else {
+        console.error('[ERROR] 以前のメッセージの読み込み失敗:', response.status);
+      }
+    } catch (error) {
+      console.error('[ERROR] 以前のメッセージの読み込みエラー:', error);
+    } finally {
+      setIsLoadingOlder(false);
+    }
+  };
+
   // LINEスタイル会話保存：新しいメッセージをサーバーに保存
   const saveMessageToServer = async (message) => {
     try {
@@ -439,6 +497,7 @@ function AppContent() {
         
         if (response.ok) {
           setMessages([]);
+          setOlderCursor(null);
           setMessagesSynced(false);
           
           // 新しい初回メッセージを表示
@@ -691,7 +750,19 @@ function AppContent() {
       </div>
 
       <div className="flex-1 overflow-hidden flex max-w-4xl mx-auto w-full">
-        <div className="flex-1 overflow-y-auto p-4 space-y-4 pb-8">
+        <div ref={messagesContainerRef} className="flex-1 overflow-y-auto p-4 space-y-4 pb-8">
+          {olderCursor && (
+            <div className="flex justify-center">
+              <button
+                onClick={loadOlderMessages}
+                disabled={isLoadingOlder}
+                className="px-4 py-1 text-sm text-gray-600 bg-white border border-gray-200 rounded-full shadow-sm hover:bg-gray-50 disabled:opacity-50"
+              >
+                {isLoadingOlder ? '読み込み中...' : '以前のメッセージを読み込む'}
+              </button>
+            </div>
+          )}
+          
           {messages.map((message, index) => (
             <ChatMessage key={`${message.id}-${index}`} message={message} />
           ))}